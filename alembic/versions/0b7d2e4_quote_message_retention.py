@@ -0,0 +1,40 @@
+"""Add send times and lookup indexes to quote messages.
+
+Revision ID: 0b7d2e4c51f9
+Revises: f3a61c8d92b4
+Create Date: 2026-10-19 18:40:12.518802
+
+"""
+
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0b7d2e4c51f9'
+down_revision = 'f3a61c8d92b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'quote_message', sa.Column('sent_at', sa.DateTime(), nullable=True))
+
+    # Existing messages are at most as old as now; counting them from now
+    # keeps them for at least the full retention period
+    quote_message = sa.table('quote_message', sa.column('sent_at', sa.DateTime))
+    op.execute(quote_message.update().values(sent_at=datetime.datetime.now()))
+
+    op.create_index(
+        'ix_quote_message_chat_id_message_id', 'quote_message',
+        ['chat_id', 'message_id'])
+    op.create_index(
+        'ix_quote_message_quote_id', 'quote_message', ['quote_id'])
+
+
+def downgrade():
+    op.drop_index('ix_quote_message_quote_id', table_name='quote_message')
+    op.drop_index(
+        'ix_quote_message_chat_id_message_id', table_name='quote_message')
+    op.drop_column('quote_message', 'sent_at')
@@ -0,0 +1,62 @@
+"""Add archive tables for deleted quotes.
+
+Revision ID: 5c8e1a3b7d40
+Revises: 0b7d2e4c51f9
+Create Date: 2026-10-19 19:52:37.104215
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '5c8e1a3b7d40'
+down_revision = '0b7d2e4c51f9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'archived_quote',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('chat_id', sa.Integer(), nullable=True),
+        sa.Column('message_id', sa.Integer(), nullable=True),
+        sa.Column('is_forward', sa.Boolean(), nullable=True),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.Column('sent_by_id', sa.Integer(), nullable=True),
+        sa.Column('content', sa.Text(), nullable=True),
+        sa.Column('content_html', sa.Text(), nullable=True),
+        sa.Column('file_id', sa.Text(), nullable=True),
+        sa.Column(
+            'message_type', sa.Enum('text', 'photo'), nullable=True),
+        sa.Column('quoted_by_id', sa.Integer(), nullable=True),
+        sa.Column('score', sa.Integer(), nullable=True),
+        sa.Column('archived_at', sa.DateTime(), nullable=True),
+        sa.Column('key', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_archived_quote_key', 'archived_quote', ['key'])
+
+    op.create_table(
+        'archived_quote_message',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('chat_id', sa.Integer(), nullable=True),
+        sa.Column('message_id', sa.Integer(), nullable=True),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.Column('quote_id', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id'))
+
+    op.create_table(
+        'archived_vote',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('quote_id', sa.Integer(), nullable=True),
+        sa.Column('direction', sa.Integer(), nullable=False),
+        sa.Column('voted_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('archived_vote')
+    op.drop_table('archived_quote_message')
+    op.drop_index('ix_archived_quote_key', table_name='archived_quote')
+    op.drop_table('archived_quote')
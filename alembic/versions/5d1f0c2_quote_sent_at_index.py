@@ -0,0 +1,24 @@
+"""Add an index for date range searches.
+
+Revision ID: 5d1f0c2a9e34
+Revises: 119a5dc71f08
+Create Date: 2026-10-19 09:12:40.118274
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '5d1f0c2a9e34'
+down_revision = '119a5dc71f08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_quote_chat_id_sent_at', 'quote', ['chat_id', 'sent_at'])
+
+
+def downgrade():
+    op.drop_index('ix_quote_chat_id_sent_at', table_name='quote')
@@ -0,0 +1,47 @@
+"""Stop reusing the IDs of quotes, quote messages and votes.
+
+Revision ID: 7e2c9d4a6b15
+Revises: 5c8e1a3b7d40
+Create Date: 2026-10-20 10:14:26.377810
+
+"""
+
+from alembic import op
+
+revision = '7e2c9d4a6b15'
+down_revision = '5c8e1a3b7d40'
+branch_labels = None
+depends_on = None
+
+# Tables whose IDs are kept by the archive, and their archive tables
+TABLES = [
+    ('quote', 'archived_quote'),
+    ('quote_message', 'archived_quote_message'),
+    ('vote', 'archived_vote'),
+]
+
+
+def upgrade():
+    # SQLite can only make a table AUTOINCREMENT by rebuilding it
+    for table, _ in TABLES:
+        with op.batch_alter_table(
+                table, recreate='always',
+                table_kwargs={'sqlite_autoincrement': True}):
+            pass
+
+    # New IDs start after every ID handed out so far, including those that
+    # are only left in the archive
+    for table, archive in TABLES:
+        op.execute(f"DELETE FROM sqlite_sequence WHERE name = '{table}'")
+        op.execute(
+            f"INSERT INTO sqlite_sequence (name, seq) SELECT '{table}', "
+            f"max(coalesce((SELECT max(id) FROM {table}), 0), "
+            f"coalesce((SELECT max(id) FROM {archive}), 0))")
+
+
+def downgrade():
+    for table, _ in TABLES:
+        with op.batch_alter_table(
+                table, recreate='always',
+                table_kwargs={'sqlite_autoincrement': False}):
+            pass
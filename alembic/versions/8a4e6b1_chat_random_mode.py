@@ -0,0 +1,24 @@
+"""Add per-chat random quote modes.
+
+Revision ID: 8a4e6b1d03c7
+Revises: 5d1f0c2a9e34
+Create Date: 2026-10-19 11:40:02.561930
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '8a4e6b1d03c7'
+down_revision = '5d1f0c2a9e34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('chat', sa.Column(
+        'random_mode', sa.Enum('uniform', 'weighted'), nullable=True))
+
+
+def downgrade():
+    op.drop_column('chat', 'random_mode')
@@ -0,0 +1,37 @@
+"""Record when quotes are added, and roll up by it.
+
+Revision ID: a4d8f31c9e62
+Revises: 7e2c9d4a6b15
+Create Date: 2026-10-20 11:02:48.551093
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'a4d8f31c9e62'
+down_revision = '7e2c9d4a6b15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('quote', sa.Column('added_at', sa.DateTime(), nullable=True))
+    op.add_column(
+        'archived_quote', sa.Column('added_at', sa.DateTime(), nullable=True))
+
+    # Rollups were by the day quotes were sent; the backfill rolls them up
+    # again by the day quotes were added and votes cast
+    state = sa.table('state', sa.column('key', sa.String),
+        sa.column('value', sa.Text))
+    op.execute(state.update()
+        .where(state.c.key == 'daily_stats_backfill')
+        .values(value='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('archived_quote') as batch_op:
+        batch_op.drop_column('added_at')
+
+    with op.batch_alter_table('quote') as batch_op:
+        batch_op.drop_column('added_at')
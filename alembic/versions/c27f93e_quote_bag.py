@@ -0,0 +1,29 @@
+"""Add shuffle bags for non-repeating random quotes.
+
+Revision ID: c27f93e5b810
+Revises: 8a4e6b1d03c7
+Create Date: 2026-10-19 13:05:47.902316
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'c27f93e5b810'
+down_revision = '8a4e6b1d03c7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('quote_bag',
+    sa.Column('chat_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('quote_ids', sa.LargeBinary(), nullable=False),
+    sa.Column('high_water', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['chat_id'], ['chat.id'], ),
+    sa.PrimaryKeyConstraint('chat_id')
+    )
+
+
+def downgrade():
+    op.drop_table('quote_bag')
@@ -0,0 +1,30 @@
+"""Save direct message conversations, so that they survive restarts.
+
+Revision ID: d15b7c9e2a48
+Revises: a4d8f31c9e62
+Create Date: 2026-10-20 14:21:05.318264
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'd15b7c9e2a48'
+down_revision = 'a4d8f31c9e62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('conversation',
+    sa.Column('user_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('state', sa.Integer(), nullable=True),
+    sa.Column('current_chat_id', sa.Integer(), nullable=True),
+    sa.Column('choices', sa.LargeBinary(), nullable=True),
+    sa.Column('search_results', sa.LargeBinary(), nullable=True),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('conversation')
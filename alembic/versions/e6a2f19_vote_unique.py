@@ -0,0 +1,54 @@
+"""Allow one vote per user and quote.
+
+Revision ID: e6a2f19d3c07
+Revises: d15b7c9e2a48
+Create Date: 2026-10-20 16:40:12.074519
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'e6a2f19d3c07'
+down_revision = 'd15b7c9e2a48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+
+    # Votes cast at the same time on two threads could both be added; the
+    # latest of each user's votes on a quote is kept
+    quote_ids = [quote_id for quote_id, in connection.execute(
+        'SELECT quote_id FROM vote GROUP BY user_id, quote_id '
+        'HAVING count(*) > 1')]
+
+    if quote_ids:
+        connection.execute(
+            'DELETE FROM vote WHERE id NOT IN '
+            '(SELECT max(id) FROM vote GROUP BY user_id, quote_id)')
+
+        quote = sa.table('quote', sa.column('id', sa.Integer),
+            sa.column('score', sa.Integer))
+        vote = sa.table('vote', sa.column('quote_id', sa.Integer),
+            sa.column('direction', sa.Integer))
+        score = (sa.select([sa.func.coalesce(sa.func.sum(vote.c.direction), 0)])
+            .where(vote.c.quote_id == quote.c.id).as_scalar())
+        op.execute(quote.update()
+            .where(quote.c.id.in_(quote_ids))
+            .values(score=score))
+
+        # The duplicates were rolled up too
+        state = sa.table('state', sa.column('key', sa.String),
+            sa.column('value', sa.Text))
+        op.execute(state.update()
+            .where(state.c.key == 'daily_stats_backfill')
+            .values(value='0'))
+
+    op.create_index('ix_vote_user_id_quote_id', 'vote', ['user_id', 'quote_id'],
+        unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_vote_user_id_quote_id', table_name='vote')
@@ -0,0 +1,43 @@
+"""Add daily rollups for windowed leaderboards.
+
+Revision ID: e90b4d7f6a21
+Revises: c27f93e5b810
+Create Date: 2026-10-19 15:22:18.340657
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'e90b4d7f6a21'
+down_revision = 'c27f93e5b810'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('daily_stats',
+    sa.Column('chat_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('user_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('quotes_sent', sa.Integer(), nullable=False),
+    sa.Column('quotes_added', sa.Integer(), nullable=False),
+    sa.Column('upvotes', sa.Integer(), nullable=False),
+    sa.Column('downvotes', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['chat_id'], ['chat.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('chat_id', 'user_id', 'day')
+    )
+    op.create_index(
+        'ix_daily_stats_chat_id_day', 'daily_stats', ['chat_id', 'day'])
+    op.create_table('state',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('value', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade():
+    op.drop_table('state')
+    op.drop_index('ix_daily_stats_chat_id_day', table_name='daily_stats')
+    op.drop_table('daily_stats')
@@ -0,0 +1,29 @@
+"""Add time-decayed hotness for trending quotes.
+
+Revision ID: f3a61c8d92b4
+Revises: e90b4d7f6a21
+Create Date: 2026-10-19 17:04:51.902213
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'f3a61c8d92b4'
+down_revision = 'e90b4d7f6a21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('quote', sa.Column('hotness', sa.Float(), nullable=True))
+    op.add_column('vote', sa.Column('voted_at', sa.DateTime(), nullable=True))
+    op.create_index(
+        'ix_quote_chat_id_hotness', 'quote', ['chat_id', 'hotness'])
+
+
+def downgrade():
+    op.drop_index('ix_quote_chat_id_hotness', table_name='quote')
+
+    op.drop_column('vote', 'voted_at')
+    op.drop_column('quote', 'hotness')
@@ -0,0 +1,90 @@
+"""Benchmarks vote latency while the database is being backed up: votes alone,
+during a paged online backup, and during a backup copied in one step.
+
+    python -m benchmarks.backup --quotes 500000
+"""
+
+import argparse
+import os
+import random
+import threading
+import time
+
+from benchmarks.common import create_database, populate_chat, report
+from soup.backup import backup, format_report
+
+CHAT_ID = 1
+
+
+def vote_while(db, voters, quotes, running, interval=0, seed=0):
+    """Adds votes in separate transactions, the given number of seconds
+    apart, for as long as running() is true. Returns the time each vote
+    took."""
+    rng = random.Random(seed)
+    timings = []
+
+    while running():
+        session = db.create_session()
+        start = time.perf_counter()
+
+        try:
+            db.add_vote(
+                session, rng.choice(voters), rng.randint(1, quotes),
+                rng.choice((-1, 1)))
+            session.commit()
+        finally:
+            session.close()
+
+        timings.append(time.perf_counter() - start)
+        time.sleep(interval)
+
+    return timings
+
+
+def during_backup(db, voters, args, pages):
+    directory = os.path.join(os.path.dirname(db.filename), 'backups')
+    result = {}
+
+    thread = threading.Thread(target=lambda: result.update(
+        report=backup(db.filename, directory, pages=pages, pause=args.pause)))
+    thread.start()
+
+    timings = vote_while(
+        db, voters, args.quotes, thread.is_alive, interval=args.interval)
+    thread.join()
+
+    return timings, result['report']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quotes', type=int, default=500000)
+    parser.add_argument('--pages', type=int, default=256)
+    parser.add_argument('--pause', type=float, default=0.05)
+    parser.add_argument('--seconds', type=float, default=5)
+    # Seconds between votes. With 0, votes are written back to back, and the
+    # paged backup keeps restarting until it falls back to one step.
+    parser.add_argument('--interval', type=float, default=0.1)
+    args = parser.parse_args()
+
+    db = create_database()
+    voters = populate_chat(db, CHAT_ID, args.quotes)
+
+    print(f'{args.quotes} quotes, '
+          f'{os.path.getsize(db.filename) / 2 ** 20:.0f} MiB')
+
+    deadline = time.perf_counter() + args.seconds
+    report('votes alone', vote_while(
+        db, voters, args.quotes, lambda: time.perf_counter() < deadline,
+        interval=args.interval))
+
+    for name, pages in ((f'{args.pages} pages per step', args.pages),
+            ('one step', -1)):
+        timings, backup_report = during_backup(db, voters, args, pages)
+        report(f'votes during backup, {name}', timings)
+        print(f'    max {max(timings) * 1000:.1f} ms; '
+              + format_report(backup_report))
+
+
+if __name__ == '__main__':
+    main()
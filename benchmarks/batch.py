@@ -0,0 +1,120 @@
+"""Benchmarks replaying a backlog of updates, such as the one waiting after a
+restart: committing after every handler against one transaction per batch.
+
+    python -m benchmarks.batch --updates 2000
+"""
+
+import argparse
+import datetime
+import queue
+import random
+import time
+
+from sqlalchemy import event
+from telegram import Bot, CallbackQuery, Chat, Message, Update, User
+from telegram.ext import CallbackQueryHandler, Dispatcher, Filters, MessageHandler
+
+from benchmarks.common import create_database, populate_chat
+from soup.batch import UpdateBatch
+
+CHAT_ID = -1
+
+
+def create_dispatcher(db, batched):
+    """Returns a dispatcher whose handlers write like the bot's: every
+    message records its sender, and votes are added."""
+    def handle_message(bot, update):
+        message = update.message
+
+        with db.session_scope() as session:
+            db.add_or_update_user(session, message.from_user)
+            db.add_or_update_chat(session, message.chat)
+            db.add_membership(session, message.from_user.id, message.chat.id)
+
+    def handle_vote(bot, update):
+        query = update.callback_query
+
+        with db.session_scope() as session:
+            db.add_or_update_user(session, query.from_user)
+            db.add_vote(session, query.from_user.id, int(query.data), 1)
+
+    bot = Bot('123:token')
+    bot.bot = User(123, 'soup', True, username='soup_bot')
+
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=0)
+    dispatcher.add_handler(
+        MessageHandler(Filters.text | Filters.command, handle_message), group=0)
+    dispatcher.add_handler(CallbackQueryHandler(handle_vote), group=1)
+
+    if batched:
+        batch = UpdateBatch(db)
+        dispatcher.add_handler(batch.start, group=-1)
+        dispatcher.add_handler(batch.end, group=2)
+
+    return dispatcher
+
+
+def create_backlog(bot, count, user_ids, quotes, seed=0):
+    rng = random.Random(seed)
+    chat = Chat(CHAT_ID, Chat.SUPERGROUP, title='Chat')
+    date = datetime.datetime.now()
+
+    for i in range(count):
+        user_id = rng.choice(user_ids)
+        user = User(user_id, f'User {user_id}', False, username=f'user_{user_id}')
+
+        if rng.random() < 0.3:
+            yield Update(i, callback_query=CallbackQuery(
+                str(i), user, 'instance', data=str(rng.randint(1, quotes)),
+                bot=bot))
+        else:
+            yield Update(i, message=Message(
+                i, user, date, chat, text=f'message {i}', bot=bot))
+
+
+def replay(db, batched, updates):
+    commits = []
+
+    def count(session):
+        if not session.transaction.nested:
+            commits.append(session)
+
+    event.listen(db.session_factory, 'after_commit', count)
+    dispatcher = create_dispatcher(db, batched)
+
+    for update in updates:
+        dispatcher.update_queue.put(update)
+
+    start = time.perf_counter()
+
+    while not dispatcher.update_queue.empty():
+        dispatcher.process_update(dispatcher.update_queue.get())
+
+    elapsed = time.perf_counter() - start
+    event.remove(db.session_factory, 'after_commit', count)
+
+    return elapsed, len(commits)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--quotes', type=int, default=10000)
+    args = parser.parse_args()
+
+    for batched in (False, True):
+        db = create_database()
+        user_ids = populate_chat(db, -CHAT_ID, args.quotes)
+
+        bot = create_dispatcher(db, batched).bot
+        updates = list(create_backlog(bot, args.updates, user_ids, args.quotes))
+
+        elapsed, commits = replay(db, batched, updates)
+        name = 'one transaction per batch' if batched else 'commit per handler'
+
+        print(f'{name:<30} {args.updates / elapsed:8.0f} updates/s    '
+              f'{commits} commits')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Helpers shared by the benchmark scripts."""
+
+import contextlib
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import event
+
+from soup.classes import Chat, Quote, User
+from soup.database import QuoteDatabase
+from soup.hotness import add_event
+
+
+def create_database(name='bench.db'):
+    """Creates an empty database in a temporary directory."""
+    directory = tempfile.mkdtemp(prefix='soup-bench-')
+    return QuoteDatabase(filename=os.path.join(directory, name))
+
+
+def populate_chat(db, chat_id, quotes, users=50, days=3650, seed=0):
+    """Bulk inserts a chat with the given number of quotes, sent by a pool of
+    users over the given number of days up to now."""
+    rng = random.Random(seed + chat_id)
+    now = datetime.datetime.now()
+
+    user_ids = [chat_id * 1000 + i for i in range(users)]
+
+    with db.engine.begin() as connection:
+        connection.execute(Chat.__table__.insert(), [
+            dict(id=chat_id, type='supergroup', title=f'Chat {chat_id}')])
+        connection.execute(User.__table__.insert().prefix_with('OR IGNORE'), [
+            dict(id=user_id, first_name=f'User {user_id}',
+                username=f'user_{user_id}')
+            for user_id in user_ids])
+
+        rows = []
+        for i in range(quotes):
+            sent_by, quoted_by = rng.sample(user_ids, 2)
+            sent_at = now - datetime.timedelta(seconds=rng.randrange(days * 86400))
+            deleted = rng.random() < 0.02
+
+            rows.append(dict(
+                chat_id=chat_id, message_id=i, is_forward=False,
+                sent_at=sent_at, sent_by_id=sent_by, quoted_by_id=quoted_by,
+                content=f'quote {i}', content_html=f'quote {i}',
+                file_id='', message_type='text', deleted=deleted,
+                score=rng.randint(-4, 20),
+                hotness=None if deleted else add_event(None, sent_at, 1)))
+
+            if len(rows) == 10000:
+                connection.execute(Quote.__table__.insert(), rows)
+                rows = []
+
+        if rows:
+            connection.execute(Quote.__table__.insert(), rows)
+
+        connection.execute('ANALYZE')
+
+    return user_ids
+
+
+@contextlib.contextmanager
+def record_statements(engine):
+    """Records the (statement, parameters) pairs executed on the engine."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def query_plan(engine, statement, parameters):
+    """Returns the SQLite query plan for a recorded statement."""
+    with engine.connect() as connection:
+        rows = connection.execute(
+            'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+
+    return [row[-1] for row in rows]
+
+
+def measure(fn, repeat=50):
+    """Calls the function repeatedly and returns the timings in seconds."""
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * p / 100))]
+
+
+def report(name, timings):
+    median = statistics.median(timings) * 1000
+    p95 = percentile(timings, 95) * 1000
+    print(f'{name:<40} median {median:8.3f} ms    p95 {p95:8.3f} ms')
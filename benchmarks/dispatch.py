@@ -0,0 +1,102 @@
+"""Benchmarks the cost of dispatching an update, with no work done by the
+handlers: one dispatcher group per handler against the router.
+
+    python -m benchmarks.dispatch
+"""
+
+import argparse
+import datetime
+
+from telegram import Bot, CallbackQuery, Chat, Message, Update, User
+from telegram.ext import (
+    CallbackQueryHandler, CommandHandler, ConversationHandler, Dispatcher,
+    Filters, MessageHandler)
+
+from benchmarks.common import measure, report
+from soup.router import Router
+
+# The bot's commands, in the order its handlers are registered
+GROUP_COMMANDS = [
+    'addquote', 'addqoute', 'madquote', 'sadquote', 'about', 'help', 'random',
+    'random_mode', 'search', 'stats', 'most_quoted', 'most_added', 'scores',
+    'hi_scores', 'lo_scores', 'trending', 'activity']
+DM_COMMANDS = [
+    'random', 'search', 'stats', 'most_quoted', 'most_added', 'scores',
+    'hi_scores', 'lo_scores', 'trending', 'activity']
+
+
+def nothing(bot, update, **kwargs):
+    pass
+
+
+def create_handlers():
+    """Returns a side handler and the routed handlers, shaped like the
+    bot's."""
+    side = MessageHandler(Filters.text | Filters.command, nothing)
+
+    handlers = [CommandHandler(command, nothing, filters=Filters.group)
+        for command in GROUP_COMMANDS]
+    handlers += [
+        CommandHandler('searchall', nothing, filters=Filters.private),
+        MessageHandler(Filters.status_update.left_chat_member, nothing),
+        MessageHandler(Filters.status_update.migrate, nothing),
+        CallbackQueryHandler(nothing),
+    ]
+
+    conversation = ConversationHandler(
+        entry_points=[CommandHandler(['start', 'chats'], nothing, filters=Filters.private)],
+        states={1: [CommandHandler(command, nothing, filters=Filters.private)
+            for command in DM_COMMANDS]},
+        fallbacks=[CommandHandler('cancel', nothing, filters=Filters.private)])
+    handlers.append(conversation)
+
+    return side, handlers, conversation
+
+
+def create_updates(bot):
+    group = Chat(-100, Chat.SUPERGROUP, title='group')
+    private = Chat(5, Chat.PRIVATE)
+    user = User(5, 'user', False)
+    date = datetime.datetime(2019, 1, 1)
+
+    def message(chat, text):
+        return Update(1, message=Message(1, user, date, chat, text=text, bot=bot))
+
+    return {
+        'group message': message(group, 'just chatting'),
+        'group /addquote': message(group, '/addquote'),
+        'group /activity': message(group, '/activity'),
+        'private /trending': message(private, '/trending'),
+        'vote': Update(1, callback_query=CallbackQuery(
+            '1', user, 'instance', data='1:1:1', bot=bot)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=20000)
+    args = parser.parse_args()
+
+    bot = Bot('123:token')
+    bot.bot = User(123, 'soup', True, username='soup_bot')
+
+    grouped = Dispatcher(bot, None, workers=0)
+    side, handlers, _ = create_handlers()
+    for i, handler in enumerate([side] + handlers):
+        grouped.add_handler(handler, group=i)
+
+    routed = Dispatcher(bot, None, workers=0)
+    side, handlers, conversation = create_handlers()
+    routed.add_handler(side, group=0)
+    routed.add_handler(Router(handlers, private=[conversation]), group=1)
+
+    print(f'{len(handlers) + 1} handlers')
+
+    for name, update in create_updates(bot).items():
+        for kind, dispatcher in (('groups', grouped), ('router', routed)):
+            report(f'{name}, {kind}', measure(
+                lambda: dispatcher.process_update(update), repeat=args.repeat))
+
+
+if __name__ == '__main__':
+    main()
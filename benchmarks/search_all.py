@@ -0,0 +1,72 @@
+"""Benchmarks /searchall for a user in many chats against /search in one of
+those chats, and against searching each chat in turn.
+
+    python -m benchmarks.search_all --chats 20 --quotes 5000 [--fulltext]
+"""
+
+import argparse
+
+from benchmarks.common import (
+    create_database, measure, populate_chat, query_plan, record_statements,
+    report)
+from soup.classes import membership_table
+from soup.search import Term
+
+USER_ID = 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--quotes', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--fulltext', action='store_true')
+    args = parser.parse_args()
+
+    db = create_database()
+    chat_ids = list(range(1, args.chats + 1))
+
+    for chat_id in chat_ids:
+        populate_chat(db, chat_id, args.quotes)
+
+    # Chats the user isn't in
+    for chat_id in range(args.chats + 1, args.chats * 2 + 1):
+        populate_chat(db, chat_id, args.quotes)
+
+    with db.engine.begin() as connection:
+        connection.execute(membership_table.insert(), [
+            dict(user_id=USER_ID, chat_id=chat_id) for chat_id in chat_ids])
+
+    if args.fulltext:
+        db.create_fulltext_index()
+        db.fulltext = db.has_fulltext_index()
+
+    session = db.create_session()
+    expression = Term("quote 12")
+
+    mode = 'full-text' if db.fulltext else 'substring'
+    print(f'user in {args.chats} chats of {args.quotes} quotes each, {mode}')
+
+    report('search_quote, one chat', measure(
+        lambda: db.search_quote(session, chat_ids[0], expression),
+        repeat=args.repeat))
+
+    report('search_quote, each chat in turn', measure(
+        lambda: [db.search_quote(session, chat_id, expression)
+            for chat_id in chat_ids],
+        repeat=args.repeat))
+
+    report('search_member_quote', measure(
+        lambda: db.search_member_quote(session, USER_ID, expression),
+        repeat=args.repeat))
+
+    with record_statements(db.engine) as statements:
+        db.search_member_quote(session, USER_ID, expression)
+
+    print('    ' + '; '.join(query_plan(db.engine, *statements[0])))
+
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Benchmarks date range searches over a large chat, and checks that every
+range is answered from the (chat_id, sent_at) index rather than a scan of the
+chat's quotes.
+
+Run from the bot's working directory, since importing the handlers reads the
+bot's config:
+
+    python -m benchmarks.search_ranges --quotes 500000
+"""
+
+import argparse
+import datetime
+
+from benchmarks.common import (
+    create_database, measure, populate_chat, query_plan, record_statements,
+    report)
+from soup.handlers.search_tags import create_tag
+from soup.search import parse_search
+
+CHAT_ID = 1
+OTHER_CHAT_ID = 2
+
+INDEX = 'ix_quote_chat_id_sent_at'
+
+
+def searches():
+    this_year = datetime.date.today().year
+
+    yield f'date:{this_year - 1}-03-14'
+    yield f'month:{this_year - 1}-03'
+    yield f'year:{this_year - 1}'
+    yield f'date:>={this_year}-01-01'
+    yield 'since:30d'
+    yield 'since:7d score:>5'
+    yield f'year:{this_year - 2} OR year:{this_year - 1}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quotes', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    db = create_database()
+    populate_chat(db, CHAT_ID, args.quotes)
+    populate_chat(db, OTHER_CHAT_ID, args.quotes // 10)
+
+    session = db.create_session()
+    failures = 0
+
+    print(f'{args.quotes} quotes in chat {CHAT_ID}')
+
+    for search in searches():
+        expression = parse_search(search, create_tag)
+
+        with record_statements(db.engine) as statements:
+            db.search_quote(session, CHAT_ID, expression)
+
+        plan = query_plan(db.engine, *statements[0])
+        index_bound = any(INDEX in step for step in plan)
+        failures += not index_bound
+
+        timings = measure(
+            lambda: db.search_quote(session, CHAT_ID, expression),
+            repeat=args.repeat)
+
+        report(search, timings)
+        print('    ' + '; '.join(plan))
+
+    session.close()
+
+    if failures:
+        raise SystemExit(f'{failures} searches did not use {INDEX}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Benchmarks /stats on a large chat: the single-statement get_chat_stats
+against the previous path of get_quote_count and two rank_users queries.
+
+    python -m benchmarks.stats --quotes 500000
+"""
+
+import argparse
+
+from benchmarks.common import create_database, measure, populate_chat, report
+
+CHAT_ID = 1
+OTHER_CHAT_ID = 2
+
+
+def three_queries(db, session, chat_id, limit):
+    total = db.get_quote_count(session, chat_id)
+    most_quoted = list(db.get_most_quoted(session, chat_id, limit=limit))
+    most_added = list(db.get_most_quotes_added(session, chat_id, limit=limit))
+
+    return total, most_quoted, most_added
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quotes', type=int, default=500000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    db = create_database()
+    populate_chat(db, CHAT_ID, args.quotes, users=args.users)
+    populate_chat(db, OTHER_CHAT_ID, args.quotes // 10, users=args.users)
+
+    session = db.create_session()
+
+    single = db.get_chat_stats(session, CHAT_ID, limit=args.limit)
+    separate = three_queries(db, session, CHAT_ID, args.limit)
+    assert single[0] == separate[0]
+
+    print(f'{args.quotes} quotes from {args.users} users in chat {CHAT_ID}')
+
+    report('get_quote_count + 2x rank_users', measure(
+        lambda: three_queries(db, session, CHAT_ID, args.limit),
+        repeat=args.repeat))
+
+    report('get_chat_stats', measure(
+        lambda: db.get_chat_stats(session, CHAT_ID, limit=args.limit),
+        repeat=args.repeat))
+
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Benchmarks /trending as the vote table grows, and checks that it stays a
+bounded read of the (chat_id, hotness) index: no sort, and no votes read.
+
+    python -m benchmarks.trending --quotes 200000 --votes 1000000
+"""
+
+import argparse
+import random
+
+from benchmarks.common import (
+    create_database, measure, populate_chat, query_plan, record_statements,
+    report)
+from soup.classes import Vote
+
+CHAT_ID = 1
+OTHER_CHAT_ID = 2
+
+INDEX = 'ix_quote_chat_id_hotness'
+
+
+def add_votes(db, count, quotes, voters, seed=0):
+    """Bulk inserts votes by random voters on random quotes."""
+    rng = random.Random(seed)
+
+    with db.engine.begin() as connection:
+        rows = []
+
+        for _ in range(count):
+            rows.append(dict(
+                user_id=rng.choice(voters), quote_id=rng.randint(1, quotes),
+                direction=rng.choice((-1, 1))))
+
+            if len(rows) == 10000:
+                connection.execute(Vote.__table__.insert(), rows)
+                rows = []
+
+        if rows:
+            connection.execute(Vote.__table__.insert(), rows)
+
+        connection.execute('ANALYZE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quotes', type=int, default=200000)
+    parser.add_argument('--votes', type=int, default=1000000)
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    db = create_database()
+    voters = populate_chat(db, CHAT_ID, args.quotes)
+    populate_chat(db, OTHER_CHAT_ID, args.quotes // 10)
+
+    session = db.create_session()
+    failures = 0
+
+    print(f'{args.quotes} quotes in chat {CHAT_ID}')
+
+    for step in range(args.steps + 1):
+        votes = args.votes * step // args.steps
+
+        if step:
+            add_votes(db, args.votes // args.steps, args.quotes, voters, seed=step)
+
+        with record_statements(db.engine) as statements:
+            db.get_trending_quotes(session, CHAT_ID, limit=args.limit)
+
+        plan = query_plan(db.engine, *statements[0])
+        bounded = (any(INDEX in line for line in plan)
+            and not any('TEMP B-TREE' in line or 'vote' in line.lower()
+                for line in plan))
+        failures += not bounded
+
+        report(f'{votes} votes', measure(
+            lambda: db.get_trending_quotes(session, CHAT_ID, limit=args.limit),
+            repeat=args.repeat))
+        print('    ' + '; '.join(plan))
+
+    session.close()
+
+    if failures:
+        raise SystemExit(f'{failures} reads were not bounded by {INDEX}')
+
+
+if __name__ == '__main__':
+    main()
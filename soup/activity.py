@@ -0,0 +1,220 @@
+import calendar
+import threading
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def to_seconds(sent_at):
+    """Returns a quote's send time as seconds since 1970-01-01 on the same
+    wall clock, which is how SQLite's strftime('%s') reads stored times."""
+    return calendar.timegm(sent_at.timetuple())
+
+
+class ActivitySnapshot:
+    """A columnar copy of a chat's quotes for activity statistics: send times,
+    senders and scores in NumPy arrays. The arrays keep spare capacity, so
+    quotes are appended in amortized O(1) and statistics are computed over
+    whole columns at once.
+
+    The version is bumped on every change, so that anything derived from the
+    snapshot can tell when it is stale."""
+
+    COLUMNS = ('quote_id', 'sent_at', 'sender_id', 'score')
+
+    def __init__(self, rows=()):
+        """Creates a snapshot from (quote ID, seconds, sender ID, score) rows.
+        Unknown senders are stored as 0."""
+        data = numpy.array(rows, dtype=numpy.int64).reshape(-1, len(self.COLUMNS))
+
+        self.size = len(data)
+        self.version = 0
+        self.lock = threading.Lock()
+
+        capacity = max(self.size * 2, 64)
+        self.columns = {}
+
+        for i, name in enumerate(self.COLUMNS):
+            column = numpy.zeros(capacity, dtype=numpy.int64)
+            column[:self.size] = data[:, i]
+            self.columns[name] = column
+
+        self.live = numpy.zeros(capacity, dtype=bool)
+        self.live[:self.size] = True
+
+        self.rows = {
+            quote_id: row for row, quote_id in enumerate(data[:, 0].tolist())}
+
+        # Values derived from the snapshot, by key: (version, value)
+        self.derived = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def dumps(self):
+        """Returns the live quotes' rows as a compact byte string."""
+        with self.lock:
+            live = self.live[:self.size]
+            data = numpy.stack([self.columns[name][:self.size][live]
+                for name in self.COLUMNS], axis=1)
+
+        return zlib.compress(data.tobytes())
+
+    @classmethod
+    def loads(cls, data):
+        """Returns a snapshot saved by dumps."""
+        return cls(numpy.frombuffer(zlib.decompress(data), dtype=numpy.int64))
+
+    def __contains__(self, quote_id):
+        return quote_id in self.rows
+
+    def derive(self, key, function):
+        """Returns function(), computing it again only if the snapshot has
+        changed since it was last computed for key. The values are kept as
+        long as the snapshot is."""
+        version = self.version
+        cached = self.derived.get(key)
+
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        value = function()
+        self.derived[key] = (version, value)
+        return value
+
+    def append(self, quote_id, sent_at, sender_id, score):
+        with self.lock:
+            if quote_id in self.rows:
+                return
+
+            if self.size == len(self.live):
+                self._grow()
+
+            row = self.size
+            values = (quote_id, to_seconds(sent_at), sender_id or 0, score or 0)
+
+            for name, value in zip(self.COLUMNS, values):
+                self.columns[name][row] = value
+
+            self.live[row] = True
+            self.rows[quote_id] = row
+            self.size += 1
+            self.version += 1
+
+    def set_score(self, quote_id, score):
+        with self.lock:
+            row = self.rows.get(quote_id)
+
+            if row is not None:
+                self.columns['score'][row] = score
+                self.version += 1
+
+    def remove(self, quote_id):
+        with self.lock:
+            row = self.rows.pop(quote_id, None)
+
+            if row is not None:
+                self.live[row] = False
+                self.version += 1
+
+    def _grow(self):
+        capacity = len(self.live) * 2
+
+        for name, column in self.columns.items():
+            self.columns[name] = numpy.resize(column, capacity)
+
+        self.live = numpy.resize(self.live, capacity)
+        self.live[self.size:] = False
+
+    def _select(self, sender_id=None):
+        """Returns the send times and scores of live quotes, optionally only
+        those sent by one user."""
+        with self.lock:
+            mask = self.live[:self.size].copy()
+
+            if sender_id is not None:
+                mask &= self.columns['sender_id'][:self.size] == sender_id
+
+            return (self.columns['sent_at'][:self.size][mask],
+                self.columns['score'][:self.size][mask])
+
+    def heatmap(self, sender_id=None):
+        """Returns a 7 x 24 array of quote counts by weekday (Monday first)
+        and hour of day."""
+        sent_at, _ = self._select(sender_id)
+
+        hours = sent_at // 3600 % 24
+        # 1970-01-01 was a Thursday
+        weekdays = (sent_at // 86400 + 3) % 7
+
+        cells = numpy.bincount(weekdays * 24 + hours, minlength=7 * 24)
+        return cells.reshape(7, 24)
+
+    def monthly(self, sender_id=None):
+        """Returns the first month with quotes as a numpy.datetime64, and for
+        every month from then on the number of quotes, the running total and
+        the mean score. Returns None if there are no quotes."""
+        sent_at, scores = self._select(sender_id)
+
+        if not len(sent_at):
+            return None
+
+        months = (sent_at // 86400).astype('datetime64[D]').astype('datetime64[M]')
+        offsets = (months - months.min()).astype(numpy.int64)
+
+        counts = numpy.bincount(offsets)
+        score_sums = numpy.bincount(offsets, weights=scores)
+        means = numpy.divide(
+            score_sums, counts, out=numpy.zeros(len(counts)), where=counts > 0)
+
+        return months.min(), counts, numpy.cumsum(counts), means
+
+
+# Rendering
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+SHADES = ' ░▒▓█'
+BARS = '▁▂▃▄▅▆▇█'
+
+
+def scale(values, levels):
+    """Maps non-negative values onto 0..levels - 1, with any non-zero value
+    mapped to at least 1."""
+    peak = values.max() if values.size else 0
+
+    if not peak:
+        return numpy.zeros(values.shape, dtype=numpy.int64)
+
+    return numpy.ceil(values * (levels - 1) / peak).astype(numpy.int64)
+
+
+def render_heatmap(cells):
+    """Renders a weekday x hour array of counts as lines of shaded blocks."""
+    shades = scale(cells, len(SHADES))
+    lines = ['    0     6     12    18']
+
+    for weekday, row in zip(WEEKDAYS, shades):
+        lines.append(weekday + ' ' + ''.join(SHADES[level] for level in row))
+
+    weekday, hour = numpy.unravel_index(cells.argmax(), cells.shape)
+    peak = f"busiest: {WEEKDAYS[weekday]} {hour:02}:00"
+
+    return '\n'.join(lines), peak
+
+
+def render_trend(first_month, counts, totals, means, months=12):
+    """Renders the last few months of a monthly trend, one line per month."""
+    start = max(len(counts) - months, 0)
+    bars = scale(counts[start:], len(BARS) + 1)
+    lines = []
+
+    for i, bar in enumerate(bars, start):
+        month = first_month + i
+        lines.append(
+            f"{month} {BARS[bar - 1] if bar else ' '} {counts[i]:>4} "
+            f"({totals[i]} total, avg score {means[i]:+.1f})")
+
+    return '\n'.join(lines)
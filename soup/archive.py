@@ -0,0 +1,69 @@
+import array
+import bisect
+import hashlib
+import threading
+
+
+def quote_key(sent_at, sent_by_id, content_html):
+    """Returns a signed 64-bit hash of the fields that identify a quote, as
+    checked when a quote is added."""
+    fields = '\0'.join([
+        sent_at.replace(tzinfo=None).isoformat(' '),
+        str(sent_by_id),
+        content_html or ''])
+
+    digest = hashlib.blake2b(fields.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+class KeySet:
+    """A set of 64-bit integers stored in a sorted array, at 8 bytes each.
+    New keys go into a small set, which is merged into the array once it
+    grows past merge_size."""
+
+    def __init__(self, keys=(), merge_size=1024):
+        self.keys = array.array('q', sorted(keys))
+        self.recent = set()
+        self.merge_size = merge_size
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys) + len(self.recent)
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.recent:
+                return True
+
+            i = bisect.bisect_left(self.keys, key)
+            return i < len(self.keys) and self.keys[i] == key
+
+    def add(self, key):
+        with self.lock:
+            i = bisect.bisect_left(self.keys, key)
+
+            if i < len(self.keys) and self.keys[i] == key:
+                return
+
+            self.recent.add(key)
+
+            if len(self.recent) > self.merge_size:
+                self.keys = array.array(
+                    'q', sorted(set(self.keys) | self.recent))
+                self.recent = set()
+
+    def dumps(self):
+        """Returns the keys as a byte string, sorted, at 8 bytes each. Keys
+        are hashes, which don't compress."""
+        with self.lock:
+            keys = array.array('q', sorted(set(self.keys) | self.recent))
+
+        return keys.tobytes()
+
+    @classmethod
+    def loads(cls, data, merge_size=1024):
+        """Returns a set saved by dumps."""
+        keys = cls(merge_size=merge_size)
+        keys.keys.frombytes(data)
+
+        return keys
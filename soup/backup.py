@@ -0,0 +1,198 @@
+"""Online backups of the bot's database, taken with SQLite's backup API while
+the bot keeps running."""
+
+import collections
+import datetime
+import glob
+import gzip
+import os
+import shutil
+import sqlite3
+import time
+
+BackupReport = collections.namedtuple('BackupReport', [
+    # The compressed snapshot
+    'path',
+    # Seconds from start to finish, including pauses
+    'duration',
+    'pages', 'steps',
+    # Times the backup started over because the database changed
+    'restarts',
+    # Seconds the database was locked: in total, and in the longest step.
+    # Writes wait for at most the longest step.
+    'locked', 'longest_step',
+    'size', 'compressed_size',
+    # Snapshots deleted by rotation
+    'rotated',
+])
+
+TIME_FORMAT = '%Y%m%d-%H%M%S'
+
+# Connection.backup is new in Python 3.7
+BACKUP_API = hasattr(sqlite3.Connection, 'backup')
+
+
+def copy_database(source, target, pages=256, pause=0.05, max_restarts=3):
+    """Copies the source database into the target file a few pages at a time,
+    pausing between steps so that writes to the source can go through. The
+    source is only locked during a step.
+
+    Writes from other connections make SQLite start the copy over. After
+    max_restarts, the rest is copied in one step, which holds the lock for
+    longer but always finishes. Returns the number of pages, steps and
+    restarts, the total time locked, and the longest step.
+
+    Without the backup API, the files are copied in one step instead."""
+    stats = {'pages': 0, 'steps': 0, 'restarts': 0, 'locked': 0.0,
+        'longest_step': 0.0}
+    remaining_before = None
+    step_started = None
+
+    def progress(status, remaining, total):
+        nonlocal remaining_before, step_started
+
+        locked = time.perf_counter() - step_started
+        stats['locked'] += locked
+        stats['longest_step'] = max(stats['longest_step'], locked)
+        stats['steps'] += 1
+        stats['pages'] = total
+
+        if remaining_before is not None and remaining > remaining_before:
+            stats['restarts'] += 1
+
+            if stats['restarts'] >= max_restarts:
+                raise _Restart
+
+        remaining_before = remaining
+
+        # The lock is released between steps
+        if remaining:
+            time.sleep(pause)
+
+        step_started = time.perf_counter()
+
+    if not BACKUP_API:
+        return _copy_file(source, target)
+
+    source_connection = sqlite3.connect(source, timeout=30)
+    target_connection = sqlite3.connect(target)
+
+    try:
+        try:
+            step_started = time.perf_counter()
+            source_connection.backup(
+                target_connection, pages=pages, progress=progress, sleep=pause)
+        except _Restart:
+            step_started = time.perf_counter()
+            source_connection.backup(
+                target_connection, pages=-1, progress=progress)
+
+        return (stats['pages'], stats['steps'], stats['restarts'],
+            stats['locked'], stats['longest_step'])
+    finally:
+        target_connection.close()
+        source_connection.close()
+
+
+def _copy_file(source, target):
+    """Copies the database's files in one step, holding the write lock so
+    that no commit can change them meanwhile; reads go on. A database in WAL
+    mode has its log copied too, then folded into the target."""
+    # The transaction is begun and ended by hand
+    source_connection = sqlite3.connect(source, timeout=30,
+        isolation_level=None)
+
+    try:
+        started = time.perf_counter()
+        source_connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            pages, = source_connection.execute('PRAGMA page_count').fetchone()
+            shutil.copyfile(source, target)
+
+            if os.path.isfile(source + '-wal'):
+                shutil.copyfile(source + '-wal', target + '-wal')
+        finally:
+            source_connection.execute('ROLLBACK')
+
+        locked = time.perf_counter() - started
+    finally:
+        source_connection.close()
+
+    # Leaving WAL mode checkpoints the log into the target and deletes it
+    target_connection = sqlite3.connect(target)
+
+    try:
+        target_connection.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target_connection.close()
+
+    return pages, 1, 0, locked, locked
+
+
+class _Restart(Exception):
+    pass
+
+
+def compress(path):
+    """Compresses a file with gzip, replacing it. Returns the new path."""
+    compressed = path + '.gz'
+
+    with open(path, 'rb') as f, gzip.open(compressed + '.tmp', 'wb') as out:
+        shutil.copyfileobj(f, out)
+
+    os.replace(compressed + '.tmp', compressed)
+    os.remove(path)
+
+    return compressed
+
+
+def rotate(directory, name, keep, suffix='.db.gz'):
+    """Deletes all but the newest few files named after the time they were
+    taken, such as database snapshots. Returns the number deleted."""
+    snapshots = sorted(glob.glob(os.path.join(directory, f'{name}-*{suffix}')))
+    expired = snapshots[:-keep] if keep > 0 else snapshots
+
+    for path in expired:
+        os.remove(path)
+
+    return len(expired)
+
+
+def backup(filename, directory, keep=7, pages=256, pause=0.05):
+    """Takes a compressed snapshot of the database in the given directory,
+    then deletes all but the newest few. Returns a BackupReport."""
+    started = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+
+    name = os.path.splitext(os.path.basename(filename))[0]
+    stamp = datetime.datetime.now().strftime(TIME_FORMAT)
+    path = os.path.join(directory, f'{name}-{stamp}.db')
+
+    try:
+        pages, steps, restarts, locked, longest_step = copy_database(
+            filename, path, pages=pages, pause=pause)
+        size = os.path.getsize(path)
+        path = compress(path)
+    except:
+        if os.path.isfile(path):
+            os.remove(path)
+        raise
+
+    rotated = rotate(directory, name, keep)
+
+    return BackupReport(
+        path=path, duration=time.perf_counter() - started, pages=pages,
+        steps=steps, restarts=restarts, locked=locked,
+        longest_step=longest_step, size=size,
+        compressed_size=os.path.getsize(path), rotated=rotated)
+
+
+def format_report(report):
+    return (f"backed up {report.pages} pages to {report.path} in "
+            f"{report.duration:.1f} s ({report.steps} steps, "
+            f"{report.restarts} restarts); locked for {report.locked:.3f} s, "
+            f"at most {report.longest_step * 1000:.1f} ms at a time; "
+            f"{report.size / 1024:.0f} KiB, "
+            f"{report.compressed_size / 1024:.0f} KiB compressed; "
+            f"deleted {report.rotated} old snapshots")
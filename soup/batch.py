@@ -0,0 +1,61 @@
+"""Processes a backlog of updates in batches that share one transaction, with
+a savepoint for each handler, instead of committing after every handler."""
+
+import time
+
+from telegram import Update
+from telegram.ext import Handler
+
+from soup.outbox import Sent
+
+
+class _Hook(Handler):
+    """Calls a function with the dispatcher for every update, and for every
+    sent message's callback."""
+
+    def __init__(self, function):
+        super().__init__(None)
+        self.function = function
+
+    def check_update(self, update):
+        return isinstance(update, (Update, Sent))
+
+    def handle_update(self, update, dispatcher):
+        self.function(dispatcher)
+
+
+class UpdateBatch:
+    """Opens a batch on the dispatcher's thread before an update, and commits
+    it after an update once no more updates are waiting, or the batch is
+    full or old enough. Handlers that raise only roll back their own
+    savepoint.
+
+    start has to be added in a dispatcher group before all other handlers,
+    and end in a group after them."""
+
+    def __init__(self, database, max_updates=100, max_age=1.0):
+        self.database = database
+        self.max_updates = max_updates
+        self.max_age = max_age
+
+        self.updates = 0
+        self.started_at = None
+
+        self.start = _Hook(self.begin)
+        self.end = _Hook(self.finish)
+
+    def begin(self, dispatcher):
+        if self.database.current_batch() is None:
+            self.database.begin_batch()
+            self.updates = 0
+            self.started_at = time.monotonic()
+
+        self.updates += 1
+
+    def finish(self, dispatcher):
+        # Other threads wait for the write lock while the batch is open
+        full = (self.updates >= self.max_updates
+            or time.monotonic() - self.started_at >= self.max_age)
+
+        if full or dispatcher.update_queue.empty():
+            self.database.end_batch()
@@ -1,6 +1,6 @@
 from sqlalchemy import (
-    Boolean, Column, Enum, DateTime, ForeignKey, Integer, PrimaryKeyConstraint,
-    String, Text, UniqueConstraint)
+    Boolean, Column, Date, Enum, DateTime, Float, ForeignKey, Index, Integer,
+    LargeBinary, PrimaryKeyConstraint, String, Text, UniqueConstraint)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import Table
@@ -40,6 +40,9 @@ class Chat(Base):
     title = Column(String)
     username = Column(String, unique=True)
 
+    # How /random chooses quotes; NULL means uniform
+    random_mode = Column(Enum('uniform', 'weighted'), default='uniform')
+
     users = relationship(
         "User", secondary=membership_table, back_populates="chats")
     quotes = relationship("Quote", back_populates="chat")
@@ -59,6 +62,9 @@ class Quote(Base):
     is_forward = Column(Boolean, default=False)
     sent_at = Column(DateTime)
 
+    # When the quote was added; NULL for quotes added before this was kept
+    added_at = Column(DateTime, nullable=True)
+
     sent_by_id = Column(Integer, ForeignKey('user.id'), nullable=True)
     sent_by = relationship(
         "User", back_populates="quotes", cascade='save-update, merge',
@@ -79,9 +85,21 @@ class Quote(Base):
     deleted = Column(Boolean, default=False)
     score = Column(Integer, default=0)
 
+    # Time-decayed score for trending quotes, in log space (see soup.hotness)
+    hotness = Column(Float, nullable=True)
+
     constraint1 = UniqueConstraint('chat_id', 'message_id')
     constraint2 = UniqueConstraint('sent_at', 'sent_by_id', 'content_html')
 
+    __table_args__ = (
+        # Serves date range searches within a chat
+        Index('ix_quote_chat_id_sent_at', 'chat_id', 'sent_at'),
+        # Serves trending quotes within a chat
+        Index('ix_quote_chat_id_hotness', 'chat_id', 'hotness'),
+        # IDs are never reused, since archived quotes keep theirs
+        {'sqlite_autoincrement': True},
+    )
+
     messages = relationship("QuoteMessage", back_populates="quote")
     votes = relationship("Vote", back_populates="quote")
 
@@ -96,11 +114,19 @@ class QuoteMessage(Base):
         "Chat", back_populates="quote_messages", cascade='save-update, merge')
 
     message_id = Column(Integer)
+    sent_at = Column(DateTime, nullable=True)
 
     quote_id = Column(Integer, ForeignKey('quote.id'), nullable=True)
     quote = relationship(
         "Quote", back_populates="messages", cascade='save-update, merge')
 
+    __table_args__ = (
+        # Serves vote lookups and the fan-out when a quote is deleted
+        Index('ix_quote_message_chat_id_message_id', 'chat_id', 'message_id'),
+        Index('ix_quote_message_quote_id', 'quote_id'),
+        {'sqlite_autoincrement': True},
+    )
+
 
 class Vote(Base):
     __tablename__ = 'vote'
@@ -116,5 +142,123 @@ class Vote(Base):
         "Quote", back_populates="votes", cascade='save-update, merge')
 
     direction = Column(Integer, default=0, nullable=False)
+    voted_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # One vote per user and quote, which also serves vote lookups
+        Index('ix_vote_user_id_quote_id', 'user_id', 'quote_id', unique=True),
+        {'sqlite_autoincrement': True},
+    )
+
+
+class QuoteBag(Base):
+    __tablename__ = 'quote_bag'
+
+    chat_id = Column(
+        Integer, ForeignKey('chat.id'), primary_key=True, autoincrement=False)
+
+    # IDs of the quotes /random hasn't drawn yet, packed by
+    # soup.sampling.pack_ids
+    quote_ids = Column(LargeBinary, nullable=False)
+
+    # The highest quote ID the bag has seen
+    high_water = Column(Integer, nullable=False, default=0)
+
+
+class DailyStats(Base):
+    __tablename__ = 'daily_stats'
+
+    chat_id = Column(
+        Integer, ForeignKey('chat.id'), primary_key=True, autoincrement=False)
+    user_id = Column(
+        Integer, ForeignKey('user.id'), primary_key=True, autoincrement=False)
+
+    # The day the quotes were added, or the votes cast
+    day = Column(Date, primary_key=True)
+
+    quotes_sent = Column(Integer, nullable=False, default=0)
+    quotes_added = Column(Integer, nullable=False, default=0)
+    upvotes = Column(Integer, nullable=False, default=0)
+    downvotes = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # Serves windowed leaderboards within a chat
+        Index('ix_daily_stats_chat_id_day', 'chat_id', 'day'),
+    )
+
+
+class State(Base):
+    __tablename__ = 'state'
+
+    key = Column(String, primary_key=True)
+    value = Column(Text)
+
+
+class Conversation(Base):
+    __tablename__ = 'conversation'
+
+    # A user's direct message conversation, saved by soup.conversations
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    state = Column(Integer)
+    current_chat_id = Column(Integer)
+
+    # IDs of the chats offered by /chats, in order, and pairs of message and
+    # chat IDs of /searchall results, packed by soup.conversations.pack_ints
+    choices = Column(LargeBinary)
+    search_results = Column(LargeBinary)
+
+
+# Archive tables for deleted quotes, moved out of the tables above by
+# QuoteDatabase.archive_deleted_quotes. IDs are kept, but there are no foreign
+# keys, since the archive is only read when a quote is added again.
+
+class ArchivedQuote(Base):
+    __tablename__ = 'archived_quote'
 
-    constraint1 = UniqueConstraint('user_id', 'quote_id')
+    id = Column(Integer, primary_key=True, autoincrement=False)
+
+    chat_id = Column(Integer)
+    message_id = Column(Integer)
+    is_forward = Column(Boolean, default=False)
+    sent_at = Column(DateTime)
+    added_at = Column(DateTime, nullable=True)
+    sent_by_id = Column(Integer)
+
+    content = Column(Text)
+    content_html = Column(Text)
+    file_id = Column(Text)
+    message_type = Column(Enum('text', 'photo'), default='text')
+
+    quoted_by_id = Column(Integer)
+    score = Column(Integer, default=0)
+
+    archived_at = Column(DateTime)
+
+    # Hash of sent_at, sent_by_id and content_html (see soup.archive)
+    key = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index('ix_archived_quote_key', 'key'),
+    )
+
+
+class ArchivedQuoteMessage(Base):
+    __tablename__ = 'archived_quote_message'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+
+    chat_id = Column(Integer)
+    message_id = Column(Integer)
+    sent_at = Column(DateTime, nullable=True)
+    quote_id = Column(Integer)
+
+
+class ArchivedVote(Base):
+    __tablename__ = 'archived_vote'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+
+    user_id = Column(Integer)
+    quote_id = Column(Integer)
+    direction = Column(Integer, default=0, nullable=False)
+    voted_at = Column(DateTime, nullable=True)
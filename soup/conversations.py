@@ -0,0 +1,297 @@
+"""Keeps the state of users' direct message conversations, which chat each
+user is browsing and what /chats and /searchall offered them, in the
+database, so that it survives restarts. A user's state is loaded the first
+time they're seen, saved in batches, and dropped from memory once they've
+been idle for a while."""
+
+import collections
+import logging
+import struct
+import threading
+import time
+
+from soup.outbox import Sent
+
+# A user with nothing to save
+EMPTY = (None, None, (), ())
+
+
+def pack_ints(values):
+    """Packs integers, which can be negative, into a byte string of 8 bytes
+    each, in order. Returns None if there are none."""
+    values = list(values)
+
+    if not values:
+        return None
+    return struct.pack(f'<{len(values)}q', *values)
+
+
+def unpack_ints(data):
+    """Returns the list of integers packed by pack_ints."""
+    if not data:
+        return []
+    return list(struct.unpack(f'<{len(data) // 8}q', data))
+
+
+class _UserData(collections.defaultdict):
+    """The dispatcher's user_data, which loads a user's saved state the
+    first time they're seen."""
+
+    def __init__(self, store):
+        super().__init__(dict)
+        self.store = store
+
+    def __getitem__(self, user_id):
+        self.store.touch(user_id)
+        return super().__getitem__(user_id)
+
+    def __missing__(self, user_id):
+        if user_id is not None:
+            self.store.load(user_id)
+
+            if dict.__contains__(self, user_id):
+                return dict.__getitem__(self, user_id)
+
+        return super().__missing__(user_id)
+
+
+class _Conversations(dict):
+    """A ConversationHandler's states, by (chat ID, user ID), which loads the
+    state of a user's private chat the first time it's looked up."""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def get(self, key, default=None):
+        user_id = self.store.private_user(key)
+
+        if user_id is not None:
+            self.store.touch(user_id)
+
+            if key not in self:
+                self.store.load(user_id)
+
+        return super().get(key, default)
+
+
+class ConversationStore:
+    """Saves a ConversationHandler's states in private chats, along with the
+    user_data it uses, to the database's conversation table.
+
+    Once started, the store takes the place of the handler's conversations
+    and the dispatcher's user_data. A user's saved state is loaded the first
+    time either is looked up, in one query. Every interval seconds, the
+    states that changed since they were last saved are written in one
+    transaction, and users that haven't been seen for idle seconds are
+    dropped from memory; their state is loaded again if they come back.
+    Changes made since the last save are lost if the bot crashes.
+
+    Only 'current', 'choices' and 'search_results' are kept of user_data,
+    as chat IDs: the titles of the choices are looked up when they're
+    loaded.
+
+    Updates from private chats, which are what change the saved state, are
+    handled under the store's lock, and the background save copies the
+    states under it too, so that it never reads them half changed. Other
+    updates don't wait on the store."""
+
+    def __init__(self, database, handler, interval=10, idle=3600):
+        self.database = database
+        self.handler = handler
+        self.interval = interval
+        self.idle = idle
+
+        self.user_data = _UserData(self)
+        self.conversations = _Conversations(self)
+
+        # Each loaded user's state as last loaded or saved, and when they
+        # were last seen
+        self.saved = {}
+        self.used = {}
+
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def start(self, dispatcher):
+        self.handler.conversations = self.conversations
+        dispatcher.user_data = self.user_data
+
+        process_update = dispatcher.process_update
+
+        def locked_process_update(update):
+            if not self.in_private_chat(update):
+                return process_update(update)
+
+            with self.lock:
+                return process_update(update)
+
+        dispatcher.process_update = locked_process_update
+
+        self.thread = threading.Thread(
+            target=self.run, name='conversations', daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        """Stops saving in the background, and saves what's left."""
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+        self.flush()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+                self.evict()
+            except Exception:
+                self.logger.exception("couldn't save conversations")
+
+    @staticmethod
+    def private_user(key):
+        """Returns the user whose private chat a conversation key is for, or
+        None if it's for another chat."""
+        if len(key) == 2 and key[0] == key[1]:
+            return key[1]
+        return None
+
+    @staticmethod
+    def in_private_chat(update):
+        """Returns whether an update, or the callback of a sent message, is
+        from a user's private chat."""
+        if isinstance(update, Sent):
+            chat = getattr(update.result, 'chat', None)
+        else:
+            chat = getattr(update, 'effective_chat', None)
+
+        return chat is not None and chat.type == 'private'
+
+    def touch(self, user_id):
+        if user_id is not None:
+            with self.lock:
+                self.used[user_id] = time.monotonic()
+
+    def load(self, user_id):
+        """Loads a user's saved state into memory, unless it's there
+        already."""
+        with self.lock:
+            if user_id in self.saved:
+                return
+
+            with self.database.session_scope() as session:
+                saved = self.database.get_conversation(session, user_id)
+
+                if saved is None:
+                    record = EMPTY
+                else:
+                    results = unpack_ints(saved.search_results)
+                    record = (saved.state, saved.current_chat_id,
+                        tuple(unpack_ints(saved.choices)),
+                        tuple(zip(results[::2], results[1::2])))
+
+                state, current, choices, results = record
+                data = {}
+
+                if current is not None:
+                    data['current'] = current
+
+                if choices:
+                    titles = self.database.get_chat_titles(session, choices)
+                    data['choices'] = [[i, chat_id, titles.get(chat_id, '')]
+                        for i, chat_id in enumerate(choices)]
+
+                if results:
+                    data['search_results'] = dict(results)
+
+            dict.__setitem__(self.user_data, user_id, data)
+
+            if state is not None:
+                dict.__setitem__(self.conversations, (user_id, user_id), state)
+
+            self.saved[user_id] = record
+            self.touch(user_id)
+
+    def record(self, user_id):
+        """Returns a loaded user's state as it is in memory."""
+        data = dict.get(self.user_data, user_id) or {}
+        state = dict.get(self.conversations, (user_id, user_id))
+
+        # States that are still being worked out are saved once they are
+        if state is not None and not isinstance(state, int):
+            state = self.saved[user_id][0]
+
+        choices = tuple(chat_id for _, chat_id, _ in data.get('choices', ()))
+        results = tuple(data.get('search_results', {}).items())
+
+        return state, data.get('current'), choices, results
+
+    @staticmethod
+    def columns(record):
+        """Returns a state as the conversation table's columns, or None if
+        there's nothing to save."""
+        if record == EMPTY:
+            return None
+
+        state, current, choices, results = record
+
+        return {
+            'state': state,
+            'current_chat_id': current,
+            'choices': pack_ints(choices),
+            'search_results': pack_ints(
+                value for pair in results for value in pair),
+        }
+
+    def flush(self):
+        """Saves the states that changed since they were last saved, in one
+        transaction. Returns the number of users saved."""
+        # Records are copies, so they're written without holding up updates
+        with self.lock:
+            changed = {}
+
+            for user_id, saved in self.saved.items():
+                record = self.record(user_id)
+
+                if record != saved:
+                    changed[user_id] = record
+
+        if not changed:
+            return 0
+
+        with self.database.session_scope() as session:
+            self.database.save_conversations(session, {
+                user_id: self.columns(record)
+                for user_id, record in changed.items()})
+
+        with self.lock:
+            self.saved.update(changed)
+
+        return len(changed)
+
+    def evict(self):
+        """Drops users that haven't been seen for idle seconds, and whose
+        state has been saved, from memory. Returns the number dropped."""
+        now = time.monotonic()
+        evicted = 0
+
+        with self.lock:
+            for user_id, used in list(self.used.items()):
+                if now - used < self.idle:
+                    continue
+
+                if self.record(user_id) != self.saved.get(user_id, EMPTY):
+                    continue
+
+                dict.pop(self.user_data, user_id, None)
+                dict.pop(self.conversations, (user_id, user_id), None)
+                self.saved.pop(user_id, None)
+                self.used.pop(user_id, None)
+                evicted += 1
+
+        return evicted
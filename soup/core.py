@@ -4,13 +4,27 @@ import functools
 import json
 import logging
 import os
+import queue
+import threading
 import traceback
 from html import escape
-from telegram.ext import ConversationHandler, Updater
+from telegram import Bot
+from telegram.ext import ConversationHandler, Dispatcher, Updater
+from telegram.utils.request import Request
 from telegram.error import (BadRequest, ChatMigrated, NetworkError,
     TelegramError, TimedOut, Unauthorized)
 
+from soup.batch import UpdateBatch
+from soup.conversations import ConversationStore
 from soup.database import QuoteDatabase
+from soup.maintenance import (
+    archive_deleted_quotes, backup_database, compact_quote_messages)
+from soup.outbox import Outbox, QueuedBot, Sent
+from soup.replay import UpdateRecorder
+from soup.runtime import AsyncRuntime
+from soup.shards import ShardedQuoteDatabase
+from soup.snapshot import load_snapshot, save_snapshot, start_run
+from soup.workers import Forwarder, Supervisor, shard
 
 
 DEBUG = os.path.isfile('debug')
@@ -43,23 +57,31 @@ with open(os.path.join('data', CONFIG_FILENAME)) as f:
 username = config['username']
 TOKEN = config['token']
 
-# Global database object
-FILENAME = 'test.db' if DEBUG else 'data.db'
-database = QuoteDatabase(filename=FILENAME)
+# Global database object, with a file for each chat's quotes if a shard
+# directory is set
+FILENAME = os.environ.get('SOUP_DATABASE') or ('test.db' if DEBUG else 'data.db')
+SHARD_DIRECTORY = os.environ.get('SOUP_SHARDS') or config.get('shard_directory')
+
+if SHARD_DIRECTORY:
+    database = ShardedQuoteDatabase(
+        filename=FILENAME, directory=SHARD_DIRECTORY,
+        fulltext=config.get('fulltext', False),
+        pool_size=config.get('shard_pool_size', 64))
+else:
+    database = QuoteDatabase(
+        filename=FILENAME, fulltext=config.get('fulltext', False))
+
+# Batches hold one transaction, which sharded databases can't
+BATCH_UPDATES = config.get('batch_updates') and not SHARD_DIRECTORY
+
+# Where the processes handling updates save their caches when they stop
+SNAPSHOT_DIRECTORY = config.get('snapshot_directory')
 
 
 @contextlib.contextmanager
 def session_scope():
-    session = database.create_session()
-
-    try:
+    with database.session_scope() as session:
         yield session
-        session.commit()
-    except:
-        session.rollback()
-        raise
-    finally:
-        session.close()
 
 
 def session_wrapper(f):
@@ -72,14 +94,204 @@ def session_wrapper(f):
     return with_session
 
 
+def snapshot_path(name):
+    return os.path.join(SNAPSHOT_DIRECTORY, f'{name}.snapshot')
+
+
+def load_caches(name):
+    """Loads the database's caches from the snapshot of a process that
+    handles updates, if snapshots are enabled. Returns a function that saves
+    the shuffle bags' draws, and the snapshot, when the process stops."""
+    path = snapshot_path(name) if SNAPSHOT_DIRECTORY else None
+
+    if path is not None:
+        logging.info("%s snapshot: %s", name, load_snapshot(database, path))
+
+    def save():
+        logging.info("%s: saved %s shuffle bags", name, database.save_bags())
+
+        if path is not None:
+            logging.info(
+                "%s snapshot: %s", name, save_snapshot(database, path))
+
+    return save
+
+
+def add_handlers(dispatcher, router, side_handlers=(), outbox=None,
+        conversation=None):
+    """Adds the bot's handlers to a dispatcher, and the handler for the
+    callbacks of messages sent through an outbox, if given. If a
+    conversation handler is given, its state and the dispatcher's user_data
+    are kept in the database; returns the ConversationStore that does so."""
+    # Side handlers get a group each, so they run for every update; the
+    # router runs the matching handlers after them
+    for i, handler in enumerate(side_handlers):
+        dispatcher.add_handler(handler, group=i)
+
+    dispatcher.add_handler(router, group=len(side_handlers))
+
+    if outbox is not None:
+        outbox.start(dispatcher, database)
+        dispatcher.add_handler(outbox.handler, group=len(side_handlers))
+
+    # Commit backlogs of updates together, if enabled
+    if BATCH_UPDATES:
+        batch = UpdateBatch(database)
+        dispatcher.add_handler(batch.start, group=-1)
+        dispatcher.add_handler(batch.end, group=len(side_handlers) + 1)
+
+    if conversation is not None:
+        return ConversationStore(database, conversation).start(dispatcher)
+    return None
+
+
+def worker_dispatcher(index, workers):
+    """Returns a dispatcher with the bot's handlers, for one of workers
+    worker processes."""
+    from soup.handlers import conversation_handler, router, side_handlers
+
+    base_url = config.get('api_url')
+    outbox = None
+
+    if config.get('outbox'):
+        # Each worker only sends to its own chats, so it gets a share of the
+        # total limit
+        outbox = Outbox(
+            threads=config.get('outbox_threads', 4), total=(25 / workers, 5))
+        bot = QueuedBot(
+            TOKEN, outbox, base_url=base_url,
+            request=Request(con_pool_size=1 + len(outbox.threads)))
+    else:
+        bot = Bot(TOKEN, base_url=base_url, request=Request(con_pool_size=1))
+
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=0)
+    dispatcher.add_error_handler(QuoteBot.error_callback)
+
+    # Direct messages can be about any chat, but only the worker that owns a
+    # chat sees all of its changes, so only it keeps the chat's state
+    database.owner = lambda chat_id: shard(chat_id, workers) == index
+
+    # Changes made here to other workers' chats are passed on to them
+    database.on_foreign_change = lambda chat_id, change: (
+        dispatcher.send_to_owner(chat_id, change))
+    dispatcher.on_message = [
+        lambda chat_id, change: database.apply_change(change)]
+
+    conversations = add_handlers(
+        dispatcher, router, side_handlers, outbox,
+        conversation=conversation_handler)
+
+    # Run by run_worker once the worker has stopped
+    dispatcher.on_stop = [conversations.stop, load_caches(f'worker_{index}')]
+
+    return dispatcher
+
+
 class QuoteBot:
-    def __init__(self, token, handlers):
-        self.updater = Updater(token)
+    def __init__(self, token, router, side_handlers=(), conversation=None):
+        # A different Bot API server, such as soup.fakebot's, if set
+        base_url = config.get('api_url')
+
+        # Handle updates in worker processes, if more than one is set; this
+        # process only polls for them and runs the maintenance jobs
+        workers = config.get('worker_processes', 1)
+        self.supervisor = None
+
+        if workers > 1:
+            self.supervisor = Supervisor(worker_dispatcher, workers=workers)
+
+        # Send messages from per-chat queues, if enabled; the asyncio
+        # runtime always does. Worker processes have outboxes of their own
+        asyncio_runtime = config.get('runtime') == 'asyncio'
+        self.outbox = None
+
+        if self.supervisor is None and (config.get('outbox') or asyncio_runtime):
+            self.outbox = Outbox(threads=config.get('outbox_threads', 4))
+
+        if self.supervisor is None and asyncio_runtime:
+            # Only one thread can hold a batch's transaction
+            threads = (1 if BATCH_UPDATES
+                else config.get('database_threads', 1))
+            self.updater = AsyncRuntime(
+                token, self.outbox, base_url=base_url, workers=threads)
+        elif self.outbox is not None:
+            # Connections for the updater's, plus the outbox's threads
+            request = Request(con_pool_size=8 + len(self.outbox.threads))
+            self.updater = Updater(bot=QueuedBot(
+                token, self.outbox, base_url=base_url, request=request))
+        else:
+            self.updater = Updater(token, base_url=base_url)
+
+        if self.outbox is not None:
+            self.updater.job_queue.run_repeating(
+                self.log_outbox, interval=datetime.timedelta(minutes=5))
+
         self.dispatcher = self.updater.dispatcher
         self.dispatcher.add_error_handler(self.error_callback)
 
-        for i, handler in enumerate(handlers):
-            self.dispatcher.add_handler(handler, group=i)
+        self.conversations = None
+        self.save_caches = None
+
+        if self.supervisor is not None:
+            self.dispatcher.add_handler(Forwarder(self.supervisor))
+            self.updater.job_queue.run_repeating(
+                self.log_workers, interval=datetime.timedelta(minutes=5))
+        else:
+            self.conversations = add_handlers(
+                self.dispatcher, router, side_handlers, self.outbox,
+                conversation=conversation)
+            self.save_caches = load_caches('bot')
+
+        # Record incoming updates for replaying, if a directory is set
+        directory = config.get('update_log_directory')
+        self.recorder = None
+
+        if directory:
+            self.recorder = UpdateRecorder(
+                directory, keep=config.get('update_log_keep', 10))
+            self.dispatcher.add_handler(self.recorder, group=-2)
+
+        # Delete old quote messages daily, if a retention period is set
+        retention = config.get('quote_message_retention_days')
+
+        if retention:
+            self.updater.job_queue.run_repeating(
+                self.compact_messages, interval=datetime.timedelta(days=1),
+                first=60, context=datetime.timedelta(days=retention))
+
+        # Move deleted quotes out of the live tables daily
+        self.updater.job_queue.run_repeating(
+            self.archive_quotes, interval=datetime.timedelta(days=1), first=120)
+
+        # Take snapshots of the database, if a backup directory is set
+        directory = config.get('backup_directory')
+
+        if directory:
+            self.updater.job_queue.run_repeating(
+                self.backup, first=180,
+                interval=datetime.timedelta(
+                    hours=config.get('backup_interval_hours', 24)),
+                context=(directory, config.get('backup_keep', 7)))
+
+    @staticmethod
+    def compact_messages(bot, job):
+        logging.info(compact_quote_messages(database, job.context))
+
+    @staticmethod
+    def archive_quotes(bot, job):
+        logging.info(archive_deleted_quotes(database))
+
+    @staticmethod
+    def backup(bot, job):
+        directory, keep = job.context
+        logging.info(backup_database(database, directory, keep))
+
+    def log_outbox(self, bot, job):
+        logging.info("outbox: %s", self.outbox.metrics())
+
+    def log_workers(self, bot, job):
+        for metrics in self.supervisor.metrics(window=300):
+            logging.info("worker: %s", metrics)
 
     @staticmethod
     def error_callback(bot, update, error):
@@ -93,14 +305,50 @@ class QuoteBot:
             logging.error(traceback.format_exc())
 
     def run(self):
+        if self.supervisor is not None:
+            self.supervisor.start()
+
         self.updater.start_polling()
         self.updater.idle()
 
+        if self.supervisor is not None:
+            self.supervisor.stop()
+
+        # The asyncio runtime stops its outbox when it stops, and runs the
+        # last messages' callbacks in its own lanes
+        if self.outbox is not None and not isinstance(self.updater, AsyncRuntime):
+            self.outbox.stop()
+
+            # The dispatcher has stopped, so run the last messages' callbacks
+            while not self.dispatcher.update_queue.empty():
+                update = self.dispatcher.update_queue.get()
+
+                if isinstance(update, Sent):
+                    self.dispatcher.process_update(update)
+
+        if self.conversations is not None:
+            self.conversations.stop()
+
+        if self.save_caches is not None:
+            self.save_caches()
+
+        if self.recorder is not None:
+            self.recorder.close()
+
 
 def main():
-    from soup.handlers import handlers
+    from soup.handlers import conversation_handler, router, side_handlers
+
+    # Snapshots of caches are only loaded by the run after the one that
+    # saved them
+    start_run(database)
+
+    # Roll up quotes from before the daily rollups existed
+    threading.Thread(
+        target=database.backfill_daily_stats, name='backfill', daemon=True
+    ).start()
 
-    quote = QuoteBot(TOKEN, handlers)
+    quote = QuoteBot(TOKEN, router, side_handlers, conversation_handler)
     quote.run()
 
 
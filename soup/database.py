@@ -1,12 +1,38 @@
+import collections
+import contextlib
+import datetime
 import functools
+import logging
+import threading
+import time
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, event
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import class_mapper, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import exists
-from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import (
+    and_, case, cast, func, literal, select, union_all)
 
-from soup.classes import Base, User, Chat, Quote, QuoteMessage, Vote
+from soup.activity import ActivitySnapshot
+from soup.archive import KeySet, quote_key
+from soup.classes import (
+    ArchivedQuote, ArchivedQuoteMessage, ArchivedVote, Base, User, Chat,
+    Conversation, DailyStats, Quote, QuoteBag, QuoteMessage, State, Vote,
+    membership_table)
+from soup.hotness import add_event
+from soup.sampling import ShuffleBag, WeightedSampler
+from soup.search import FULLTEXT_DDL, compile_search
+
+
+# Staging table for sync_memberships, created as a temporary table on the
+# connection that uses it
+membership_sync_table = Table(
+    'membership_sync', MetaData(),
+    Column('user_id', Integer, primary_key=True))
+
+MembershipSync = collections.namedtuple(
+    'MembershipSync', 'added removed kept unknown')
 
 
 class QuoteDatabase:
@@ -22,17 +48,270 @@ class QuoteDatabase:
 
     SCORE_TO_DELETE = -5
 
-    def __init__(self, filename='data.db'):
+    # Bots can only edit their messages for this long
+    MESSAGE_EDIT_WINDOW = datetime.timedelta(hours=48)
+
+    # Progress of the daily rollup backfill: the ID of the last quote that has
+    # been rolled up, or 'done'
+    DAILY_STATS_BACKFILL = 'daily_stats_backfill'
+
+    def __init__(self, filename='data.db', fulltext=False):
         self.filename = filename
 
-        engine = create_engine(f"sqlite:///{filename}", echo=False)
-        Base.metadata.create_all(engine)
+        self.engine = create_engine(f"sqlite:///{filename}", echo=False)
+        self.create_schema(fulltext)
+
+        # Searches use the full-text index if one exists
+        self.fulltext = self.has_fulltext_index()
+
+        self.session_factory = self._session_factory()
+        self.daily_stats_ready = self._init_daily_stats()
+
+        event.listen(
+            self.session_factory, 'after_commit', self._run_commit_hooks)
+        event.listen(
+            self.session_factory, 'after_rollback', self._discard_commit_hooks)
+
+        # Whether a chat's state is kept in memory by this process (see
+        # owns_chat); worker processes only keep their own chats'
+        self.owner = None
+
+        # Called with a chat's ID and a change to its state in memory, for
+        # chats this process doesn't own, to pass it on to the process that
+        # does (see apply_change)
+        self.on_foreign_change = None
+
+        # Per-chat state for random quotes, loaded on first use
+        self.samplers = {}
+        self.samplers_lock = threading.Lock()
+        self.bags = {}
+        self.bags_lock = threading.Lock()
 
-        self.session_factory = sessionmaker(bind=engine)
+        # Chats whose bags have been drawn from since they were saved
+        self.bags_changed = set()
+
+        # Per-chat columnar snapshots for activity stats, loaded on first use
+        self.activity = {}
+        self.activity_lock = threading.Lock()
+
+        # Keys of archived quotes, loaded on first use, and the number of
+        # archived quotes they were loaded for
+        self.archived_keys = None
+        self.archived_count = None
+        self.archived_keys_lock = threading.Lock()
+
+        # The session of each thread's open batch (see begin_batch)
+        self.batches = threading.local()
+
+    def create_schema(self, fulltext=False):
+        """Creates the tables that don't exist yet, and the full-text index
+        if it's wanted."""
+        Base.metadata.create_all(self.engine)
+
+        if fulltext and not self.has_fulltext_index():
+            self.create_fulltext_index()
+
+    def _session_factory(self):
+        return sessionmaker(bind=self.engine)
 
     def create_session(self, **kwargs):
         return self.session_factory(**kwargs)
 
+    def files(self):
+        """Returns the paths of the database's files."""
+        return [self.filename]
+
+    def on_commit(self, session, callback):
+        """Calls the callback once the session's transaction is committed.
+        In-memory state is updated this way so that it never reflects changes
+        that were rolled back."""
+        session.info.setdefault('on_commit', []).append(callback)
+
+    def on_rollback(self, session, callback):
+        """Calls the callback if the session's transaction, or the savepoint
+        it's in, is rolled back. This undoes changes that in-memory state
+        can't wait for the commit to make, such as drawing from a bag."""
+        session.info.setdefault('on_rollback', []).append(callback)
+
+    @staticmethod
+    def _run_commit_hooks(session):
+        # Releasing a savepoint counts as a commit; wait for the transaction
+        if session.transaction.nested:
+            return
+
+        session.info.pop('on_rollback', None)
+
+        for callback in session.info.pop('on_commit', []):
+            callback()
+
+    @staticmethod
+    def _discard_commit_hooks(session):
+        # Savepoints discard their own hooks
+        if session.transaction.nested:
+            return
+
+        session.info.pop('on_commit', None)
+
+        for callback in reversed(session.info.pop('on_rollback', [])):
+            callback()
+
+    @contextlib.contextmanager
+    def session_scope(self):
+        """Provides a session that is committed at the end, or rolled back
+        on errors. Within a batch, this is a savepoint of the batch's
+        session instead."""
+        session = self.current_batch()
+
+        if session is not None:
+            with self.savepoint(session):
+                yield session
+            return
+
+        session = self.create_session()
+
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    @contextlib.contextmanager
+    def savepoint(self, session, cls=None):
+        """Runs a block in a savepoint, which is rolled back alone if the
+        block raises, along with the commit hooks it added. cls is the model
+        the block writes, for sessions that route it to a file of its own."""
+        connection = session.connection(
+            mapper=None if cls is None else class_mapper(cls))
+
+        # pysqlite only begins transactions before writes, and a savepoint
+        # outside of a transaction would commit on release
+        if not connection.connection.in_transaction:
+            connection.execute('BEGIN')
+
+        hooks = session.info.setdefault('on_commit', [])
+        undo = session.info.setdefault('on_rollback', [])
+        mark, undo_mark = len(hooks), len(undo)
+        nested = session.begin_nested()
+
+        try:
+            yield
+            nested.commit()
+        except:
+            nested.rollback()
+            del hooks[mark:]
+
+            for callback in reversed(undo[undo_mark:]):
+                callback()
+
+            del undo[undo_mark:]
+            raise
+
+    # Batch methods
+
+    def begin_batch(self):
+        """Opens a batch on this thread: until end_batch, every
+        session_scope on the thread shares one transaction, so that many
+        small units of work are committed together."""
+        session = self.create_session()
+
+        # pysqlite only begins transactions before writes, and a savepoint
+        # outside of a transaction would commit on release
+        session.execute('BEGIN')
+        self.batches.session = session
+
+    def current_batch(self):
+        """Returns the session of this thread's open batch, or None."""
+        return getattr(self.batches, 'session', None)
+
+    def end_batch(self):
+        """Commits and closes this thread's open batch."""
+        session = self.batches.session
+        self.batches.session = None
+
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def table_size(self, name):
+        """Returns the number of rows in a table, and the number of bytes its
+        pages take up, or None if SQLite was built without the dbstat
+        table."""
+        table = Base.metadata.tables[name]
+
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select([func.count()]).select_from(table)).scalar()
+
+            try:
+                size = connection.execute(
+                    "SELECT sum(pgsize) FROM dbstat WHERE name = ?",
+                    name).scalar()
+            except OperationalError:
+                size = None
+
+        return rows, size
+
+    def has_fulltext_index(self):
+        return self.engine.has_table('quote_fts')
+
+    def create_fulltext_index(self):
+        """Creates and populates the full-text index over quote contents. This
+        requires SQLite to be built with FTS5."""
+        try:
+            with self.engine.begin() as connection:
+                for statement in FULLTEXT_DDL:
+                    connection.execute(statement)
+        except OperationalError:
+            logging.warning("FTS5 is unavailable; using substring search")
+
+    # State methods
+
+    def get_state(self, session, key):
+        return (session.query(State.value)
+            .filter(State.key == key).scalar())
+
+    def set_state(self, session, key, value):
+        session.merge(State(key=key, value=value))
+
+    def data_version(self, session):
+        """Returns the highest quote ID and the number of archived quotes,
+        which change whenever quotes are added or archived, so that state
+        saved from memory can be checked against the database."""
+        return (session.query(func.max(Quote.id)).scalar() or 0,
+            session.query(func.count(ArchivedQuote.id)).scalar())
+
+    # Conversation methods
+
+    def get_conversation(self, session, user_id):
+        """Returns a user's saved direct message conversation, or None."""
+        return (session.query(Conversation)
+            .filter(Conversation.user_id == user_id).one_or_none())
+
+    def save_conversations(self, session, records):
+        """Saves direct message conversations, given as a dictionary of user
+        IDs to the Conversation table's columns, in one statement each for
+        conversations saved and deleted. A record of None deletes the user's
+        conversation."""
+        table = Conversation.__table__
+        saved = [dict(record, user_id=user_id)
+            for user_id, record in records.items() if record is not None]
+        deleted = [user_id
+            for user_id, record in records.items() if record is None]
+
+        if saved:
+            session.execute(table.insert().prefix_with('OR REPLACE'), saved)
+
+        if deleted:
+            session.execute(table.delete()
+                .where(table.c.user_id.in_(deleted)))
+
     # User methods
 
     def get_user_by_id(self, session, user_id):
@@ -64,6 +343,15 @@ class QuoteDatabase:
         user = self.get_user_by_id(session, user_id)
         return [] if user is None else user.chats
 
+    def get_user_chat_titles(self, session, user_id):
+        """Returns the IDs and titles of the chats that a user is a member
+        of, ordered by title, without loading the chats."""
+        return (session.query(Chat.id, Chat.title)
+            .join(membership_table, membership_table.c.chat_id == Chat.id)
+            .filter(membership_table.c.user_id == user_id)
+            .order_by(Chat.title, Chat.id)
+            .all())
+
     def get_user_score(self, session, user_id, chat_id):
         """Returns the total number of upvotes and downvotes, and the total
         score for the user's quotes."""
@@ -92,6 +380,14 @@ class QuoteDatabase:
         """Returns the chat with the given ID."""
         return session.query(Chat).filter(Chat.id == chat_id).one_or_none()
 
+    def get_chat_titles(self, session, chat_ids):
+        """Returns a dictionary of the given chats' IDs to their titles."""
+        if not chat_ids:
+            return {}
+
+        return dict(session.query(Chat.id, Chat.title)
+            .filter(Chat.id.in_(chat_ids)))
+
     def chat_exists(self, session, chat_id):
         """Determines if the given chat exists in the database."""
         return session.query(exists().where(Chat.id == chat_id)).scalar()
@@ -116,24 +412,94 @@ class QuoteDatabase:
         chat = self.get_chat_by_id(session, from_id)
         chat.id = to_id
 
+        self.on_commit(session, functools.partial(
+            self.samplers.pop, from_id, None))
+        self.on_commit(session, functools.partial(
+            self.bags.pop, from_id, None))
+        self.on_commit(session, functools.partial(
+            self.activity.pop, from_id, None))
+
+    def set_random_mode(self, session, chat_id, mode):
+        """Sets how random quotes are chosen in a chat: 'uniform' or
+        'weighted' by score."""
+        chat = self.get_chat_by_id(session, chat_id)
+        chat.random_mode = mode
+
     # Membership methods
 
     def add_membership(self, session, user_id, chat_id):
-        """Adds a membership listing, indicating that a user is in a chat."""
-        user = self.get_user_by_id(session, user_id)
-        chat = self.get_chat_by_id(session, chat_id)
+        """Adds a membership listing, indicating that a user is in a chat.
+        Returns whether the listing is new."""
+        result = session.execute(membership_table.insert()
+            .prefix_with('OR IGNORE')
+            .values(user_id=user_id, chat_id=chat_id))
 
-        if chat not in user.chats:
-            user.chats.append(chat)
-            session.add(user)
+        self._expire_memberships(session, chat_id, [user_id])
+        return result.rowcount > 0
 
     def remove_membership(self, session, user_id, chat_id):
         """Removes a membership listing, when a user leaves or is removed from
-        a group."""
-        user = self.get_user_by_id(session, user_id)
-        chat = self.get_chat_by_id(session, chat_id)
-
-        user.chats.remove(chat)
+        a group. Returns whether there was a listing to remove."""
+        result = session.execute(membership_table.delete().where(and_(
+            membership_table.c.user_id == user_id,
+            membership_table.c.chat_id == chat_id)))
+
+        self._expire_memberships(session, chat_id, [user_id])
+        return result.rowcount > 0
+
+    def sync_memberships(self, session, chat_id, user_ids):
+        """Makes the given users the chat's full member set. Users who aren't
+        in the database are skipped. Returns the number of listings added,
+        removed and kept, and the number of unknown users."""
+        user_ids = set(user_ids)
+
+        # Users added in this session must be visible to the statements below
+        session.flush()
+        session.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {membership_sync_table.name} "
+            f"(user_id INTEGER PRIMARY KEY)")
+        session.execute(membership_sync_table.delete())
+
+        if user_ids:
+            session.execute(membership_sync_table.insert(),
+                [{'user_id': user_id} for user_id in user_ids])
+
+        listed = membership_sync_table.c.user_id
+        members = (select([membership_table.c.user_id])
+            .where(membership_table.c.chat_id == chat_id))
+
+        known = session.execute(select([func.count()])
+            .where(listed.in_(select([User.id])))).scalar()
+
+        added = session.execute(membership_table.insert()
+            .prefix_with('OR IGNORE')
+            .from_select(['user_id', 'chat_id'],
+                select([listed, literal(chat_id)])
+                .where(listed.in_(select([User.id])))
+                .where(~listed.in_(members)))).rowcount
+
+        removed = session.execute(membership_table.delete().where(and_(
+            membership_table.c.chat_id == chat_id,
+            ~membership_table.c.user_id.in_(select([listed]))))).rowcount
+
+        session.execute(membership_sync_table.delete())
+        self._expire_memberships(session, chat_id)
+
+        return MembershipSync(
+            added, removed, known - added, len(user_ids) - known)
+
+    def _expire_memberships(self, session, chat_id, user_ids=None):
+        """Expires membership collections that were loaded before the listings
+        were changed directly, so that they're reloaded on next use. Without
+        user_ids, every loaded user's chats are expired."""
+        # Identities are matched by class and ID alone, since sessions of a
+        # sharded database can hold one for each file an object was loaded
+        # from
+        for (cls, ident, _), obj in list(session.identity_map.items()):
+            if cls is User and (user_ids is None or ident[0] in user_ids):
+                session.expire(obj, ['chats'])
+            elif cls is Chat and ident[0] == chat_id:
+                session.expire(obj, ['users'])
 
     # User ranking methods
 
@@ -157,22 +523,117 @@ class QuoteDatabase:
         return self.rank_users(
             session, chat_id, Quote.quoted_by_id, limit=limit)
 
-    def get_user_scores(self, session, chat_id, limit=5, direction=1):
-        chat = self.get_chat_by_id(session, chat_id)
-        scores = []
-
-        for user in chat.users:
-            up, score, down = self.get_user_score(session, user.id, chat.id)
+    def get_chat_stats(self, session, chat_id, limit=5, since=None):
+        """Returns the number of quotes in a chat, the users who have the most
+        quotes and the users who have added the most quotes. If since is
+        given, only quotes added on or after that day are counted.
+
+        This is a single statement: the chat's quotes (or daily rollups) are
+        read once and grouped by sender and quoter, then each role is ranked
+        with window functions."""
+        if since is None:
+            pairs = (session.query(
+                    Quote.sent_by_id, Quote.quoted_by_id,
+                    func.count(Quote.id).label('count'))
+                .filter(Quote.chat_id == chat_id, Quote.deleted == False)
+                .group_by(Quote.sent_by_id, Quote.quoted_by_id)
+                .cte('pairs'))
+
+            sources = (
+                ('quoted', pairs.c.sent_by_id, pairs.c.count),
+                ('added', pairs.c.quoted_by_id, pairs.c.count))
+        else:
+            days = (session.query(DailyStats)
+                .filter(DailyStats.chat_id == chat_id, DailyStats.day >= since)
+                .cte('days'))
+
+            sources = (
+                ('quoted', days.c.user_id, days.c.quotes_sent),
+                ('added', days.c.user_id, days.c.quotes_added))
+
+        counts = union_all(*[
+            select([
+                literal(role).label('role'),
+                column.label('user_id'),
+                func.sum(count).label('count')])
+            .group_by(column)
+            for role, column, count in sources
+        ]).cte('counts')
+
+        ranked = select([
+            counts.c.role, counts.c.user_id, counts.c.count,
+            func.sum(counts.c.count)
+                .over(partition_by=counts.c.role).label('total'),
+            func.row_number().over(
+                partition_by=counts.c.role,
+                order_by=(counts.c.user_id.is_(None), counts.c.count.desc(),
+                    counts.c.user_id)).label('rank'),
+        ]).cte('ranked')
+
+        rows = (session.query(ranked.c.role, User, ranked.c.count, ranked.c.total)
+            .outerjoin(User, User.id == ranked.c.user_id)
+            .filter(ranked.c.rank <= limit)
+            .order_by(ranked.c.role, ranked.c.rank))
+
+        total = 0
+        users = {'quoted': [], 'added': []}
+
+        for role, user, count, role_total in rows:
+            total = role_total
+
+            # Quotes without a known user are counted, but not ranked. Rollups
+            # list users who only sent or only added quotes with a count of 0
+            if user is not None and count:
+                users[role].append((user, count))
+
+        return total, users['quoted'], users['added']
+
+    def get_user_scores(self, session, chat_id, limit=5, direction=1,
+            since=None):
+        """Returns the chat members with the highest (direction 1) or lowest
+        (direction -1) total scores, with their upvotes and downvotes. If since
+        is given, only votes cast on or after that day are counted.
+
+        Highest scores skip members with a score of 0, and lowest scores skip
+        members with positive scores. Deleted quotes aren't counted."""
+        if since is None:
+            up = func.sum(case([(Vote.direction == 1, 1)], else_=0))
+            down = func.sum(case([(Vote.direction == -1, 1)], else_=0))
+        else:
+            up = func.sum(DailyStats.upvotes)
+            down = func.sum(DailyStats.downvotes)
+
+        up, down = func.coalesce(up, 0), func.coalesce(down, 0)
+        score = (up - down).label('score')
+
+        query = (session.query(User, up, score, down)
+            .select_from(membership_table)
+            .join(User, User.id == membership_table.c.user_id))
+
+        if since is None:
+            query = (query
+                .outerjoin(Quote, and_(
+                    Quote.sent_by_id == membership_table.c.user_id,
+                    Quote.chat_id == chat_id,
+                    Quote.deleted == False))
+                .outerjoin(Vote, Vote.quote_id == Quote.id))
+        else:
+            query = query.outerjoin(DailyStats, and_(
+                DailyStats.user_id == membership_table.c.user_id,
+                DailyStats.chat_id == chat_id,
+                DailyStats.day >= since))
 
-            if direction == 1 and score == 0:
-                continue
-            elif direction == -1 and score > 0:
-                continue
+        query = (query
+            .filter(membership_table.c.chat_id == chat_id)
+            .group_by(membership_table.c.user_id))
 
-            scores.append((user, up, score, down))
+        if direction == 1:
+            query = query.having(score != 0).order_by(score.desc(), User.id)
+        else:
+            query = query.having(score <= 0).order_by(score.asc(), User.id)
 
-        users = sorted(scores, key=lambda u: u[2], reverse=direction == 1)
-        return users[:limit]
+        return [(user, up, score, down)
+            for user, up, score, down in query.limit(limit)]
 
     get_lowest_scoring = functools.partialmethod(get_user_scores, direction=-1)
     """Returns users with the lowest overall scores."""
@@ -191,13 +652,36 @@ class QuoteDatabase:
             .filter(Quote.chat_id == chat_id, Quote.message_id == message_id)
             .one_or_none())
 
+    def get_trending_quotes(self, session, chat_id, limit=5):
+        """Returns the quotes with the highest time-decayed scores. This reads
+        at most limit entries from the (chat_id, hotness) index."""
+        return (session.query(Quote)
+            .filter(Quote.chat_id == chat_id, Quote.hotness != None,
+                Quote.deleted == False)
+            .order_by(Quote.hotness.desc())
+            .limit(limit)
+            .all())
+
     def get_quote_count(self, session, chat_id):
         """Returns the number of quotes added in the given chat."""
         return (session.query(func.count(Quote.id))
-            .filter(Quote.chat_id == chat_id).scalar())
+            .filter(Quote.chat_id == chat_id, Quote.deleted == False)
+            .scalar())
 
     def get_random_quote(self, session, chat_id, name=None):
-        """Returns a random quote, and the user who wrote the quote."""
+        """Returns a random quote, and the user who wrote the quote. Quotes
+        don't repeat until every quote in the chat has been drawn, unless the
+        chat has chosen to favor quotes with higher scores. Chats this
+        process doesn't own draw uniformly without a shuffle bag, which only
+        the owner keeps."""
+        if name is None:
+            chat = self.get_chat_by_id(session, chat_id)
+
+            if chat is not None and chat.random_mode == 'weighted':
+                return self.get_weighted_random_quote(session, chat_id)
+            elif chat is not None and self.owns_chat(chat_id):
+                return self.get_shuffled_random_quote(session, chat_id)
+
         query = (session.query(Quote)
             .join(Chat, Quote.chat_id == Chat.id)
             .filter(Chat.id == chat_id, Quote.deleted == False))
@@ -212,21 +696,23 @@ class QuoteDatabase:
         else:
             return None, None
 
-    def search_quote(self, session, chat_id, terms, tags):
-        """Returns a random quote matching the search terms, and the user
+    def search_quote(self, session, chat_id, expression):
+        """Returns a random quote matching the search expression, and the user
         who wrote the quote."""
-        query = (session.query(Quote)
-            .filter(Quote.chat_id == chat_id, Quote.deleted == False))
-
-        if terms:
-            query = query.filter(Quote.content.ilike(f'%{terms}%'))
+        query, params = compile_search(expression, fulltext=self.fulltext)
+        quote = query(session).params(chat_id=chat_id, **params).first()
 
-        for tag in tags:
-            query = tag.apply_filter(query)
-
-        quote = query.order_by(func.random()).first()
+        if quote is not None:
+            return quote, quote.sent_by
+        else:
+            return None, None
 
-        print(query)
+    def search_member_quote(self, session, user_id, expression):
+        """Returns a random quote matching the search expression from any chat
+        that the user is a member of, and the user who wrote the quote."""
+        query, params = compile_search(
+            expression, fulltext=self.fulltext, member=True)
+        quote = query(session).params(user_id=user_id, **params).first()
 
         if quote is not None:
             return quote, quote.sent_by
@@ -239,12 +725,13 @@ class QuoteDatabase:
         """Inserts a quote."""
         quote = (session.query(Quote.id, Quote.deleted)
             .filter(Quote.sent_at == sent_at,
-                User.id == sent_by_id,
+                Quote.sent_by_id == sent_by_id,
                 Quote.content_html == content_html)
             .one_or_none())
 
         if quote is None:
-            pass
+            if self.is_archived(session, sent_at, sent_by_id, content_html):
+                return None, self.QUOTE_PREVIOUSLY_DELETED
         else:
             quote_id, deleted = quote
 
@@ -258,14 +745,29 @@ class QuoteDatabase:
         sent_by = self.get_user_by_id(session, sent_by_id)
         quoted_by = self.get_user_by_id(session, quoted_by_id)
 
+        now = datetime.datetime.now()
+
         quote = Quote(
             chat=chat, message_id=message_id, is_forward=is_forward,
-            sent_at=sent_at, sent_by=sent_by, message_type=message_type,
-            content=content, content_html=content_html, file_id=file_id,
-            quoted_by=quoted_by, score=score)
+            sent_at=sent_at, added_at=now, sent_by=sent_by,
+            message_type=message_type, content=content,
+            content_html=content_html, file_id=file_id, quoted_by=quoted_by,
+            score=score,
+            # Being quoted counts as the first upvote for trending
+            hotness=add_event(None, now, 1))
 
         session.add(quote)
 
+        # Assigns the quote's ID
+        session.flush()
+
+        if self.tracks_daily_stats(session, quote.id):
+            self.roll_up_quote(session, quote, 1)
+
+        self.on_commit(session, functools.partial(
+            self._quote_added, chat_id, quote.id, quote.score, quote.sent_at,
+            quote.sent_by_id))
+
         return quote, self.QUOTE_ADDED
 
     def add_quote_for_test(self, session, quote):
@@ -276,7 +778,387 @@ class QuoteDatabase:
     def delete_quote(self, session, quote_id):
         """Marks a quote as deleted."""
         quote = self.get_quote_by_id(session, quote_id)
+
+        if not quote.deleted and self.tracks_daily_stats(session, quote_id):
+            self.roll_up_quote(session, quote, -1)
+
         quote.deleted = True
+        quote.hotness = None
+
+        self.on_commit(session, functools.partial(
+            self._quote_removed, quote.chat_id, quote_id))
+
+    # Archive methods
+
+    def get_archived_keys(self, session):
+        """Returns the keys of all archived quotes, loading them on first
+        use. Quotes can be archived by other processes, such as the
+        archive-quotes command, so the keys are loaded again whenever the
+        number of archived quotes has changed."""
+        count = session.query(func.count(ArchivedQuote.id)).scalar()
+
+        if self.archived_keys is None or self.archived_count != count:
+            with self.archived_keys_lock:
+                if self.archived_keys is None or self.archived_count != count:
+                    self.archived_keys = KeySet(
+                        key for key, in session.query(ArchivedQuote.key))
+                    self.archived_count = count
+
+        return self.archived_keys
+
+    def is_archived(self, session, sent_at, sent_by_id, content_html):
+        """Returns whether a quote with the given fields has been deleted and
+        archived. Most quotes aren't, which the in-memory keys rule out
+        without a query."""
+        key = quote_key(sent_at, sent_by_id, content_html)
+
+        if key not in self.get_archived_keys(session):
+            return False
+
+        # Rules out hash collisions
+        return session.query(exists().where(and_(
+            ArchivedQuote.key == key,
+            ArchivedQuote.sent_at == sent_at,
+            ArchivedQuote.sent_by_id == sent_by_id,
+            ArchivedQuote.content_html == content_html))).scalar()
+
+    def archive_deleted_quotes(self, batch_size=200, pause=0.1):
+        """Moves deleted quotes, with their votes and messages, into the
+        archive tables, in batches that are committed separately so that the
+        write lock is never held for long. Returns the number of quotes
+        archived."""
+        archived_at = datetime.datetime.now()
+        archived = 0
+
+        while True:
+            session = self.create_session()
+
+            try:
+                quotes = (session.query(Quote.__table__)
+                    .filter(Quote.deleted == True)
+                    .order_by(Quote.id)
+                    .limit(batch_size)
+                    .all())
+
+                if not quotes:
+                    break
+
+                quote_ids = [quote.id for quote in quotes]
+                rows = [{
+                    'id': quote.id,
+                    'chat_id': quote.chat_id,
+                    'message_id': quote.message_id,
+                    'is_forward': quote.is_forward,
+                    'sent_at': quote.sent_at,
+                    'added_at': quote.added_at,
+                    'sent_by_id': quote.sent_by_id,
+                    'content': quote.content,
+                    'content_html': quote.content_html,
+                    'file_id': quote.file_id,
+                    'message_type': quote.message_type,
+                    'quoted_by_id': quote.quoted_by_id,
+                    'score': quote.score,
+                    'archived_at': archived_at,
+                    'key': quote_key(
+                        quote.sent_at, quote.sent_by_id, quote.content_html),
+                } for quote in quotes]
+
+                session.execute(ArchivedQuote.__table__.insert(), rows)
+
+                for hot, cold in ((Vote, ArchivedVote),
+                        (QuoteMessage, ArchivedQuoteMessage)):
+                    columns = [column.name for column in cold.__table__.columns]
+
+                    session.execute(cold.__table__.insert().from_select(
+                        columns,
+                        select([hot.__table__.c[name] for name in columns])
+                        .where(hot.quote_id.in_(quote_ids))))
+
+                    session.query(hot).filter(
+                        hot.quote_id.in_(quote_ids)
+                    ).delete(synchronize_session=False)
+
+                session.query(Quote).filter(
+                    Quote.id.in_(quote_ids)
+                ).delete(synchronize_session=False)
+
+                self.on_commit(session, functools.partial(
+                    self._quotes_archived, [row['key'] for row in rows]))
+
+                session.commit()
+                archived += len(quotes)
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+            time.sleep(pause)
+
+        return archived
+
+    def _quotes_archived(self, keys):
+        if self.archived_keys is not None:
+            for key in keys:
+                self.archived_keys.add(key)
+
+            self.archived_count += len(keys)
+
+    # Random quote methods
+
+    def owns_chat(self, chat_id):
+        """Returns whether this process keeps a chat's state, such as its
+        random quote sampler, in memory. The state is only right in the
+        process that sees every change to the chat's quotes, which with
+        worker processes is the worker that owns the chat."""
+        return self.owner is None or self.owner(chat_id)
+
+    def quote_weight(self, score):
+        """Returns the relative chance of drawing a quote with the given score.
+        Weights grow linearly from 1, just above the deletion threshold."""
+        return max((score or 0) - self.SCORE_TO_DELETE, 1)
+
+    def get_sampler(self, session, chat_id):
+        """Returns the chat's weighted sampler, loading it on first use.
+        Samplers of chats this process doesn't own are loaded every time."""
+        if not self.owns_chat(chat_id):
+            return self._load_sampler(session, chat_id)
+
+        sampler = self.samplers.get(chat_id)
+
+        if sampler is None:
+            with self.samplers_lock:
+                sampler = self.samplers.get(chat_id)
+
+                if sampler is None:
+                    sampler = self._load_sampler(session, chat_id)
+                    self.samplers[chat_id] = sampler
+
+        return sampler
+
+    def _load_sampler(self, session, chat_id):
+        items = (session.query(Quote.id, Quote.score)
+            .filter(Quote.chat_id == chat_id, Quote.deleted == False))
+
+        return WeightedSampler(self.quote_weight, items)
+
+    def get_weighted_random_quote(self, session, chat_id):
+        """Returns a random quote drawn with probability proportional to its
+        weight, and the user who wrote the quote."""
+        sampler = self.get_sampler(session, chat_id)
+
+        for _ in range(3):
+            quote_id = sampler.draw()
+
+            if quote_id is None:
+                break
+
+            quote = self.get_quote_by_id(session, quote_id)
+
+            if quote is not None and not quote.deleted:
+                return quote, quote.sent_by
+
+            # The sampler was loaded while the quote was being added, and
+            # that transaction was rolled back
+            sampler.remove(quote_id)
+
+        return None, None
+
+    def get_bag(self, session, chat_id):
+        """Returns the chat's shuffle bag, restoring its saved state on first
+        use."""
+        bag = self.bags.get(chat_id)
+
+        if bag is None:
+            with self.bags_lock:
+                bag = self.bags.get(chat_id)
+
+                if bag is None:
+                    bag = self._load_bag(session, chat_id)
+                    self.bags[chat_id] = bag
+
+        return bag
+
+    def _load_bag(self, session, chat_id):
+        saved = (session.query(QuoteBag)
+            .filter(QuoteBag.chat_id == chat_id).one_or_none())
+
+        if saved is None:
+            return ShuffleBag()
+
+        bag = ShuffleBag.loads(saved.quote_ids, high_water=saved.high_water)
+
+        # Absorb quotes that were added after the bag was saved
+        for quote_id, in self._live_quote_ids(session, chat_id, saved.high_water):
+            bag.add(quote_id)
+
+        return bag
+
+    def _live_quote_ids(self, session, chat_id, after=0):
+        return (session.query(Quote.id)
+            .filter(Quote.chat_id == chat_id, Quote.deleted == False,
+                Quote.id > after))
+
+    def save_bag(self, session, chat_id, bag):
+        session.merge(QuoteBag(
+            chat_id=chat_id, quote_ids=bag.dumps(), high_water=bag.high_water))
+
+    def save_bags(self):
+        """Saves the shuffle bags that have been drawn from since they were
+        last saved, each in its own transaction. Returns the number saved."""
+        with self.bags_lock:
+            changed, self.bags_changed = self.bags_changed, set()
+
+        saved = 0
+
+        for chat_id in changed:
+            # Bags of migrated chats are dropped
+            bag = self.bags.get(chat_id)
+
+            if bag is not None:
+                with self.session_scope() as session:
+                    self.save_bag(session, chat_id, bag)
+
+                saved += 1
+
+        return saved
+
+    def get_shuffled_random_quote(self, session, chat_id):
+        """Returns a random quote that hasn't been drawn since the chat's
+        shuffle bag was last refilled, and the user who wrote the quote.
+
+        Draws only change the bag in memory, and are undone if the session
+        is rolled back. The bag is saved when it's refilled and by
+        save_bags, which is called when the bot stops; after a crash, quotes
+        drawn since the bag was last saved can be drawn again."""
+        bag = self.get_bag(session, chat_id)
+        refilled = False
+
+        while True:
+            quote_id = bag.pop()
+
+            if quote_id is None:
+                if refilled:
+                    return None, None
+
+                for quote_id, in self._live_quote_ids(session, chat_id):
+                    bag.add(quote_id)
+
+                self.save_bag(session, chat_id, bag)
+                refilled = True
+                continue
+
+            quote = self.get_quote_by_id(session, quote_id)
+
+            # Saved bags can refer to quotes deleted since they were saved
+            if quote is not None and not quote.deleted:
+                self.on_rollback(session, functools.partial(bag.add, quote_id))
+                self.bags_changed.add(chat_id)
+                return quote, quote.sent_by
+
+    # Commit hooks that update chats' state in memory, which can be passed on
+    # to the process that owns a chat
+    CHANGES = ('_quote_added', '_quote_scored', '_quote_removed')
+
+    def _pass_on(self, name, chat_id, *args):
+        """Returns whether a change to a chat's state was passed on to the
+        process that owns the chat, instead of being made here."""
+        if self.owns_chat(chat_id):
+            return False
+
+        if self.on_foreign_change is not None:
+            self.on_foreign_change(chat_id, (name, (chat_id,) + args))
+        return True
+
+    def apply_change(self, change):
+        """Makes a change passed on by a process that doesn't own the chat,
+        such as a vote cast by direct message."""
+        name, args = change
+
+        if name not in self.CHANGES:
+            raise ValueError(f"unknown change: {name}")
+
+        getattr(self, name)(*args)
+
+    def _quote_added(self, chat_id, quote_id, score, sent_at, sent_by_id):
+        if self._pass_on('_quote_added', chat_id, quote_id, score, sent_at,
+                sent_by_id):
+            return
+
+        sampler = self.samplers.get(chat_id)
+        if sampler is not None:
+            sampler.set(quote_id, score)
+
+        # Bags refilled in the quote's own transaction have seen it already,
+        # and might have drawn it since
+        bag = self.bags.get(chat_id)
+        if bag is not None and quote_id > bag.high_water:
+            bag.add(quote_id)
+
+        snapshot = self.activity.get(chat_id)
+        if snapshot is not None:
+            snapshot.append(quote_id, sent_at, sent_by_id, score)
+
+    def _quote_scored(self, chat_id, quote_id, score):
+        if self._pass_on('_quote_scored', chat_id, quote_id, score):
+            return
+
+        sampler = self.samplers.get(chat_id)
+        if sampler is not None:
+            sampler.set(quote_id, score)
+
+        snapshot = self.activity.get(chat_id)
+        if snapshot is not None:
+            snapshot.set_score(quote_id, score)
+
+    def _quote_removed(self, chat_id, quote_id):
+        if self._pass_on('_quote_removed', chat_id, quote_id):
+            return
+
+        sampler = self.samplers.get(chat_id)
+        if sampler is not None:
+            sampler.remove(quote_id)
+
+        bag = self.bags.get(chat_id)
+        if bag is not None:
+            bag.remove(quote_id)
+
+        snapshot = self.activity.get(chat_id)
+        if snapshot is not None:
+            snapshot.remove(quote_id)
+
+    # Activity methods
+
+    def get_activity(self, session, chat_id):
+        """Returns the chat's activity snapshot, loading it on first use.
+        Snapshots of chats this process doesn't own are loaded every time.
+        This requires NumPy."""
+        if not self.owns_chat(chat_id):
+            return self._load_activity(session, chat_id)
+
+        snapshot = self.activity.get(chat_id)
+
+        if snapshot is None:
+            with self.activity_lock:
+                snapshot = self.activity.get(chat_id)
+
+                if snapshot is None:
+                    snapshot = self._load_activity(session, chat_id)
+                    self.activity[chat_id] = snapshot
+
+        return snapshot
+
+    def _load_activity(self, session, chat_id):
+        rows = (session.query(
+                Quote.id,
+                cast(func.strftime('%s', Quote.sent_at), Integer),
+                func.coalesce(Quote.sent_by_id, 0),
+                func.coalesce(Quote.score, 0))
+            .filter(Quote.chat_id == chat_id,
+                Quote.deleted == False,
+                Quote.sent_at != None))
+
+        return ActivitySnapshot(rows.all())
 
     # Quote message methods
 
@@ -285,7 +1167,9 @@ class QuoteDatabase:
         chat = self.get_chat_by_id(session, chat_id)
         session.add(chat)
 
-        qm = QuoteMessage(chat=chat, message_id=message_id, quote=quote)
+        qm = QuoteMessage(
+            chat=chat, message_id=message_id, quote=quote,
+            sent_at=datetime.datetime.now())
         session.add(qm)
 
     def get_quote_id_from_message(self, session, chat_id, message_id):
@@ -300,6 +1184,70 @@ class QuoteDatabase:
         except NoResultFound:
             return None
 
+    def compact_quote_messages(self, max_age, batch_size=500, pause=0.1):
+        """Deletes quote messages older than max_age, in batches that are
+        committed separately so that the write lock is never held for long.
+        Returns the number of messages deleted.
+
+        The newest message of each quote is kept, so that every quote can
+        still be voted on from at least one message. Messages of deleted
+        quotes aren't needed for voting, and are all deleted."""
+        if max_age < self.MESSAGE_EDIT_WINDOW:
+            raise ValueError(
+                "quote messages must be kept for the message edit window")
+
+        cutoff = datetime.datetime.now() - max_age
+        after = deleted = 0
+
+        while True:
+            session = self.create_session()
+
+            try:
+                batch = (session.query(
+                        QuoteMessage.id, QuoteMessage.quote_id, Quote.deleted)
+                    .outerjoin(Quote, Quote.id == QuoteMessage.quote_id)
+                    .filter(QuoteMessage.id > after,
+                        QuoteMessage.sent_at < cutoff)
+                    .order_by(QuoteMessage.id)
+                    .limit(batch_size)
+                    .all())
+
+                if not batch:
+                    break
+
+                live = {quote_id for _, quote_id, quote_deleted in batch
+                    if quote_id is not None and not quote_deleted}
+
+                newest = set()
+
+                if live:
+                    newest.update(message_id for message_id, in
+                        session.query(func.max(QuoteMessage.id))
+                        .filter(QuoteMessage.quote_id.in_(live))
+                        .group_by(QuoteMessage.quote_id))
+
+                expired = [message_id for message_id, _, _ in batch
+                    if message_id not in newest]
+
+                if expired:
+                    session.query(QuoteMessage).filter(
+                        QuoteMessage.id.in_(expired)
+                    ).delete(synchronize_session=False)
+
+                session.commit()
+
+                after = batch[-1].id
+                deleted += len(expired)
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+            time.sleep(pause)
+
+        return deleted
+
     def get_quote_messages(self, session, quote_id):
         """Returns a list of all messages that refer to the given quote."""
         return (session.query(QuoteMessage)
@@ -319,16 +1267,48 @@ class QuoteDatabase:
         session.add(quote)
 
         vote = self.get_user_vote(session, user_id, quote_id)
+        previous = 0 if vote is None else vote.direction
+        previous_at = None if vote is None else vote.voted_at
+        now = datetime.datetime.now()
 
         if vote is None:
-            vote = Vote(user=user, quote=quote, direction=direction)
-            session.add(vote)
+            vote = Vote(user_id=user_id, quote_id=quote_id, direction=direction)
+
+            try:
+                with self.savepoint(session, Vote):
+                    session.add(vote)
+                    session.flush()
+            except IntegrityError:
+                # Another thread added the user's vote since it was read, so
+                # this changes that vote instead
+                return self.add_vote(session, user_id, quote_id, direction)
         elif vote.direction == direction:
             return self.ALREADY_VOTED
         else:
+            # Take back the previous vote with the weight it was cast with.
+            # Votes from before vote times were recorded count as recent
+            if previous:
+                quote.hotness = add_event(
+                    quote.hotness, vote.voted_at or now, -previous)
+
             vote.direction = direction
             session.add(vote)
 
+        vote.voted_at = now
+
+        if direction:
+            quote.hotness = add_event(quote.hotness, now, direction)
+
+        if not quote.deleted and self.tracks_daily_stats(session, quote_id):
+            # A changed vote is taken back from the day it was cast
+            self.add_daily_stats(
+                session, quote.chat_id, quote.sent_by_id,
+                self.vote_day(previous_at, quote),
+                upvotes=-int(previous == 1), downvotes=-int(previous == -1))
+            self.add_daily_stats(
+                session, quote.chat_id, quote.sent_by_id, now.date(),
+                upvotes=int(direction == 1), downvotes=int(direction == -1))
+
         _, score, _ = self.get_votes_by_id(session, quote_id)
         quote.score = score
 
@@ -336,6 +1316,8 @@ class QuoteDatabase:
             self.delete_quote(session, quote_id)
             return self.QUOTE_DELETED
         else:
+            self.on_commit(session, functools.partial(
+                self._quote_scored, quote.chat_id, quote_id, score))
             return self.VOTE_ADDED
 
     def get_votes(self, session, chat_id, message_id):
@@ -360,3 +1342,185 @@ class QuoteDatabase:
                 score -= 1
 
         return up, score, down
+
+    # Daily rollup methods
+
+    def _init_daily_stats(self):
+        """Records whether the daily rollups need a backfill. A new database
+        has nothing to backfill; an existing one is rolled up from its first
+        quote."""
+        with self.engine.begin() as connection:
+            state = connection.execute(select([State.value])
+                .where(State.key == self.DAILY_STATS_BACKFILL)).scalar()
+
+            if state is None:
+                state = '0' if self._has_quotes(connection) else 'done'
+
+                connection.execute(State.__table__.insert().values(
+                    key=self.DAILY_STATS_BACKFILL, value=state))
+
+        return state == 'done'
+
+    def _has_quotes(self, connection):
+        return connection.execute(select([Quote.id]).limit(1)).first() is not None
+
+    def tracks_daily_stats(self, session, quote_id):
+        """Returns whether changes to the quote should update the rollups.
+        While the backfill is running, quotes it hasn't reached yet are left to
+        the backfill, so that they're never counted twice."""
+        if self.daily_stats_ready:
+            return True
+
+        state = self.get_state(session, self.DAILY_STATS_BACKFILL)
+
+        if state == 'done':
+            self.daily_stats_ready = True
+            return True
+
+        return quote_id <= int(state)
+
+    def add_daily_stats(self, session, chat_id, user_id, day, **deltas):
+        """Adds the given amounts to a user's rollup for the day, creating the
+        row if needed."""
+        if user_id is None or not any(deltas.values()):
+            return
+
+        table = DailyStats.__table__
+
+        result = session.execute(table.update()
+            .where(and_(
+                table.c.chat_id == chat_id,
+                table.c.user_id == user_id,
+                table.c.day == day))
+            .values({table.c[name]: table.c[name] + delta
+                for name, delta in deltas.items()}))
+
+        if result.rowcount == 0:
+            session.execute(table.insert().values(
+                chat_id=chat_id, user_id=user_id, day=day, **deltas))
+
+    @staticmethod
+    def added_day(quote):
+        """Returns the day a quote counts toward in the rollups: the day it
+        was added, or the day its message was sent for quotes added before
+        that was recorded."""
+        return (quote.added_at or quote.sent_at).date()
+
+    def vote_day(self, voted_at, quote):
+        """Returns the day a vote counts toward in the rollups: the day it
+        was cast, or the day its quote was added for votes cast before that
+        was recorded."""
+        return self.added_day(quote) if voted_at is None else voted_at.date()
+
+    def get_votes_by_day(self, session, *criteria):
+        """Returns the upvotes and downvotes of the votes that match the
+        criteria, as (quote ID, day the votes were cast or None, upvotes,
+        downvotes) tuples."""
+        up = func.sum(case([(Vote.direction == 1, 1)], else_=0))
+        down = func.sum(case([(Vote.direction == -1, 1)], else_=0))
+        day = func.date(Vote.voted_at)
+
+        return [(quote_id,
+                None if day is None
+                else datetime.datetime.strptime(day, '%Y-%m-%d').date(),
+                up, down)
+            for quote_id, day, up, down in
+            session.query(Vote.quote_id, day, up, down)
+            .filter(*criteria)
+            .group_by(Vote.quote_id, day)]
+
+    def roll_up_quote(self, session, quote, sign):
+        """Adds (sign 1) or removes (sign -1) a quote from its sender's and
+        quoter's rollups, on the day it was added. Removing a quote also
+        removes its votes, from the days they were cast."""
+        day = self.added_day(quote)
+
+        self.add_daily_stats(
+            session, quote.chat_id, quote.sent_by_id, day, quotes_sent=sign)
+        self.add_daily_stats(
+            session, quote.chat_id, quote.quoted_by_id, day, quotes_added=sign)
+
+        # New quotes have no votes yet
+        if sign > 0:
+            return
+
+        for _, vote_day, up, down in self.get_votes_by_day(
+                session, Vote.quote_id == quote.id):
+            self.add_daily_stats(
+                session, quote.chat_id, quote.sent_by_id, vote_day or day,
+                upvotes=-up, downvotes=-down)
+
+    def backfill_daily_stats(self, batch_size=1000, pause=0.1):
+        """Rolls up existing quotes in batches of quote IDs, committing each
+        batch with the backfill's progress so that it can resume after a
+        restart and never holds the write lock for long. Returns the number of
+        quotes rolled up."""
+        processed = 0
+
+        while not self.daily_stats_ready:
+            session = self.create_session()
+
+            try:
+                state = self.get_state(session, self.DAILY_STATS_BACKFILL)
+
+                if state == 'done':
+                    self.daily_stats_ready = True
+                    break
+
+                after = int(state)
+
+                if after == 0:
+                    session.query(DailyStats).delete()
+
+                quotes = (session.query(Quote)
+                    .filter(Quote.id > after, Quote.deleted == False)
+                    .order_by(Quote.id)
+                    .limit(batch_size)
+                    .all())
+
+                if not quotes:
+                    self.set_state(session, self.DAILY_STATS_BACKFILL, 'done')
+                    session.commit()
+                    self.daily_stats_ready = True
+                    break
+
+                last = quotes[-1].id
+                by_id = {quote.id: quote for quote in quotes}
+
+                # Sum the batch per row first, to write each row once
+                rows = collections.defaultdict(collections.Counter)
+
+                for quote in quotes:
+                    day = self.added_day(quote)
+
+                    rows[quote.chat_id, quote.sent_by_id, day].update(
+                        quotes_sent=1)
+                    rows[quote.chat_id, quote.quoted_by_id, day].update(
+                        quotes_added=1)
+
+                for quote_id, day, up, down in self.get_votes_by_day(session,
+                        Vote.quote_id > after, Vote.quote_id <= last):
+                    quote = by_id.get(quote_id)
+
+                    # Votes of deleted quotes aren't counted
+                    if quote is not None:
+                        rows[quote.chat_id, quote.sent_by_id,
+                            day or self.added_day(quote)].update(
+                                upvotes=up, downvotes=down)
+
+                for (chat_id, user_id, day), deltas in rows.items():
+                    self.add_daily_stats(session, chat_id, user_id, day, **deltas)
+
+                self.set_state(session, self.DAILY_STATS_BACKFILL, str(last))
+                session.commit()
+
+                processed += len(quotes)
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+            time.sleep(pause)
+
+        return processed
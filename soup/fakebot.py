@@ -0,0 +1,315 @@
+"""A stand-in for the Telegram Bot API, for replaying and load testing the
+bot without sending anything: in process, or over HTTP for an Updater to
+poll."""
+
+import collections
+import email.parser
+import email.policy
+import http.server
+import itertools
+import json
+import math
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+TOKEN = '123456:fake'
+
+# Methods that count towards the limits on sending messages
+SEND_METHODS = {
+    'sendMessage', 'sendPhoto', 'editMessageText', 'editMessageReplyMarkup'}
+
+
+class RateLimits:
+    """Telegram's limits on sending messages, as sliding windows of (count,
+    seconds): in any one chat, in any one group, and in total. None turns a
+    limit off."""
+
+    def __init__(self, chat=(1, 1), group=(20, 60), total=(30, 1)):
+        self.chat = chat
+        self.group = group
+        self.total = total
+
+        # Times of recent messages in each window
+        self.sent = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+
+    def windows(self, chat_id):
+        if self.total:
+            yield 'total', self.total
+        if self.chat and chat_id is not None:
+            yield ('chat', chat_id), self.chat
+        if self.group and chat_id is not None and chat_id < 0:
+            yield ('group', chat_id), self.group
+
+    def check(self, chat_id, now=None):
+        """Records a message sent to a chat, or None for inline messages, and
+        returns 0. If that would break a limit, records nothing and returns
+        the seconds until it wouldn't."""
+        now = time.monotonic() if now is None else now
+        wait = 0
+
+        with self.lock:
+            windows = list(self.windows(chat_id))
+
+            for key, (count, seconds) in windows:
+                sent = self.sent[key]
+
+                while sent and sent[0] <= now - seconds:
+                    sent.popleft()
+
+                if len(sent) >= count:
+                    wait = max(wait, sent[0] + seconds - now)
+
+            if not wait:
+                for key, _ in windows:
+                    self.sent[key].append(now)
+
+        return wait
+
+
+class FakeBotAPI:
+    """Answers the Bot API methods the bot uses with plausible results, and
+    counts the calls made to each method.
+
+    Sent messages are numbered from first_message_id, which should be past
+    any message the bot's database already has. Updates given to push_update
+    are served by getUpdates. With limits, a RateLimits, sending too many
+    messages raises RetryAfter, and the calls rejected are counted by
+    method."""
+
+    def __init__(self, username='soup_bot', user_id=123456, limits=None,
+            first_message_id=1):
+        self.me = {
+            'id': user_id, 'is_bot': True, 'first_name': 'Soup Dumpling',
+            'username': username}
+        self.limits = limits
+
+        self.calls = collections.Counter()
+        self.rejected = collections.Counter()
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(first_message_id)
+
+        # Updates not yet confirmed by getUpdates
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.update_added = threading.Condition(self.lock)
+
+    def push_update(self, data):
+        """Queues an update for getUpdates, numbered after the ones before it.
+        Returns its update ID."""
+        with self.lock:
+            update_id = next(self.update_ids)
+            self.updates.append(dict(data, update_id=update_id))
+            self.update_added.notify_all()
+
+        return update_id
+
+    def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+
+        with self.lock:
+            # Updates before the offset have been confirmed
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+
+            if not self.updates and timeout:
+                self.update_added.wait_for(lambda: self.updates, timeout)
+
+            return self.updates[:limit]
+
+    def call(self, method, params):
+        with self.lock:
+            self.calls[method] += 1
+            message_id = next(self.message_ids)
+
+        if method in SEND_METHODS and self.limits is not None:
+            chat_id = params.get('chat_id')
+            wait = self.limits.check(None if chat_id is None else int(chat_id))
+
+            if wait:
+                with self.lock:
+                    self.rejected[method] += 1
+
+                # Telegram gives whole seconds
+                raise RetryAfter(math.ceil(wait))
+
+        if method == 'getMe':
+            return self.me
+
+        if method == 'getUpdates':
+            return self.get_updates(params)
+
+        if method in ('sendMessage', 'sendPhoto'):
+            return self.message(params, message_id)
+
+        if method in ('editMessageText', 'editMessageReplyMarkup'):
+            # Edits of inline messages return True
+            if 'chat_id' not in params:
+                return True
+
+            return self.message(params, int(params['message_id']))
+
+        return True
+
+    def message(self, params, message_id):
+        chat_id = int(params['chat_id'])
+
+        result = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {
+                'id': chat_id,
+                'type': 'private' if chat_id > 0 else 'supergroup'},
+            'from': self.me,
+        }
+
+        if 'text' in params:
+            result['text'] = params['text']
+
+        return result
+
+
+class FakeRequest:
+    """Stands in for telegram.utils.request.Request, answering every request
+    with a FakeBotAPI after the given latency in seconds."""
+
+    con_pool_size = 8
+
+    def __init__(self, api=None, latency=0):
+        self.api = api or FakeBotAPI()
+        self.latency = latency
+
+    def post(self, url, data, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+
+        return self.api.call(url.rsplit('/', 1)[-1], data or {})
+
+    def get(self, url, timeout=None):
+        return self.post(url, None, timeout=timeout)
+
+    def retrieve(self, url, timeout=None):
+        return b''
+
+    def download(self, url, filename, timeout=None):
+        pass
+
+    def stop(self):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections open, as the bot's connection pool expects
+    disable_nagle_algorithm = True
+    protocol_version = 'HTTP/1.1'
+
+    PATH = re.compile(r'^/bot[^/]+/(\w+)$')
+
+    def do_GET(self):
+        query = urllib.parse.urlsplit(self.path).query
+        self.respond(dict(urllib.parse.parse_qsl(query)))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.respond(parse_params(self.headers.get('Content-Type', ''), body))
+
+    def respond(self, params):
+        fake = self.server.fake
+        match = self.PATH.match(urllib.parse.urlsplit(self.path).path)
+
+        if match is None:
+            return self.send_json(404, {
+                'ok': False, 'error_code': 404, 'description': "Not Found"})
+
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        try:
+            result = fake.api.call(match.group(1), params)
+        except RetryAfter as e:
+            retry_after = int(e.retry_after)
+            self.send_json(429, {
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {retry_after}",
+                'parameters': {'retry_after': retry_after}})
+        else:
+            self.send_json(200, {'ok': True, 'result': result})
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_params(content_type, body):
+    """Returns the parameters of a Bot API request sent as JSON, a form, or a
+    multipart upload. Uploaded files are left out."""
+    if content_type.startswith('application/json'):
+        return json.loads(body.decode() or '{}')
+
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+
+        return {part.get_param('name', header='content-disposition'):
+                part.get_content()
+            for part in message.iter_parts() if not part.get_filename()}
+
+    return dict(urllib.parse.parse_qsl(body.decode()))
+
+
+class FakeBotServer:
+    """Serves a FakeBotAPI over HTTP on a local port, taking latency seconds
+    to answer each request. Point an Updater at it with base_url=server.url to
+    run the bot's polling and requests end to end."""
+
+    def __init__(self, api=None, host='127.0.0.1', port=0, latency=0):
+        self.api = api or FakeBotAPI()
+        self.latency = latency
+
+        self.server = _Server((host, port), _RequestHandler)
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name='fakebot', daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def create_bot(api=None, latency=0):
+    """Returns a Bot whose requests are answered by a FakeBotAPI."""
+    request = FakeRequest(api, latency=latency)
+    bot = Bot(TOKEN, request=request)
+    bot.get_me()
+
+    return bot
@@ -1,14 +1,16 @@
 from .direct import dm_only_handler_cancel, dm_only_handler_select, dm_only_handler_which, start_handlers, SELECT_CHAT, SELECTED_CHAT
 from .group import handler_addquote, handler_addqoute, handler_madquote, handler_sadquote
 from .meta import handler_about, handler_database, handler_group_migration, handler_help, handler_help_group, handler_user_left
-from .quotes import handler_random, handler_search, handler_vote
-from .stats import handler_hi_scores, handler_lo_scores, handler_most_added, handler_most_quoted, handler_scores, handler_stats
+from .quotes import handler_random, handler_random_mode, handler_search, handler_search_all, handler_vote
+from .stats import handler_activity, handler_hi_scores, handler_lo_scores, handler_most_added, handler_most_quoted, handler_scores, handler_stats, handler_trending
 
 from .quotes import dm_handler_random, dm_handler_search
-from .stats import dm_handler_hi_scores, dm_handler_lo_scores, dm_handler_most_added, dm_handler_most_quoted, dm_handler_scores, dm_handler_stats
+from .stats import dm_handler_activity, dm_handler_hi_scores, dm_handler_lo_scores, dm_handler_most_added, dm_handler_most_quoted, dm_handler_scores, dm_handler_stats, dm_handler_trending
 
 from telegram.ext import ConversationHandler
 
+from soup.router import Router
+
 _all = globals()
 dm_handlers = [v for k, v in _all.items() if k.startswith('dm_handler')]
 
@@ -22,5 +24,14 @@ _dm_handler = ConversationHandler(
     allow_reentry=True
 )
 
-handlers = [v for k, v in _all.items() if k.startswith('handler')]
+# Its state is kept in the database by soup.conversations
+conversation_handler = _dm_handler
+
+# Run for every update, before the routed handlers
+side_handlers = [handler_database]
+
+handlers = [v for k, v in _all.items()
+    if k.startswith('handler') and v not in side_handlers]
 handlers += [_dm_handler]
+
+router = Router(handlers, private=[_dm_handler])
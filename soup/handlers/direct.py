@@ -25,7 +25,7 @@ dm_only_handler_cancel = CommandHandler('cancel', handle_cancel, **dm_kwargs)
 def handle_start(bot, update, user_data, session=None):
     user_id = update.message.from_user.id
 
-    chats = database.get_user_chats(session, user_id)
+    chats = database.get_user_chat_titles(session, user_id)
 
     if not chats:
         response = "<b>Chat selection</b>\nno chats found"
@@ -39,16 +39,16 @@ def handle_start(bot, update, user_data, session=None):
     ]
 
     mapping = []
-    for i, chat in enumerate(chats):
-        response.append("<b>[{0}]</b> {1}".format(i, escape(chat.title)))
-        mapping.append([i, chat.id, chat.title])
+    for i, (chat_id, title) in enumerate(chats):
+        response.append("<b>[{0}]</b> {1}".format(i, escape(title)))
+        mapping.append([i, chat_id, title])
 
     user_data['choices'] = mapping
     response = '\n'.join(response)
 
     if len(chats) < 6:
         # Use a reply keyboard
-        titles = [chat.title for chat in chats]
+        titles = [title for _, title in chats]
         reply_keyboard = list(chunks(titles, 2))
         markup = ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, resize_keyboard=True)
@@ -88,6 +88,9 @@ def handle_select_chat(bot, update, user_data):
 
     user_data['current'] = selected_id
 
+    # The choices are only needed until one is made
+    del user_data['choices']
+
     response = 'selected chat "{0}"'.format(title)
     update.message.reply_text(response, reply_markup=ReplyKeyboardRemove())
 
@@ -98,8 +101,9 @@ dm_only_handler_select = MessageHandler(
     Filters.text | Filters.command, handle_select_chat, pass_user_data=True)
 
 
-def handle_which(bot, update, user_data):
-    chat = database.get_chat_by_id(user_data['current'])
+@session_wrapper
+def handle_which(bot, update, user_data, session=None):
+    chat = database.get_chat_by_id(session, user_data['current'])
 
     response = 'searching quotes from "{0}"'.format(escape(chat.title))
     update.message.reply_text(response)
@@ -1,6 +1,8 @@
 from telegram.ext import CommandHandler, Filters
 
 from soup.core import database, username, session_wrapper
+from soup.outbox import when_sent
+from soup.utils import remember_message
 
 
 LOUDLY_CRYING_FACE = '\U0001F62D'
@@ -88,9 +90,8 @@ def handle_addquote(bot, update, word='quote', emoji=None, session=None):
         raise RuntimeError
 
     response = format_response(response, emoji)
-    message = update.message.reply_text(response)
-
-    database.add_message(session, message.chat_id, message.message_id, quote)
+    when_sent(update.message.reply_text(response),
+        remember_message(chat_id, quote.id), session)
 
 
 def handle_addqoute(bot, update):
@@ -1,10 +1,12 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, TelegramError
+from telegram.error import BadRequest
 from telegram.ext import CallbackQueryHandler, CommandHandler, Filters
 
-from soup.core import (
-    database, TRUNCATE_ARGS_LENGTH, session_wrapper)
-from soup.utils import send_quote
-from soup.handlers.search_tags import create_tag, PATTERN
+from soup.core import database, session_wrapper
+from soup.outbox import request_ignoring, when_sent
+from soup.utils import remember_message, send_quote
+from soup.handlers.search_tags import create_tag
+from soup.search import parse_search, SearchSyntaxError
 
 dm_kwargs = {
     'filters': Filters.private,
@@ -44,6 +46,16 @@ def create_vote_buttons(user_id, quote_id, direct=False, session=None):
     return keyboard
 
 
+def can_not_edit(error):
+    # The message is over 48 hours old, or was deleted
+    return isinstance(error, TelegramError)
+
+
+def not_modified(error):
+    # The buttons already show the votes, such as after two quick clicks
+    return isinstance(error, BadRequest) and 'not modified' in str(error)
+
+
 @session_wrapper
 def handle_vote(bot, update, user_data, session=None):
     query = update.callback_query
@@ -59,7 +71,10 @@ def handle_vote(bot, update, user_data, session=None):
     direct = current_chat_id == user.id
 
     if direct:
-        quote_chat_id = user_data['current']
+        # Quotes from /searchall can be from any chat the user is in
+        results = user_data.get('search_results', {})
+        quote_chat_id = results.get(
+            quote_message.message_id, user_data.get('current'))
     else:
         quote_chat_id = current_chat_id
 
@@ -94,13 +109,10 @@ def handle_vote(bot, update, user_data, session=None):
         query.answer(response)
 
         for qm in database.get_quote_messages(session, quote_id):
-            try:
-                bot.edit_message_text(
-                    chat_id=qm.chat_id, message_id=qm.message_id,
-                    text="[quote was deleted]", reply_markup=[])
-            except TelegramError:
-                # The message is over 48 hours old and can't be edited
-                pass
+            request_ignoring(
+                can_not_edit, bot.edit_message_text,
+                chat_id=qm.chat_id, message_id=qm.message_id,
+                text="[quote was deleted]", reply_markup=[])
 
         return
 
@@ -109,7 +121,8 @@ def handle_vote(bot, update, user_data, session=None):
     keyboard = create_vote_buttons(
         user.id, quote_id, direct=direct, session=session)
 
-    bot.edit_message_reply_markup(
+    request_ignoring(
+        not_modified, bot.edit_message_reply_markup,
         chat_id=current_chat_id, message_id=quote_message.message_id,
         reply_markup=keyboard)
 
@@ -133,50 +146,60 @@ def handle_random(bot, update, user_data=None, session=None):
         buttons = create_vote_buttons(
             user.id, quote.id, direct=user_data is not None, session=session)
 
-        message = send_quote(update, quote, sent_by, buttons)
-        database.add_message(session, chat_id, message.message_id, quote)
+        when_sent(send_quote(update, quote, sent_by, buttons),
+            remember_message(chat_id, quote.id), session)
 
 
 handler_random = CommandHandler('random', handle_random, filters=Filters.group)
 dm_handler_random = CommandHandler('random', handle_random, **dm_kwargs)
 
 
+RANDOM_MODES = {
+    'uniform': "every quote is equally likely",
+    'weighted': "quotes with higher scores are more likely",
+}
+
+
 @session_wrapper
-def handle_search(bot, update, args=list(), user_data=None, session=None):
-    if user_data is None:
-        chat_id = update.message.chat_id
-    else:
-        chat_id = user_data['current']
+def handle_random_mode(bot, update, args=None, session=None):
+    chat_id = update.message.chat_id
+    chat = database.get_chat_by_id(session, chat_id)
 
     if not args:
-        return
+        mode = chat.random_mode or 'uniform'
+        response = f"random mode is {mode}: {RANDOM_MODES[mode]}"
+        return update.message.reply_text(response)
+
+    mode = args[0].lower()
+
+    if mode not in RANDOM_MODES:
+        options = ', '.join(RANDOM_MODES)
+        return update.message.reply_text(f"random mode must be one of: {options}")
 
-    terms, tags = [], []
+    database.set_random_mode(session, chat_id, mode)
+    update.message.reply_text(f"random mode set to {mode}: {RANDOM_MODES[mode]}")
 
-    for item in args:
-        match = PATTERN.search(item)
 
-        # Tags
-        if match is not None:
-            groups = match.groups()
+handler_random_mode = CommandHandler(
+    'random_mode', handle_random_mode, filters=Filters.group, pass_args=True)
 
-            if len(groups) == 2:
-                name, value = groups
-                cmp = None
-            elif len(groups) == 3:
-                name, cmp, value = groups
 
-            tag = create_tag(name, value, cmp=cmp)
-            tags.append(tag)
-        # Search terms
-        else:
-            terms.append(item)
+@session_wrapper
+def handle_search(bot, update, args=list(), user_data=None, session=None):
+    if user_data is None:
+        chat_id = update.message.chat_id
+    else:
+        chat_id = user_data['current']
+
+    try:
+        expression = parse_search(' '.join(args), create_tag)
+    except SearchSyntaxError as e:
+        return update.message.reply_text(f"invalid search: {e}")
 
-    terms = ' '.join(terms)
-    quote, sent_by = database.search_quote(session, chat_id, terms, tags)
+    if expression is None:
+        return
 
-    if len(args) > TRUNCATE_ARGS_LENGTH:
-        args = args[:TRUNCATE_ARGS_LENGTH] + '...'
+    quote, sent_by = database.search_quote(session, chat_id, expression)
 
     from_user = update.message.from_user
 
@@ -186,11 +209,55 @@ def handle_search(bot, update, args=list(), user_data=None, session=None):
         buttons = create_vote_buttons(
             from_user.id, quote.id, direct=user_data is not None, session=session)
 
-        message = send_quote(update, quote, sent_by, buttons)
-        database.add_message(session, chat_id, message.message_id, quote)
+        when_sent(send_quote(update, quote, sent_by, buttons),
+            remember_message(chat_id, quote.id), session)
 
 
 handler_search = CommandHandler(
     'search', handle_search, filters=Filters.group, pass_args=True)
 dm_handler_search = CommandHandler(
     'search', handle_search, pass_args=True, **dm_kwargs)
+
+
+# The number of /searchall results per user that can be voted on
+MAX_SEARCH_RESULTS = 50
+
+
+@session_wrapper
+def handle_search_all(bot, update, args=list(), user_data=None, session=None):
+    try:
+        expression = parse_search(' '.join(args), create_tag)
+    except SearchSyntaxError as e:
+        return update.message.reply_text(f"invalid search: {e}")
+
+    if expression is None:
+        return
+
+    from_user = update.message.from_user
+    quote, sent_by = database.search_member_quote(
+        session, from_user.id, expression)
+
+    if quote is None:
+        return update.message.reply_text("no quotes found")
+
+    buttons = create_vote_buttons(
+        from_user.id, quote.id, direct=True, session=session)
+
+    def remember_result(message):
+        # Remember which chat the result is from, for votes on it
+        results = user_data.setdefault('search_results', {})
+        results[message.message_id] = quote_chat_id
+
+        while len(results) > MAX_SEARCH_RESULTS:
+            del results[next(iter(results))]
+
+    quote_chat_id = quote.chat_id
+    when_sent(
+        send_quote(update, quote, sent_by, buttons, source=quote.chat.title),
+        remember_message(quote_chat_id, quote.id, then=remember_result),
+        session)
+
+
+# Works whether or not a chat has been selected
+handler_search_all = CommandHandler(
+    'searchall', handle_search_all, pass_args=True, **dm_kwargs)
@@ -1,15 +1,45 @@
 import datetime
+import operator
 import re
 
-from soup.classes import Quote, User
+from sqlalchemy import and_, bindparam, func
+
+from soup.classes import Quote
+from soup.search import Quoter, Sender
+
+
+COMPARATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '=': operator.eq,
+    '>=': operator.ge,
+    '>': operator.gt,
+}
 
 
 class Tag:
     value = None
 
-    def apply_filter(self, query):
+    # The user role this tag filters on: 'sender', 'quoter' or None
+    role = None
+
+    # Tags with lower priorities are filtered first
+    priority = 50
+
+    @property
+    def shape(self):
+        """Identifies the SQL this tag compiles to, regardless of its value."""
+        return (self.__class__.__name__,)
+
+    def criterion(self, param):
+        """Returns the filter for this tag, with its value bound to the
+        parameter with the given name."""
         raise NotImplementedError
 
+    def params(self, param):
+        """Returns the values to bind to this tag's criterion."""
+        return {param: self.value}
+
     def __str__(self):
         return f"<{self.__class__.__name__}: {self.value}>"
 
@@ -17,75 +47,166 @@ class Tag:
         return str(self)
 
 
-class AuthorTag(Tag):
+class SubstringTag(Tag):
+    priority = 80
+
     def __init__(self, value=None):
         self.value = value.lower()
 
-    def apply_filter(self, query):
-        return (query.join(User, Quote.sent_by_id == User.id)
-            .filter(User.first_name.ilike(f'%{self.value}%')
-                    | User.last_name.ilike(f'%{self.value}%')))
+    def params(self, param):
+        return {param: f'%{self.value}%'}
 
 
-class UsernameTag(Tag):
-    def __init__(self, value=None):
-        self.value = value.lower()
+class AuthorTag(SubstringTag):
+    role = 'sender'
 
-    def apply_filter(self, query):
-        return (query.join(User, Quote.sent_by_id == User.id)
-            .filter(User.username.ilike(f'%{self.value}%')))
+    def criterion(self, param):
+        # Missing names are blank, so negated searches still match them
+        return (Sender.first_name.ilike(bindparam(param))
+                | func.coalesce(Sender.last_name, '').ilike(bindparam(param)))
 
 
-class QuotedByTag(Tag):
-    def __init__(self, value=None):
-        self.value = value.lower()
+class UsernameTag(SubstringTag):
+    role = 'sender'
+
+    def criterion(self, param):
+        return func.coalesce(Sender.username, '').ilike(bindparam(param))
+
+
+class QuotedByTag(SubstringTag):
+    role = 'quoter'
+
+    def criterion(self, param):
+        return func.coalesce(Quoter.username, '').ilike(bindparam(param))
+
+
+class PeriodTag(Tag):
+    """Matches quotes sent during a period, or before or after it when used
+    with a comparator. All periods compile to a half-open range on
+    Quote.sent_at."""
+    priority = 10
+    format = None
+
+    def __init__(self, value=None, cmp='='):
+        start = datetime.datetime.strptime(value, self.format)
+        end = self.period_end(start)
+
+        self.value = value
+        self.cmp = cmp
+
+        if cmp == '=':
+            self.start, self.end = start, end
+        elif cmp == '<':
+            self.start, self.end = None, start
+        elif cmp == '<=':
+            self.start, self.end = None, end
+        elif cmp == '>=':
+            self.start, self.end = start, None
+        elif cmp == '>':
+            self.start, self.end = end, None
+
+    def period_end(self, start):
+        raise NotImplementedError
+
+    @property
+    def shape(self):
+        # Every period compiles to the same SQL, so they share statements
+        return ('SentAt', self.start is not None, self.end is not None)
+
+    def criterion(self, param):
+        criteria = []
+
+        if self.start is not None:
+            criteria.append(Quote.sent_at >= bindparam(f'{param}_start'))
+        if self.end is not None:
+            criteria.append(Quote.sent_at < bindparam(f'{param}_end'))
+
+        return and_(*criteria)
+
+    def params(self, param):
+        params = {}
+
+        if self.start is not None:
+            params[f'{param}_start'] = self.start
+        if self.end is not None:
+            params[f'{param}_end'] = self.end
+
+        return params
+
+
+class DateTag(PeriodTag):
+    format = '%Y-%m-%d'
+
+    def period_end(self, start):
+        return start + datetime.timedelta(days=1)
+
+
+class MonthTag(PeriodTag):
+    format = '%Y-%m'
 
-    def apply_filter(self, query):
-        return (query.join(User, Quote.quoted_by_id == User.id)
-            .filter(User.username.ilike(f'%{self.value}%')))
+    def period_end(self, start):
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
 
 
-class DateTag(Tag):
+class YearTag(PeriodTag):
+    format = '%Y'
+
+    def period_end(self, start):
+        return start.replace(year=start.year + 1)
+
+
+class SinceTag(PeriodTag):
+    """Matches quotes sent within a relative amount of time, e.g. 12h, 30d,
+    2w or 1y."""
+    UNITS = {
+        'h': datetime.timedelta(hours=1),
+        'd': datetime.timedelta(days=1),
+        'w': datetime.timedelta(weeks=1),
+        'y': datetime.timedelta(days=365),
+    }
+
     def __init__(self, value=None):
-        try:
-            self.day = datetime.datetime.strptime(value, '%Y-%m-%d')
-            self.next_day = self.day + datetime.timedelta(days=1)
-        except ValueError as e:
-            raise e
+        match = re.match(r'^(\d+)([hdwy])$', value)
+
+        if match is None:
+            raise ValueError("Invalid relative time")
+
+        amount, unit = match.groups()
 
-    def apply_filter(self, query):
-        return query.filter(
-            Quote.sent_at >= self.day,
-            Quote.sent_at < self.next_day)
+        self.value = value
+        self.cmp = '>='
+        self.start = datetime.datetime.now() - int(amount) * self.UNITS[unit]
+        self.end = None
 
 
 class ScoreTag(Tag):
+    priority = 30
+
     def __init__(self, value=None, cmp='='):
         self.value = int(value)
         self.cmp = cmp
 
-    def apply_filter(self, query):
-        if self.cmp == '<':
-            return query.filter(Quote.score < self.value)
-        elif self.cmp == '<=':
-            return query.filter(Quote.score <= self.value)
-        elif self.cmp == '>=':
-            return query.filter(Quote.score >= self.value)
-        elif self.cmp == '>':
-            return query.filter(Quote.score > self.value)
-        else:
-            return query.filter(Quote.score == self.value)
+    @property
+    def shape(self):
+        return (self.__class__.__name__, self.cmp)
+
+    def criterion(self, param):
+        return COMPARATORS[self.cmp](Quote.score, bindparam(param))
 
 
 class TypeTag(Tag):
+    priority = 20
+
     def __init__(self, value=None):
         if value not in ('text', 'photo'):
             raise ValueError
 
         self.value = value
 
-    def apply_filter(self, query):
-        return query.filter(Quote.message_type == self.value)
+    def criterion(self, param):
+        return Quote.message_type == bindparam(param)
 
 
 TAGS = {
@@ -94,6 +215,9 @@ TAGS = {
     'u': UsernameTag,
     'quoted_by': QuotedByTag,
     'date': DateTag,
+    'month': MonthTag,
+    'year': YearTag,
+    'since': SinceTag,
     'score': ScoreTag,
     'type': TypeTag,
 }
@@ -116,5 +240,3 @@ def create_tag(name, value, cmp=None):
 
     return tag(value=value)
 
-
-PATTERN = re.compile(r'^([-\w]+):(<|<=|>=|>)?([-\w]+)$')
@@ -1,8 +1,11 @@
+import datetime
 import functools
 from html import escape
 from telegram.ext import CommandHandler, Filters
 
+from soup import activity
 from soup.core import database, TIME_FORMAT, session_wrapper
+from soup.hotness import decayed_score
 from soup.utils import format_users
 from soup.handlers.quotes import dm_kwargs
 
@@ -21,6 +24,31 @@ def parse_limit(args, default=15):
     return limit if limit > 0 else default
 
 
+# Time windows for leaderboards: (number of days, description)
+WINDOWS = {
+    'today': (1, 'today'),
+    'week': (7, 'past week'),
+    'month': (30, 'past month'),
+}
+
+
+def parse_window(args):
+    """Removes a time window such as "week" from the arguments. Returns the
+    first day of the window, or None for all time, its description, and the
+    remaining arguments."""
+    args = list(args or [])
+
+    for arg in args:
+        if arg.lower() in WINDOWS:
+            days, description = WINDOWS[arg.lower()]
+            args.remove(arg)
+
+            since = datetime.date.today() - datetime.timedelta(days=days - 1)
+            return since, f" ({description})", args
+
+    return None, "", args
+
+
 @session_wrapper
 def handle_stats(bot, update, args=None, user_data=None, general=True,
         quoted=True, added=True, session=None):
@@ -30,38 +58,37 @@ def handle_stats(bot, update, args=None, user_data=None, general=True,
     else:
         chat_id = user_data['current']
 
+    since, window, args = parse_window(args)
     limit = parse_limit(args, default=5)
     response = list()
 
-    total_count = database.get_quote_count(session, chat_id)
+    total_count, most_quoted, most_added = database.get_chat_stats(
+        session, chat_id, limit=limit, since=since)
 
     if not total_count:
-        return update.message.reply_text("no quotes in database")
+        return update.message.reply_text(
+            "no quotes in database" if since is None
+            else f"no quotes{window}")
 
     if general:
         # Total quotes
-        response.append("<b>Overall</b>")
+        response.append(f"<b>Overall{window}</b>")
         response.append("• {0} total quotes".format(total_count))
 
     if quoted:
-        most_quoted = database.get_most_quoted(session, chat_id, limit=limit)
-
-        response.append("<b>Users with the most quotes</b>")
+        response.append(f"<b>Users with the most quotes{window}</b>")
         response.extend(format_users(most_quoted, total_count))
         response.append("")
 
     if added:
-        most_added = database.get_most_quotes_added(
-            session, chat_id, limit=limit)
-
-        response.append("<b>Users who add the most quotes</b>")
+        response.append(f"<b>Users who add the most quotes{window}</b>")
         response.extend(format_users(most_added, total_count))
 
     update.message.reply_text('\n'.join(response).rstrip(), parse_mode='HTML')
 
 
 handler_stats = CommandHandler(
-    'stats', handle_stats, filters=Filters.group)
+    'stats', handle_stats, filters=Filters.group, pass_args=True)
 dm_handler_stats = CommandHandler(
     'stats', handle_stats, pass_args=True, **dm_kwargs)
 
@@ -70,7 +97,7 @@ handle_most_quoted = functools.partial(
     handle_stats, general=False, quoted=True, added=False)
 
 handler_most_quoted = CommandHandler(
-    'most_quoted', handle_most_quoted, filters=Filters.group)
+    'most_quoted', handle_most_quoted, filters=Filters.group, pass_args=True)
 dm_handler_most_quoted = CommandHandler(
     'most_quoted', handle_most_quoted, pass_args=True, **dm_kwargs)
 
@@ -79,7 +106,7 @@ handle_most_added = functools.partial(
     handle_stats, general=False, quoted=False, added=True)
 
 handler_most_added = CommandHandler(
-    'most_added', handle_most_added, filters=Filters.group)
+    'most_added', handle_most_added, filters=Filters.group, pass_args=True)
 dm_handler_most_added = CommandHandler(
     'most_added', handle_most_added, pass_args=True, **dm_kwargs)
 
@@ -103,14 +130,15 @@ def handle_scores(bot, update, args=None, user_data=None, high=True, low=True,
     else:
         chat_id = user_data['current']
 
+    since, window, args = parse_window(args)
     limit = parse_limit(args, default=5)
     response = []
 
     if high:
         high_scores = database.get_highest_scoring(
-            session, chat_id, limit=limit)
+            session, chat_id, limit=limit, since=since)
 
-        response.append("<b>Users with the highest scores</b>")
+        response.append(f"<b>Users with the highest scores{window}</b>")
         response.extend(format_user_scores(high_scores))
 
     if high and low:
@@ -118,16 +146,16 @@ def handle_scores(bot, update, args=None, user_data=None, high=True, low=True,
 
     if low:
         low_scores = database.get_lowest_scoring(
-            session, chat_id, limit=limit)
+            session, chat_id, limit=limit, since=since)
 
-        response.append("<b>Users with the lowest scores</b>")
+        response.append(f"<b>Users with the lowest scores{window}</b>")
         response.extend(format_user_scores(low_scores))
 
     update.message.reply_text('\n'.join(response), parse_mode='HTML')
 
 
 handler_scores = CommandHandler(
-    'scores', handle_scores, filters=Filters.group)
+    'scores', handle_scores, filters=Filters.group, pass_args=True)
 dm_handler_scores = CommandHandler(
     'scores', handle_scores, pass_args=True, **dm_kwargs)
 
@@ -135,7 +163,7 @@ dm_handler_scores = CommandHandler(
 handle_hi_scores = functools.partial(handle_scores, high=True, low=False)
 
 handler_hi_scores = CommandHandler(
-    'hi_scores', handle_hi_scores, filters=Filters.group)
+    'hi_scores', handle_hi_scores, filters=Filters.group, pass_args=True)
 dm_handler_hi_scores = CommandHandler(
     'hi_scores', handle_hi_scores, pass_args=True, **dm_kwargs)
 
@@ -143,6 +171,100 @@ dm_handler_hi_scores = CommandHandler(
 handle_lo_scores = functools.partial(handle_scores, high=False, low=True)
 
 handler_lo_scores = CommandHandler(
-    'lo_scores', handle_lo_scores, filters=Filters.group)
+    'lo_scores', handle_lo_scores, filters=Filters.group, pass_args=True)
 dm_handler_lo_scores = CommandHandler(
     'lo_scores', handle_lo_scores, pass_args=True, **dm_kwargs)
+
+
+# Characters of each quote shown in /trending
+TRENDING_PREVIEW_LENGTH = 80
+
+
+def format_trending(quotes, now):
+    lines = []
+
+    for i, quote in enumerate(quotes, 1):
+        text = quote.content or "[photo]"
+
+        if len(text) > TRENDING_PREVIEW_LENGTH:
+            text = text[:TRENDING_PREVIEW_LENGTH].rstrip() + "..."
+
+        name = quote.sent_by.first_name if quote.sent_by else "unknown"
+        heat = decayed_score(quote.hotness, now)
+
+        lines.append(escape(f"{i}. \"{text}\" - {name} ({heat:.1f})"))
+
+    return lines
+
+
+@session_wrapper
+def handle_trending(bot, update, args=None, user_data=None, session=None):
+    if user_data is None:
+        chat_id = update.message.chat_id
+    else:
+        chat_id = user_data['current']
+
+    limit = min(parse_limit(args, default=5), 10)
+    quotes = database.get_trending_quotes(session, chat_id, limit=limit)
+
+    if not quotes:
+        return update.message.reply_text("no trending quotes")
+
+    response = ["<b>Trending quotes</b>"]
+    response.extend(format_trending(quotes, datetime.datetime.now()))
+
+    update.message.reply_text('\n'.join(response), parse_mode='HTML')
+
+
+handler_trending = CommandHandler(
+    'trending', handle_trending, filters=Filters.group, pass_args=True)
+dm_handler_trending = CommandHandler(
+    'trending', handle_trending, pass_args=True, **dm_kwargs)
+
+
+@session_wrapper
+def handle_activity(bot, update, args=None, user_data=None, session=None):
+    if activity.numpy is None:
+        return update.message.reply_text("activity stats need NumPy installed")
+
+    if user_data is None:
+        chat_id = update.message.chat_id
+    else:
+        chat_id = user_data['current']
+
+    # "/activity me" only counts the caller's quotes
+    mine = bool(args) and args[0].lower() == 'me'
+    sender_id = update.message.from_user.id if mine else None
+
+    # Responses are kept on the chat's snapshot, and go with it
+    snapshot = database.get_activity(session, chat_id)
+    response = snapshot.derive(('activity', sender_id),
+        functools.partial(render_activity, snapshot, sender_id))
+
+    update.message.reply_text(response, parse_mode='HTML')
+
+
+def render_activity(snapshot, sender_id=None):
+    trend = snapshot.monthly(sender_id)
+
+    if trend is None:
+        return "no quotes in database"
+
+    heatmap, peak = activity.render_heatmap(snapshot.heatmap(sender_id))
+
+    response = [
+        "<b>Quotes by weekday and hour</b>",
+        f"<code>{escape(heatmap)}</code>",
+        escape(peak),
+        "",
+        "<b>Quotes per month</b>",
+        f"<code>{escape(activity.render_trend(*trend))}</code>",
+    ]
+
+    return '\n'.join(response)
+
+
+handler_activity = CommandHandler(
+    'activity', handle_activity, filters=Filters.group, pass_args=True)
+dm_handler_activity = CommandHandler(
+    'activity', handle_activity, pass_args=True, **dm_kwargs)
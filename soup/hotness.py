@@ -0,0 +1,48 @@
+import datetime
+import math
+
+# A vote counts half as much after this long
+HALF_LIFE = datetime.timedelta(days=3)
+
+# Exponents are measured from here, to keep them small
+EPOCH = datetime.datetime(2019, 1, 1)
+
+
+def exponent(when):
+    """Returns the log of an event's weight at the given time. Instead of
+    decaying every quote's votes as time passes, newer votes get exponentially
+    larger weights. Comparing quotes gives the same order either way, and
+    stored hotness never needs recomputing."""
+    seconds = (when.replace(tzinfo=None) - EPOCH).total_seconds()
+    return seconds * math.log(2) / HALF_LIFE.total_seconds()
+
+
+def add_event(hotness, when, direction):
+    """Returns the hotness after adding an upvote (direction 1) or removing
+    one (direction -1) at the given time.
+
+    Hotness is the log of the weighted sum of events, or None for a sum of
+    zero. Downvotes can take the sum down to zero, but not below it."""
+    x = exponent(when)
+
+    if direction > 0:
+        if hotness is None:
+            return x
+
+        # log(e^a + e^b), without overflowing
+        high, low = max(hotness, x), min(hotness, x)
+        return high + math.log1p(math.exp(low - high))
+
+    if hotness is None or hotness <= x:
+        return None
+
+    # log(e^a - e^b) for a > b
+    return hotness + math.log1p(-math.exp(x - hotness))
+
+
+def decayed_score(hotness, now):
+    """Returns the sum of a quote's events, each decayed by its age."""
+    if hotness is None:
+        return 0.0
+
+    return math.exp(hotness - exponent(now))
@@ -0,0 +1,141 @@
+"""Maintenance jobs for the bot's database. They can run while the bot is
+running.
+
+    python -m soup.maintenance [--database data.db] sync-members -- CHAT_ID [FILE]
+    python -m soup.maintenance [--database data.db] compact-messages [--days 30]
+    python -m soup.maintenance [--database data.db] archive-quotes
+    python -m soup.maintenance [--database data.db] backup [--directory backups] [--keep 7]
+
+With --shards DIRECTORY, the database is a catalog with each chat's quotes
+in a file of its own in DIRECTORY (see soup.shards).
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+
+from soup.backup import backup, format_report
+from soup.database import QuoteDatabase
+from soup.shards import ShardedQuoteDatabase
+
+# Where the report of the last backup is kept, in the state table
+LAST_BACKUP = 'last_backup'
+
+
+def sync_members(db, args):
+    """Replaces a chat's member list with the user IDs in a file, one per
+    line."""
+    user_ids = [int(line) for line in args.file if line.strip()]
+
+    with db.session_scope() as session:
+        result = db.sync_memberships(session, args.chat_id, user_ids)
+
+    print(f"added {result.added}, removed {result.removed}, "
+          f"kept {result.kept}, skipped {result.unknown} unknown users")
+
+
+def format_size(rows, size):
+    if size is None:
+        return f"{rows} rows"
+
+    return f"{rows} rows, {size / 1024:.0f} KiB"
+
+
+def compact_quote_messages(db, max_age):
+    """Deletes old quote messages, and returns a report of the table's size
+    before and after."""
+    before = db.table_size('quote_message')
+    deleted = db.compact_quote_messages(max_age)
+    after = db.table_size('quote_message')
+
+    return (f"deleted {deleted} quote messages older than {max_age.days} days: "
+            f"{format_size(*before)} before, {format_size(*after)} after")
+
+
+def compact_messages(db, args):
+    """Deletes quote messages that are no longer needed."""
+    print(compact_quote_messages(db, datetime.timedelta(days=args.days)))
+
+
+def archive_deleted_quotes(db):
+    """Archives deleted quotes, and returns a report of the quote table's
+    size before and after."""
+    before = db.table_size('quote')
+    archived = db.archive_deleted_quotes()
+    after = db.table_size('quote')
+
+    return (f"archived {archived} deleted quotes: "
+            f"{format_size(*before)} before, {format_size(*after)} after")
+
+
+def archive_quotes(db, args):
+    """Moves deleted quotes, their votes and messages to archive tables."""
+    print(archive_deleted_quotes(db))
+
+
+def backup_database(db, directory, keep):
+    """Takes a compressed snapshot of the database and rotates old ones.
+    The report is saved in the state table and returned as text. The files
+    of a sharded database's chats are backed up in a shards directory
+    inside the given one."""
+    report = backup(db.filename, directory, keep=keep)
+    shards = db.files()[1:]
+
+    for filename in shards:
+        backup(filename, os.path.join(directory, 'shards'), keep=keep)
+
+    with db.session_scope() as session:
+        db.set_state(session, LAST_BACKUP, json.dumps(dict(
+            report._asdict(), finished_at=datetime.datetime.now().isoformat())))
+
+    if shards:
+        return format_report(report) + f"; backed up {len(shards)} chats' files"
+    return format_report(report)
+
+
+def backup_job(db, args):
+    """Takes a snapshot of the database while it is in use."""
+    print(backup_database(db, args.directory, args.keep))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database', default='data.db')
+    parser.add_argument('--shards', metavar='DIRECTORY')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    sync = commands.add_parser('sync-members', help=sync_members.__doc__)
+    sync.add_argument('chat_id', type=int)
+    sync.add_argument(
+        'file', nargs='?', type=argparse.FileType('r'), default='-')
+    sync.set_defaults(job=sync_members)
+
+    compact = commands.add_parser(
+        'compact-messages', help=compact_messages.__doc__)
+    compact.add_argument('--days', type=int, default=30)
+    compact.set_defaults(job=compact_messages)
+
+    archive = commands.add_parser('archive-quotes', help=archive_quotes.__doc__)
+    archive.set_defaults(job=archive_quotes)
+
+    snapshot = commands.add_parser('backup', help=backup_job.__doc__)
+    snapshot.add_argument('--directory', default='backups')
+    snapshot.add_argument('--keep', type=int, default=7)
+    snapshot.set_defaults(job=backup_job)
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.shards:
+        db = ShardedQuoteDatabase(filename=args.database, directory=args.shards)
+    else:
+        db = QuoteDatabase(filename=args.database)
+
+    args.job(db, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+"""Sends the bot's messages from per-chat queues on threads of their own,
+keeping to Telegram's rate limits, so that handlers don't wait on the
+network."""
+
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import Handler
+
+# Lanes, in order of priority
+ANSWER = 0  # Answers to callback queries, which users are waiting on
+EDIT = 1    # Vote buttons and deleted quotes
+SEND = 2    # Quotes, stats and other replies
+
+LANE_NAMES = ['answer', 'edit', 'send']
+
+
+class TokenBucket:
+    """Allows rate requests a second on average, in bursts of up to
+    capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+
+    def wait(self, now):
+        """Returns the seconds until a request is allowed."""
+        if self.updated is not None:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.wait(now)
+        self.tokens -= 1
+
+
+class Pending(concurrent.futures.Future):
+    """The result of a queued request, which is the result the Bot method
+    would have returned."""
+
+    def __init__(self, outbox):
+        super().__init__()
+        self.outbox = outbox
+
+
+class Sent:
+    """A request's result, to be passed to a callback on the dispatcher's
+    thread."""
+
+    def __init__(self, callback, result):
+        self.callback = callback
+        self.result = result
+
+
+class _SentHandler(Handler):
+    """Runs the callbacks of sent requests with a database session."""
+
+    def __init__(self, database):
+        super().__init__(None)
+        self.database = database
+
+    def check_update(self, update):
+        return isinstance(update, Sent)
+
+    def handle_update(self, update, dispatcher):
+        with self.database.session_scope() as session:
+            update.callback(update.result, session)
+
+
+class _Request:
+    def __init__(self, lane, chat_id, function, args, kwargs, future, coalesce):
+        self.lane = lane
+        self.chat_id = chat_id
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.coalesce = coalesce
+        self.retries = 0
+
+
+class Outbox:
+    """Queues Bot API requests in lanes and sends them on a few threads.
+
+    Lanes of higher priority go first. Requests to a chat are sent one at a
+    time, in the order they were queued within each lane, and chats take
+    turns so that a busy chat can't hold up the others. Token buckets for
+    each chat, each group and in total hold messages to Telegram's limits,
+    given as (rate a second, burst), or None for no limit; answers to
+    callback queries aren't limited. A RetryAfter puts the request back and
+    holds its chat for as long as Telegram asks, up to max_retries times. A
+    request can replace
+    one still queued with the same coalesce key, such as an older edit of the
+    same message.
+
+    Callbacks given to then run on the dispatcher's thread once start has
+    been called with the dispatcher."""
+
+    def __init__(self, threads=4, chat=(1, 1), group=(0.25, 5), total=(25, 5),
+            max_retries=3):
+        self.chat = chat
+        self.group = group
+        self.max_retries = max_retries
+
+        self.lanes = [collections.OrderedDict() for _ in LANE_NAMES]
+        self.busy = set()
+        self.held = {}
+        self.buckets = {}
+        self.total = TokenBucket(*total) if total else None
+
+        self.sent = collections.Counter()
+        self.retries = 0
+        self.failed = 0
+        self.coalesced = 0
+
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.update_queue = None
+        self.handler = None
+        self.logger = logging.getLogger(__name__)
+
+        self.threads = [
+            threading.Thread(target=self.run, name=f'outbox_{i}', daemon=True)
+            for i in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def start(self, dispatcher, database):
+        """Sends callbacks through the dispatcher's queue, to be run by
+        self.handler, which has to be added to the dispatcher."""
+        self.update_queue = dispatcher.update_queue
+        self.handler = _SentHandler(database)
+
+    def submit(self, lane, chat_id, function, *args, coalesce=None, **kwargs):
+        """Queues a call to function, which sends a request to chat_id or to
+        no chat in particular if None. Returns a Pending, which is shared with
+        a queued request that this one replaces."""
+        with self.condition:
+            requests = self.lanes[lane].setdefault(chat_id, collections.deque())
+
+            if coalesce is not None:
+                for request in requests:
+                    if request.coalesce == coalesce:
+                        request.function = function
+                        request.args = args
+                        request.kwargs = kwargs
+                        self.coalesced += 1
+
+                        return request.future
+
+            future = Pending(self)
+            requests.append(_Request(
+                lane, chat_id, function, args, kwargs, future, coalesce))
+            self.condition.notify()
+
+        return future
+
+    def then(self, future, callback, on_error=None):
+        """Calls callback with a pending request's result and a database
+        session on the dispatcher's thread, if the request succeeds, or
+        on_error with its exception if it fails."""
+        if self.update_queue is None:
+            raise RuntimeError("the outbox hasn't been started")
+
+        def done(future):
+            error = future.exception()
+
+            if error is None:
+                if callback is not None:
+                    self.update_queue.put(Sent(callback, future.result()))
+            elif on_error is not None:
+                self.update_queue.put(Sent(on_error, error))
+
+        future.add_done_callback(done)
+
+    def metrics(self):
+        """Returns the number of requests queued in each lane, in flight,
+        sent by lane, and retried, failed or replaced by newer ones, and the
+        number of chats held for RetryAfter."""
+        with self.condition:
+            now = time.monotonic()
+
+            return {
+                'queued': {name: sum(len(q) for q in lane.values())
+                    for name, lane in zip(LANE_NAMES, self.lanes)},
+                'in_flight': len(self.busy),
+                'sent': {LANE_NAMES[lane]: count
+                    for lane, count in self.sent.items()},
+                'retries': self.retries,
+                'failed': self.failed,
+                'coalesced': self.coalesced,
+                'held_chats': sum(until > now for until in self.held.values()),
+            }
+
+    def stop(self, timeout=10):
+        """Sends what's left in the queue, waiting for up to timeout seconds,
+        then stops the threads."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+        deadline = time.monotonic() + timeout
+
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    request, wait = self.next_request(time.monotonic())
+
+                    if request is not None:
+                        break
+                    if self.stopping and not any(self.lanes):
+                        return
+
+                    self.condition.wait(wait)
+
+            self.send(request)
+
+    def next_request(self, now):
+        """Takes the next request that can be sent now. Otherwise returns the
+        seconds until one might be, or None to wait for a notification."""
+        soonest = None
+
+        for lane, chats in enumerate(self.lanes):
+            for chat_id, requests in chats.items():
+                if chat_id is not None and chat_id in self.busy:
+                    continue
+
+                wait = max(self.held.get(chat_id, now) - now,
+                    self.bucket_wait(lane, chat_id, now))
+
+                if wait > 0:
+                    soonest = wait if soonest is None else min(soonest, wait)
+                    continue
+
+                request = requests.popleft()
+
+                # Chats take turns
+                if requests:
+                    chats.move_to_end(chat_id)
+                else:
+                    del chats[chat_id]
+
+                for bucket in self.buckets_for(lane, chat_id):
+                    bucket.take(now)
+                if chat_id is not None:
+                    self.busy.add(chat_id)
+                self.held.pop(chat_id, None)
+
+                return request, None
+
+        return None, soonest
+
+    def buckets_for(self, lane, chat_id):
+        if lane == ANSWER:
+            return []
+
+        buckets = [self.total] if self.total else []
+
+        if chat_id is not None and self.chat:
+            buckets.append(self.bucket(('chat', chat_id), self.chat))
+
+        if isinstance(chat_id, int) and chat_id < 0 and self.group:
+            buckets.append(self.bucket(('group', chat_id), self.group))
+
+        return buckets
+
+    def bucket(self, key, limit):
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*limit)
+
+        return bucket
+
+    def bucket_wait(self, lane, chat_id, now):
+        return max((bucket.wait(now) for bucket in self.buckets_for(lane, chat_id)),
+            default=0)
+
+    def send(self, request):
+        try:
+            result = request.function(*request.args, **request.kwargs)
+        except RetryAfter as e:
+            with self.condition:
+                self.busy.discard(request.chat_id)
+
+                if request.retries < self.max_retries:
+                    request.retries += 1
+                    self.retries += 1
+
+                    # Hold the chat, and send this first once it's released
+                    self.held[request.chat_id] = time.monotonic() + e.retry_after
+                    self.lanes[request.lane].setdefault(
+                        request.chat_id, collections.deque()).appendleft(request)
+                    self.condition.notify_all()
+                    return
+
+                self.failed += 1
+                self.condition.notify_all()
+
+            request.future.set_exception(e)
+            self.logger.warning(
+                'gave up on a request to %s: %s', request.chat_id, e)
+        except Exception as e:
+            with self.condition:
+                self.busy.discard(request.chat_id)
+                self.failed += 1
+                self.condition.notify_all()
+
+            request.future.set_exception(e)
+            self.logger.warning(
+                'a request to %s failed: %s', request.chat_id, e)
+        else:
+            with self.condition:
+                self.busy.discard(request.chat_id)
+                self.sent[request.lane] += 1
+                self.condition.notify_all()
+
+            request.future.set_result(result)
+
+
+class QueuedBot(Bot):
+    """A Bot that queues the messages it sends, answers and edits in an
+    Outbox, and returns a Pending for each instead of waiting for it."""
+
+    def __init__(self, token, outbox, **kwargs):
+        super().__init__(token, **kwargs)
+        self.outbox = outbox
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self.outbox.submit(
+            SEND, chat_id, super().send_message, chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self.outbox.submit(
+            SEND, chat_id, super().send_photo, chat_id, *args, **kwargs)
+
+    def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        return self.outbox.submit(
+            EDIT, chat_id, super().edit_message_text, text, chat_id,
+            *args, **kwargs)
+
+    def edit_message_reply_markup(self, chat_id=None, message_id=None, *args,
+            **kwargs):
+        # Only the newest buttons for a message need to be sent
+        coalesce = ('markup', message_id) if message_id is not None else None
+
+        return self.outbox.submit(
+            EDIT, chat_id, super().edit_message_reply_markup, chat_id,
+            message_id, *args, coalesce=coalesce, **kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self.outbox.submit(
+            ANSWER, None, super().answer_callback_query, *args, **kwargs)
+
+    # Bot's camelCase aliases point at its own methods
+    sendMessage = send_message
+    sendPhoto = send_photo
+    editMessageText = edit_message_text
+    editMessageReplyMarkup = edit_message_reply_markup
+    answerCallbackQuery = answer_callback_query
+
+
+def when_sent(result, callback, session):
+    """Calls callback with the result of a Bot method and a database session:
+    now with the given session, or later with another if the request was
+    queued in an Outbox."""
+    if isinstance(result, Pending):
+        result.outbox.then(result, callback)
+    else:
+        callback(result, session)
+
+
+def request_ignoring(ignored, function, *args, **kwargs):
+    """Calls a Bot method, ignoring the errors for which ignored(error) is
+    true, such as edits of messages too old to be edited. Other errors are
+    raised: now, or on the dispatcher's thread if the request was queued in
+    an Outbox. Returns the method's result, or None if it failed."""
+    try:
+        result = function(*args, **kwargs)
+    except TelegramError as e:
+        if ignored(e):
+            return None
+        raise
+
+    def failed(error, session):
+        if not ignored(error):
+            raise error
+
+    if isinstance(result, Pending):
+        result.outbox.then(result, None, failed)
+
+    return result
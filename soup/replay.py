@@ -0,0 +1,593 @@
+"""Records incoming updates, and replays recorded or generated updates through
+the bot's handlers against a fake Bot API, to reproduce load locally.
+
+    python -m soup.replay --database copy.db [--rate 50] [--concurrency 4] \\
+        [--http] [--rate-limit] (LOG [LOG ...] | --generate 5000)
+
+With --http, the bot polls a fake Bot API server over HTTP for the updates,
+as it would Telegram. This uses the config file like the bot does.
+With --shards, the database is a catalog with each chat's quotes in a file
+of its own (see soup.shards). With --snapshot, the database's caches are
+loaded from a snapshot first, as the bot does when it starts, and saved to
+it afterwards (see soup.snapshot). Replaying writes to the database, so use
+a copy.
+"""
+
+import argparse
+import collections
+import datetime
+import functools
+import glob
+import gzip
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import statistics
+import threading
+import time
+
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, Handler, Updater
+from telegram.utils.request import Request
+
+from soup.backup import rotate
+
+# With microseconds, so that logs sort by name even if started together
+TIME_FORMAT = '%Y%m%d-%H%M%S-%f'
+
+
+class UpdateRecorder(Handler):
+    """Appends every update to a gzipped log of JSON lines, starting a new
+    log every max_updates updates and deleting all but the newest few.
+
+    Each line holds the time the update was received, and the update as the
+    Bot API sent it."""
+
+    def __init__(self, directory, name='updates', max_updates=100000, keep=10,
+            flush_interval=5):
+        super().__init__(None)
+
+        self.directory = directory
+        self.name = name
+        self.max_updates = max_updates
+        self.keep = keep
+        self.flush_interval = flush_interval
+
+        self.file = None
+        self.count = 0
+        self.flushed_at = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def check_update(self, update):
+        return isinstance(update, Update)
+
+    def handle_update(self, update, dispatcher):
+        self.record(update.to_dict())
+
+    def record(self, data, at=None):
+        line = json.dumps({'at': at or time.time(), 'update': data})
+
+        with self.lock:
+            if self.file is None or self.count >= self.max_updates:
+                self._rotate()
+
+            self.file.write(line + '\n')
+            self.count += 1
+
+            # Lines in the buffer are lost if the bot crashes
+            if time.monotonic() - self.flushed_at >= self.flush_interval:
+                self.file.flush()
+                self.flushed_at = time.monotonic()
+
+    def _rotate(self):
+        if self.file is not None:
+            self.file.close()
+
+        stamp = datetime.datetime.now().strftime(TIME_FORMAT)
+        path = os.path.join(self.directory, f'{self.name}-{stamp}.jsonl.gz')
+
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+        self.count = 0
+
+        rotate(self.directory, self.name, self.keep, suffix='.jsonl.gz')
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_log(paths):
+    """Yields the updates in recorded logs, in order, as dictionaries. A log
+    cut off by a crash is read up to where it ends."""
+    for path in paths:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    if line.endswith('\n'):
+                        yield json.loads(line)['update']
+            except EOFError:
+                pass
+
+
+def command(update_id, chat, user, text, date):
+    name = text.split(None, 1)[0]
+
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': date, 'chat': chat, 'from': user,
+        'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(name)}],
+    }}
+
+
+def generate_updates(count, members, quote_messages, words, seed=0):
+    """Yields synthetic updates in the Bot API's format: mostly chatter, with
+    /random, /search and votes on quote messages.
+
+    members is a list of (chat ID, user ID) pairs, quote_messages a list of
+    (chat ID, message ID) pairs of the bot's quote messages, and words a list
+    of words to search for."""
+    rng = random.Random(seed)
+    date = int(time.time())
+
+    def chat(chat_id):
+        if chat_id > 0:
+            return {'id': chat_id, 'type': 'private', 'first_name': 'User'}
+        return {'id': chat_id, 'type': 'supergroup', 'title': f'Chat {chat_id}'}
+
+    def user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}',
+            'username': f'user_{user_id}'}
+
+    for update_id in range(1, count + 1):
+        chat_id, user_id = rng.choice(members)
+        kind = rng.random()
+
+        if kind < 0.15 and quote_messages:
+            message_chat_id, message_id = rng.choice(quote_messages)
+
+            yield {'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user(user_id),
+                'chat_instance': str(message_chat_id),
+                'data': str(rng.choice((1, -1))),
+                'message': {'message_id': message_id, 'date': date,
+                    'chat': chat(message_chat_id)},
+            }}
+        elif kind < 0.30:
+            yield command(update_id, chat(chat_id), user(user_id), '/random', date)
+        elif kind < 0.40 and words:
+            yield command(update_id, chat(chat_id), user(user_id),
+                f'/search {rng.choice(words)}', date)
+        else:
+            yield {'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': date, 'chat': chat(chat_id),
+                'from': user(user_id),
+                'text': ' '.join(rng.choice(words or ['hi'])
+                    for _ in range(rng.randint(1, 12))),
+            }}
+
+
+ReplayReport = collections.namedtuple('ReplayReport', [
+    'updates', 'duration',
+    # Seconds from when each update was due to when it was handled
+    'latencies',
+    'statements', 'api_calls',
+    # API calls rejected for sending too many messages
+    'rejected',
+    # The outbox's metrics at the end, if messages were queued
+    'outbox',
+    # Each worker process's metrics at the end, if there were any
+    'workers',
+])
+
+
+def replay(dispatcher, engine, updates, rate=0, concurrency=1):
+    """Feeds updates, as dictionaries, through a dispatcher on the given
+    number of threads, at the given rate per second or as fast as possible.
+    Returns a ReplayReport."""
+    pending = queue.Queue(maxsize=concurrency * 100)
+    latencies = []
+    statements = itertools.count()
+
+    def count_statement(*args):
+        next(statements)
+
+    def work():
+        while True:
+            item = pending.get()
+
+            if item is None:
+                return
+
+            due, data = item
+            dispatcher.process_update(Update.de_json(data, dispatcher.bot))
+            latencies.append(time.perf_counter() - due)
+
+    api = dispatcher.bot.request.api
+    api_calls = collections.Counter(api.calls)
+    rejected = collections.Counter(api.rejected)
+    event.listen(engine, 'before_cursor_execute', count_statement)
+
+    workers = [threading.Thread(target=work, daemon=True)
+        for _ in range(concurrency)]
+    for worker in workers:
+        worker.start()
+
+    start = time.perf_counter()
+    count = 0
+
+    try:
+        for count, data in enumerate(updates, 1):
+            due = start + (count - 1) / rate if rate else time.perf_counter()
+            delay = due - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+
+            pending.put((due, data))
+
+        for _ in workers:
+            pending.put(None)
+        for worker in workers:
+            worker.join()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+    duration = time.perf_counter() - start
+
+    return ReplayReport(
+        updates=count, duration=duration, latencies=latencies,
+        statements=next(statements), api_calls=api.calls - api_calls,
+        rejected=api.rejected - rejected, outbox=None, workers=None)
+
+
+class _Handled(Handler):
+    """Notes when each update has been through every other handler."""
+
+    def __init__(self):
+        super().__init__(None)
+
+        self.times = {}
+        self.condition = threading.Condition()
+
+    def check_update(self, update):
+        return isinstance(update, Update)
+
+    def handle_update(self, update, dispatcher):
+        self.note(update.update_id)
+
+    def note(self, update_id):
+        with self.condition:
+            self.times[update_id] = time.perf_counter()
+            self.condition.notify_all()
+
+
+def replay_polling(updater, server, engine, updates, rate=0, idle_timeout=30,
+        outbox=None, supervisor=None):
+    """Pushes updates, as dictionaries, to a FakeBotServer at the given rate
+    per second or as fast as possible, while the updater, or an AsyncRuntime,
+    polls it for them.
+    Returns a ReplayReport once every update has been handled, or nothing has
+    been handled for idle_timeout seconds.
+
+    If the updater's bot queues messages in an outbox, the duration includes
+    sending what's left in it. With a Supervisor, whose workers handle the
+    updates the updater forwards, SQL statements aren't counted, since they
+    are run by the workers."""
+    api = server.api
+    handled = _Handled()
+    due = {}
+    statements = itertools.count()
+
+    def count_statement(*args):
+        next(statements)
+
+    if supervisor is not None:
+        supervisor.on_handled = handled.note
+        supervisor.start()
+
+        if not supervisor.wait_ready(idle_timeout):
+            raise RuntimeError("the workers didn't start")
+    else:
+        updater.dispatcher.add_handler(handled, group=1000)
+
+    api_calls = collections.Counter(api.calls)
+    rejected = collections.Counter(api.rejected)
+    event.listen(engine, 'before_cursor_execute', count_statement)
+
+    updater.start_polling(poll_interval=0, timeout=1)
+    start = time.perf_counter()
+
+    try:
+        for count, data in enumerate(updates, 1):
+            at = start + (count - 1) / rate if rate else time.perf_counter()
+            delay = at - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+
+            due[api.push_update(data)] = at
+
+        with handled.condition:
+            while len(handled.times) < len(due):
+                done = len(handled.times)
+                handled.condition.wait(idle_timeout)
+
+                if len(handled.times) == done:
+                    break
+
+        if outbox is not None:
+            outbox.stop(idle_timeout)
+            finished = time.perf_counter()
+
+            # Let the dispatcher run the callbacks of the last messages
+            while (not updater.update_queue.empty()
+                    and time.perf_counter() - finished < idle_timeout):
+                time.sleep(0.01)
+    finally:
+        updater.stop()
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+        if supervisor is not None:
+            supervisor.stop()
+
+    duration = max(handled.times.values(), default=start) - start
+
+    if outbox is not None:
+        duration = max(duration, finished - start)
+    latencies = [handled.times[update_id] - at
+        for update_id, at in due.items() if update_id in handled.times]
+
+    return ReplayReport(
+        updates=len(latencies), duration=duration, latencies=latencies,
+        statements=next(statements) if supervisor is None else None,
+        api_calls=api.calls - api_calls, rejected=api.rejected - rejected,
+        outbox=outbox.metrics() if outbox is not None else None,
+        workers=supervisor.metrics() if supervisor is not None else None)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def format_report(report):
+    lines = [
+        f"{report.updates} updates in {report.duration:.1f} s: "
+        f"{report.updates / report.duration:.1f} updates/s",
+    ]
+
+    if report.latencies:
+        lines.append("latency: " + ', '.join(
+            f"p{p} {percentile(report.latencies, p) * 1000:.1f} ms"
+            for p in (50, 95, 99)) +
+            f", mean {statistics.mean(report.latencies) * 1000:.1f} ms")
+
+    if report.statements is not None:
+        lines.append(
+            f"{report.statements} SQL statements, "
+            f"{report.statements / max(report.updates, 1):.1f} per update")
+
+    lines.append("API calls: " + ', '.join(
+        f"{method} {count}" for method, count in report.api_calls.most_common()))
+
+    if report.outbox:
+        lines.append(f"outbox: {report.outbox}")
+
+    for metrics in report.workers or []:
+        lines.append(
+            f"worker {metrics['worker']}: {metrics['handled']} updates, "
+            f"{metrics['restarts']} restarts")
+
+    if report.rejected:
+        lines.append("rate limited: " + ', '.join(
+            f"{method} {count}" for method, count in report.rejected.most_common()))
+
+    return '\n'.join(lines)
+
+
+def load_targets(db, limit=1000):
+    """Returns members, quote messages and search words from the database,
+    for generating updates."""
+    from soup.classes import Quote, QuoteMessage, membership_table
+
+    session = db.create_session()
+
+    try:
+        members = [(chat_id, user_id) for user_id, chat_id in session.execute(
+            membership_table.select().limit(limit))]
+        quote_messages = session.query(
+            QuoteMessage.chat_id, QuoteMessage.message_id).limit(limit).all()
+        contents = session.query(Quote.content).filter(
+            Quote.deleted == False).limit(limit)
+        words = sorted({word.lower() for content, in contents
+            for word in re.findall(r'\w{4,}', content or '')})
+    finally:
+        session.close()
+
+    return members, quote_messages, words
+
+
+def last_message_id(db):
+    """Returns the highest message ID of the bot's quote messages, so that
+    replays don't reuse them."""
+    from soup.classes import QuoteMessage
+
+    session = db.create_session()
+
+    try:
+        # Sharded databases give a row for each chat
+        return max((message_id or 0 for message_id, in
+            session.query(func.max(QuoteMessage.message_id))), default=0)
+    finally:
+        session.close()
+
+
+def log_error(bot, update, error):
+    # Rejected messages are counted in the report instead
+    logging.debug("error while replaying: %r", error)
+
+
+def replay_worker(url, index, workers):
+    """Returns a dispatcher with the bot's handlers whose bot uses the fake
+    Bot API server at url, for a replay's worker process."""
+    from soup.core import add_handlers
+    from soup.fakebot import TOKEN
+    from soup.handlers import router, side_handlers
+
+    bot = Bot(TOKEN, base_url=url, request=Request(con_pool_size=1))
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=0)
+
+    add_handlers(dispatcher, router, side_handlers)
+    dispatcher.add_error_handler(log_error)
+
+    return dispatcher
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('logs', nargs='*', help="recorded update logs")
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--shards', metavar='DIRECTORY',
+        help="with --database as the catalog, the directory of chats' files")
+    parser.add_argument('--generate', type=int, metavar='COUNT',
+        help="replay generated updates instead of logs")
+    parser.add_argument('--rate', type=float, default=0,
+        help="updates per second, or 0 for as fast as possible")
+    parser.add_argument('--concurrency', type=int, default=1,
+        help="threads handling updates, without --http or with the asyncio "
+            "runtime")
+    parser.add_argument('--api-latency', type=float, default=0,
+        help="seconds each Bot API call takes")
+    parser.add_argument('--http', action='store_true',
+        help="poll a fake Bot API server for the updates")
+    parser.add_argument('--rate-limit', action='store_true',
+        help="reject messages past Telegram's limits with 429 responses")
+    parser.add_argument('--outbox', action='store_true',
+        help="queue messages in an outbox; needs --http")
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'],
+        default='threads', help="with --http, the runtime the bot runs on")
+    parser.add_argument('--workers', type=int, default=1,
+        help="worker processes handling updates; needs --http")
+    parser.add_argument('--snapshot', metavar='FILE',
+        help="load the database's caches from a snapshot before replaying, "
+            "if it's valid, and save them to it after")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.logs and not args.generate:
+        parser.error("give recorded logs or --generate")
+    if args.outbox and not args.http:
+        parser.error("--outbox needs --http")
+    if args.runtime == 'asyncio' and not args.http:
+        parser.error("--runtime asyncio needs --http")
+    if args.workers > 1 and (
+            not args.http or args.outbox or args.runtime == 'asyncio'):
+        parser.error("--workers needs --http, without --outbox or --runtime")
+    if args.snapshot and args.workers > 1:
+        parser.error("--snapshot can't be used with --workers")
+
+    # The bot's database is opened when soup.core is imported
+    os.environ['SOUP_DATABASE'] = args.database
+
+    if args.shards:
+        os.environ['SOUP_SHARDS'] = args.shards
+
+    from soup.core import add_handlers, database
+    from soup.fakebot import (
+        TOKEN, FakeBotAPI, FakeBotServer, RateLimits, create_bot)
+    from soup.handlers import router, side_handlers
+    from soup.outbox import Outbox, QueuedBot
+    from soup.runtime import AsyncRuntime
+    from soup.snapshot import load_snapshot, save_snapshot, start_run
+    from soup.workers import Forwarder, Supervisor
+
+    api = FakeBotAPI(
+        limits=RateLimits() if args.rate_limit else None,
+        first_message_id=last_message_id(database) + 1)
+
+    # The asyncio runtime always sends through an outbox, which only keeps
+    # to Telegram's limits if the fake API enforces them
+    asyncio_runtime = args.runtime == 'asyncio'
+    outbox = None
+
+    if args.outbox or asyncio_runtime:
+        outbox = (Outbox() if args.rate_limit
+            else Outbox(chat=None, group=None, total=None))
+
+    if args.http:
+        server = FakeBotServer(api, latency=args.api_latency).start()
+
+        if asyncio_runtime:
+            updater = AsyncRuntime(
+                TOKEN, outbox, base_url=server.url, workers=args.concurrency)
+        elif outbox is not None:
+            updater = Updater(bot=QueuedBot(
+                TOKEN, outbox, base_url=server.url,
+                request=Request(con_pool_size=8 + len(outbox.threads))))
+        else:
+            updater = Updater(TOKEN, base_url=server.url)
+
+        dispatcher = updater.dispatcher
+    else:
+        dispatcher = Dispatcher(
+            create_bot(api, latency=args.api_latency), None, workers=0)
+
+    supervisor = None
+
+    if args.workers > 1:
+        supervisor = Supervisor(
+            functools.partial(replay_worker, server.url), workers=args.workers)
+        dispatcher.add_handler(Forwarder(supervisor))
+    else:
+        add_handlers(dispatcher, router, side_handlers, outbox)
+
+    dispatcher.add_error_handler(log_error)
+
+    if args.generate:
+        members, quote_messages, words = load_targets(database)
+
+        if not members:
+            parser.error("the database has no chat members to generate updates from")
+
+        updates = generate_updates(
+            args.generate, members, quote_messages, words, seed=args.seed)
+    else:
+        paths = sorted(path for pattern in args.logs for path in glob.glob(pattern))
+        updates = read_log(paths)
+
+    # Replaying counts as a run of the bot
+    if args.snapshot:
+        start_run(database)
+        print(f"snapshot: {load_snapshot(database, args.snapshot)}")
+
+    # Statements are counted on every chat's engine too
+    engine = Engine if args.shards else database.engine
+
+    if args.http:
+        report = replay_polling(
+            updater, server, engine, updates, rate=args.rate,
+            outbox=outbox, supervisor=supervisor)
+        server.stop()
+    else:
+        report = replay(
+            dispatcher, engine, updates, rate=args.rate,
+            concurrency=args.concurrency)
+
+    print(format_report(report))
+
+    if args.snapshot:
+        print(f"snapshot: {save_snapshot(database, args.snapshot)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Routes updates to handlers through a table, instead of giving every handler
+its own dispatcher group and testing each of them on every update."""
+
+import logging
+
+from telegram import TelegramError, Update
+from telegram.ext import (
+    CallbackQueryHandler, CommandHandler, DispatcherHandlerStop, Handler,
+    MessageHandler)
+
+# Kinds of updates
+CALLBACK = 'callback'
+COMMAND = 'command'
+MESSAGE = 'message'
+
+
+def parse_command(message, username):
+    """Returns the lowercased name of the command in a message, or None if
+    the message isn't a command or is addressed to another bot."""
+    text = message.text
+
+    if not text or not text.startswith('/') or len(text) < 2:
+        return None
+
+    name, _, target = text.split(None, 1)[0][1:].partition('@')
+
+    if not name or target and target.lower() != username.lower():
+        return None
+
+    return name.lower()
+
+
+class Router(Handler):
+    """Runs every handler that matches an update, in the order given, like
+    one dispatcher group per handler would.
+
+    Each update is classified once, by kind, command name and whether it was
+    sent in a private chat. The handlers that can match each class are worked
+    out on first use and kept, so a command only has its own handlers' filters
+    tested, and plain messages skip every command handler.
+
+    Handlers in private are only tried in private chats."""
+
+    def __init__(self, handlers, private=()):
+        super().__init__(None)
+
+        self.handlers = list(handlers)
+        self.private = list(private)
+        self.routes = {}
+        self.logger = logging.getLogger(__name__)
+
+    def classify(self, update, username):
+        """Returns the update's kind, command name and whether it was sent in
+        a private chat."""
+        chat = update.effective_chat
+        private = chat is not None and chat.type == chat.PRIVATE
+
+        if update.callback_query is not None:
+            return CALLBACK, None, private
+
+        if update.message is not None:
+            command = parse_command(update.message, username)
+
+            if command is not None:
+                return COMMAND, command, private
+
+        return MESSAGE, None, private
+
+    def route(self, kind, command, private):
+        """Returns the handlers that can match a class of updates."""
+        key = (kind, command, private)
+        route = self.routes.get(key)
+
+        if route is None:
+            route = [handler for handler in self.handlers
+                if self.accepts(handler, kind, command, private)]
+            self.routes[key] = route
+
+        return route
+
+    def accepts(self, handler, kind, command, private):
+        if not private and any(handler is h for h in self.private):
+            return False
+
+        if isinstance(handler, CallbackQueryHandler):
+            return kind == CALLBACK
+
+        if isinstance(handler, CommandHandler) and not handler.allow_edited:
+            return kind == COMMAND and command in handler.command
+
+        if isinstance(handler, MessageHandler):
+            return kind != CALLBACK
+
+        # Anything else decides for itself
+        return True
+
+    def check_update(self, update):
+        return isinstance(update, Update)
+
+    def handle_update(self, update, dispatcher):
+        route = self.route(*self.classify(update, dispatcher.bot.username))
+
+        for handler in route:
+            if not self.matches(handler, update):
+                continue
+
+            # Errors are kept to the handler that raised them, as they would
+            # be with a dispatcher group per handler
+            try:
+                handler.handle_update(update, dispatcher)
+            except DispatcherHandlerStop:
+                raise
+            except TelegramError as e:
+                dispatcher.dispatch_error(update, e)
+            except Exception:
+                self.logger.exception(
+                    'An uncaught error was raised while processing the update')
+
+    @staticmethod
+    def matches(handler, update):
+        if isinstance(handler, CommandHandler) and not handler.allow_edited:
+            # The route already matched the command
+            filters = handler.filters
+
+            if filters is None:
+                return True
+            if isinstance(filters, list):
+                return any(f(update.message) for f in filters)
+
+            return filters(update.message)
+
+        return handler.check_update(update)
@@ -0,0 +1,393 @@
+"""Runs the bot's handlers from an asyncio event loop instead of the Updater's
+threads. Bot API requests are made on the loop, so any number can be in
+flight at once, and handlers run on a few database threads, so they never
+wait on the network."""
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import logging
+import signal
+import ssl
+import threading
+import time
+import urllib.parse
+
+from telegram import Update
+from telegram.error import (
+    BadRequest, InvalidToken, NetworkError, RetryAfter, TelegramError,
+    TimedOut, Unauthorized)
+from telegram.ext import Dispatcher, JobQueue
+from telegram.utils.request import Request
+
+from soup.outbox import QueuedBot, Sent
+
+DEFAULT_BASE_URL = 'https://api.telegram.org/bot'
+
+
+class HTTPClient:
+    """A minimal HTTP/1.1 client on asyncio streams, for one host. Up to
+    connections requests are made at once, over connections that are kept
+    open between requests."""
+
+    def __init__(self, url, connections=16):
+        parts = urllib.parse.urlsplit(url)
+
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.path = parts.path.rstrip('/')
+
+        self.connections = connections
+        self.semaphore = None
+        self.idle = []
+
+    async def request(self, method, path, body=b'', headers=None, timeout=30):
+        """Returns the status and body of the response. Raises TimedOut, or
+        NetworkError if the connection fails."""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.connections)
+
+        head = [f'{method} {self.path}{path} HTTP/1.1', f'Host: {self.host}',
+            f'Content-Length: {len(body)}']
+        head += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        data = ('\r\n'.join(head) + '\r\n\r\n').encode() + body
+
+        async with self.semaphore:
+            # A kept connection may have been closed by the server meanwhile,
+            # in which case the request is tried once more on a new one
+            while True:
+                reused = bool(self.idle)
+                writer = None
+
+                try:
+                    if reused:
+                        reader, writer = self.idle.pop()
+                    else:
+                        reader, writer = await asyncio.wait_for(
+                            asyncio.open_connection(
+                                self.host, self.port, ssl=self.ssl), timeout)
+
+                    status, keep, response = await asyncio.wait_for(
+                        self.exchange(reader, writer, data), timeout)
+                except asyncio.TimeoutError:
+                    if writer is not None:
+                        writer.close()
+                    raise TimedOut()
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    if writer is not None:
+                        writer.close()
+                    if not reused:
+                        raise NetworkError(f'connection failed: {e!r}')
+                    continue
+
+                if keep:
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+
+                return status, response
+
+    @staticmethod
+    async def exchange(reader, writer, data):
+        writer.write(data)
+        await writer.drain()
+
+        status_line = await reader.readline()
+
+        if not status_line:
+            raise asyncio.IncompleteReadError(b'', None)
+
+        status = int(status_line.split()[1])
+        headers = {}
+
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+
+            if not line:
+                break
+
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep = headers.get('connection', '').lower() != 'close'
+
+        if 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                chunks.append(await reader.readexactly(size + 2))
+
+                if not size:
+                    break
+
+            body = b''.join(chunk[:-2] for chunk in chunks)
+        else:
+            body = await reader.read()
+            keep = False
+
+        return status, keep, body
+
+    def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+
+
+def parse_response(status, body):
+    """Returns the result of a Bot API response, raising the errors that
+    python-telegram-bot's Request raises."""
+    if 200 <= status <= 299:
+        return Request._parse(body)
+
+    # Raises RetryAfter and ChatMigrated
+    try:
+        message = Request._parse(body)
+    except ValueError:
+        message = 'Unknown HTTPError'
+
+    if status in (401, 403):
+        raise Unauthorized(message)
+    elif status == 400:
+        raise BadRequest(message)
+    elif status == 404:
+        raise InvalidToken()
+    elif status == 502:
+        raise NetworkError('Bad Gateway')
+
+    raise NetworkError(f'{message} ({status})')
+
+
+class AsyncBotAPI:
+    """Makes Bot API requests with an HTTPClient."""
+
+    def __init__(self, token, base_url=None, connections=16):
+        self.client = HTTPClient(
+            (base_url or DEFAULT_BASE_URL) + token, connections=connections)
+
+    async def call(self, method, data, timeout=None):
+        body = json.dumps(data or {}).encode()
+        status, response = await self.client.request(
+            'POST', f'/{method}', body, {'Content-Type': 'application/json'},
+            timeout=timeout or 30)
+
+        return parse_response(status, response)
+
+
+class AsyncRequest:
+    """Stands in for python-telegram-bot's Request in a Bot used from other
+    threads, making each request on the event loop and waiting for it. Files
+    can't be uploaded, but the bot only sends photos by file ID."""
+
+    # Requests share the client's connections, so any number of threads can
+    # use this at once
+    con_pool_size = 1024
+
+    def __init__(self, api, loop):
+        self.api = api
+        self.loop = loop
+
+    def post(self, url, data, timeout=None):
+        # Long polls wait for timeout seconds before answering
+        if 'timeout' in (data or {}):
+            timeout = (timeout or 0) + data['timeout'] + 5
+
+        method = url.rsplit('/', 1)[-1]
+        future = asyncio.run_coroutine_threadsafe(
+            self.api.call(method, data, timeout), self.loop)
+
+        return future.result()
+
+    def get(self, url, timeout=None):
+        return self.post(url, None, timeout=timeout)
+
+    def stop(self):
+        pass
+
+
+class _LoopQueue:
+    """The dispatcher's update queue: puts updates into the runtime's chat
+    lanes from any thread, and counts those not yet handled."""
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        with self.lock:
+            self.pending += 1
+
+        self.runtime.loop.call_soon_threadsafe(self.runtime.enqueue, item)
+
+    def done(self):
+        with self.lock:
+            self.pending -= 1
+
+    def empty(self):
+        return self.pending == 0
+
+
+class AsyncRuntime:
+    """Polls for updates on an asyncio event loop and hands each to the
+    dispatcher on one of workers database threads. Works like an Updater, for
+    the parts of it the bot uses.
+
+    Updates from one chat are handled in order, one at a time; chats are
+    handled side by side. Each chat's lane is a task, and the tasks belong to
+    the runtime: stopping waits for every lane to empty before the loop
+    closes. Messages are sent through an Outbox, whose results come back to
+    the lanes of the chats they were sent to.
+
+    Handlers on different database threads can write at the same time, so
+    only one thread works with batched updates."""
+
+    def __init__(self, token, outbox, base_url=None, workers=1, connections=16):
+        self.logger = logging.getLogger(__name__)
+        self.loop = asyncio.new_event_loop()
+        self.api = AsyncBotAPI(token, base_url, connections=connections)
+
+        self.outbox = outbox
+        self.bot = QueuedBot(
+            token, outbox, base_url=base_url or DEFAULT_BASE_URL,
+            request=AsyncRequest(self.api, self.loop))
+
+        self.update_queue = _LoopQueue(self)
+        self.dispatcher = Dispatcher(self.bot, self.update_queue, workers=0)
+        self.job_queue = JobQueue(self.bot)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='database')
+
+        # Updates waiting in each chat's lane, and the lanes' tasks
+        self.lanes = collections.defaultdict(collections.deque)
+        self.tasks = {}
+
+        self.offset = 0
+        self.running = False
+        self.stopped = None
+        self.thread = None
+        self.is_idle = False
+
+    def start_polling(self, poll_interval=0.0, timeout=10, **kwargs):
+        """Starts the event loop on a thread of its own, polling for updates
+        with long polls of timeout seconds."""
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.loop.run_until_complete, args=(self.run(timeout, poll_interval),),
+            name='runtime')
+        self.thread.start()
+        self.job_queue.start()
+
+        return self.update_queue
+
+    def stop(self):
+        """Stops polling, waits for the updates already received to be
+        handled and the outbox to be sent, and closes the loop."""
+        self.job_queue.stop()
+
+        if not self.running:
+            return
+
+        self.running = False
+        self.loop.call_soon_threadsafe(self.stopped.set)
+        self.thread.join()
+        self.executor.shutdown()
+        self.loop.close()
+
+    def idle(self, stop_signals=(signal.SIGINT, signal.SIGTERM, signal.SIGABRT)):
+        for sig in stop_signals:
+            signal.signal(sig, self.signal_handler)
+
+        self.is_idle = True
+
+        while self.is_idle:
+            time.sleep(1)
+
+    def signal_handler(self, signum, frame):
+        self.is_idle = False
+        self.logger.info('received signal %s, stopping', signum)
+        self.stop()
+
+    async def run(self, timeout, poll_interval):
+        self.stopped = asyncio.Event()
+        poller = self.loop.create_task(self.poll(timeout, poll_interval))
+
+        try:
+            await self.stopped.wait()
+        finally:
+            poller.cancel()
+            await asyncio.wait([poller])
+
+            # Finish what has been received, then send what's left, whose
+            # callbacks come back to the lanes
+            await self.drain()
+            await self.loop.run_in_executor(None, self.outbox.stop)
+            await self.drain()
+
+            self.api.client.close()
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.wait(list(self.tasks.values()))
+
+    async def poll(self, timeout, poll_interval):
+        interval = poll_interval
+
+        while True:
+            try:
+                updates = await self.api.call('getUpdates', {
+                    'offset': self.offset, 'timeout': timeout},
+                    timeout=timeout + 5)
+            except RetryAfter as e:
+                interval = e.retry_after + 0.5
+            except (TimedOut, NetworkError) as e:
+                self.logger.debug('error while getting updates: %s', e)
+                interval = min(30, max(1, interval * 2))
+            except TelegramError as e:
+                self.logger.error('error while getting updates: %s', e)
+                interval = min(30, max(1, interval * 2))
+            else:
+                interval = poll_interval
+
+                for data in updates:
+                    self.offset = data['update_id'] + 1
+                    self.update_queue.put(Update.de_json(data, self.bot))
+
+            if interval:
+                await asyncio.sleep(interval)
+
+    def enqueue(self, item):
+        """Adds an update, or a sent message's callback, to its chat's lane,
+        starting the lane's task if it isn't running."""
+        if isinstance(item, Sent):
+            key = getattr(item.result, 'chat_id', None)
+        else:
+            chat = item.effective_chat
+            key = chat.id if chat is not None else None
+
+        self.lanes[key].append(item)
+
+        if key not in self.tasks:
+            self.tasks[key] = self.loop.create_task(self.run_lane(key))
+
+    async def run_lane(self, key):
+        lane = self.lanes[key]
+
+        try:
+            while lane:
+                item = lane.popleft()
+
+                try:
+                    await self.loop.run_in_executor(
+                        self.executor, self.dispatcher.process_update, item)
+                except Exception:
+                    self.logger.exception('error while handling an update')
+                finally:
+                    self.update_queue.done()
+        finally:
+            del self.tasks[key]
+            del self.lanes[key]
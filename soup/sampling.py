@@ -0,0 +1,272 @@
+import array
+import random
+import threading
+import zlib
+
+
+class FenwickTree:
+    """Prefix sums over a list of non-negative integer weights, with O(log n)
+    updates, appends and lookups by cumulative weight."""
+
+    def __init__(self, weights=()):
+        # 1-indexed: tree[i] holds the sum of weights (i - lowbit(i), i]
+        self.tree = [0] + list(weights)
+        n = len(self.tree)
+
+        for i in range(1, n):
+            parent = i + (i & -i)
+            if parent < n:
+                self.tree[parent] += self.tree[i]
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def append(self, weight):
+        i = len(self.tree)
+        total = weight
+
+        step = 1
+        while step < (i & -i):
+            total += self.tree[i - step]
+            step <<= 1
+
+        self.tree.append(total)
+
+    def add(self, index, delta):
+        i = index + 1
+
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, count):
+        """Returns the sum of the first count weights."""
+        total = 0
+
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+
+        return total
+
+    def total(self):
+        return self.prefix_sum(len(self))
+
+    def find(self, target):
+        """Returns the index of the weight containing the given cumulative
+        weight, i.e. the smallest index whose prefix sum exceeds target."""
+        position = 0
+        step = 1 << len(self).bit_length()
+
+        while step:
+            i = position + step
+            if i <= len(self) and self.tree[i] <= target:
+                position = i
+                target -= self.tree[i]
+            step >>= 1
+
+        return position
+
+
+class WeightedSampler:
+    """Draws quote IDs with probability proportional to their weight. Quotes
+    can be added, reweighted and removed in O(log n)."""
+
+    def __init__(self, weight, items=()):
+        self.weight = weight
+        self.lock = threading.Lock()
+
+        self.ids = []
+        self.weights = []
+        self.slots = {}
+        self.free = []
+
+        for quote_id, score in items:
+            self.slots[quote_id] = len(self.ids)
+            self.ids.append(quote_id)
+            self.weights.append(weight(score))
+
+        self.tree = FenwickTree(self.weights)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, quote_id):
+        return quote_id in self.slots
+
+    def set(self, quote_id, score):
+        """Adds a quote, or updates its weight if it's already present."""
+        weight = self.weight(score)
+
+        with self.lock:
+            slot = self.slots.get(quote_id)
+
+            if slot is None:
+                if self.free:
+                    slot = self.free.pop()
+                    self.ids[slot] = quote_id
+                else:
+                    slot = len(self.ids)
+                    self.ids.append(quote_id)
+                    self.weights.append(0)
+                    self.tree.append(0)
+
+                self.slots[quote_id] = slot
+
+            self.tree.add(slot, weight - self.weights[slot])
+            self.weights[slot] = weight
+
+    def remove(self, quote_id):
+        with self.lock:
+            slot = self.slots.pop(quote_id, None)
+
+            if slot is None:
+                return
+
+            self.tree.add(slot, -self.weights[slot])
+            self.weights[slot] = 0
+            self.ids[slot] = None
+            self.free.append(slot)
+
+    def draw(self, rng=random):
+        """Returns a random quote ID, or None if the sampler is empty."""
+        with self.lock:
+            total = self.tree.total()
+
+            if total == 0:
+                return None
+
+            return self.ids[self.tree.find(rng.randrange(total))]
+
+    def dumps(self):
+        """Returns the sampler's IDs and weights as a compact byte string."""
+        with self.lock:
+            ids = [quote_id for quote_id in self.ids if quote_id is not None]
+            weights = [weight for quote_id, weight in zip(self.ids, self.weights)
+                if quote_id is not None]
+
+        return zlib.compress(array.array('q', ids + weights).tobytes())
+
+    @classmethod
+    def loads(cls, data, weight):
+        """Returns a sampler saved by dumps, which weighs new scores with
+        weight."""
+        values = array.array('q')
+        values.frombytes(zlib.decompress(data))
+        count = len(values) // 2
+
+        sampler = cls(weight)
+        sampler.ids = values[:count].tolist()
+        sampler.weights = values[count:].tolist()
+        sampler.slots = {quote_id: slot
+            for slot, quote_id in enumerate(sampler.ids)}
+        sampler.tree = FenwickTree(sampler.weights)
+
+        return sampler
+
+
+class ShuffleBag:
+    """Draws quote IDs without replacement, so no quote repeats until every
+    quote has been drawn. Draws, additions and removals are O(1)."""
+
+    def __init__(self, ids=(), high_water=0):
+        self.ids = []
+        self.positions = {}
+        self.lock = threading.Lock()
+
+        # The highest quote ID the bag has seen; newer quotes are absorbed
+        # when a saved bag is loaded
+        self.high_water = high_water
+
+        for quote_id in ids:
+            self.add(quote_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, quote_id):
+        return quote_id in self.positions
+
+    def add(self, quote_id):
+        with self.lock:
+            if quote_id in self.positions:
+                return
+
+            self.positions[quote_id] = len(self.ids)
+            self.ids.append(quote_id)
+            self.high_water = max(self.high_water, quote_id)
+
+    def remove(self, quote_id):
+        with self.lock:
+            self._remove(quote_id)
+
+    def pop(self, rng=random):
+        """Removes and returns a random quote ID, or None if the bag is
+        empty."""
+        with self.lock:
+            if not self.ids:
+                return None
+
+            quote_id = self.ids[rng.randrange(len(self.ids))]
+            self._remove(quote_id)
+
+            return quote_id
+
+    def _remove(self, quote_id):
+        position = self.positions.pop(quote_id, None)
+
+        if position is None:
+            return
+
+        # Move the last ID into the removed ID's place
+        last = self.ids.pop()
+
+        if position < len(self.ids):
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def dumps(self):
+        with self.lock:
+            return pack_ids(self.ids)
+
+    @classmethod
+    def loads(cls, data, high_water=0):
+        return cls(unpack_ids(data), high_water=high_water)
+
+
+def pack_ids(ids):
+    """Packs non-negative integer IDs into a compact byte string. The IDs are
+    sorted, delta encoded as varints and compressed, so dense IDs take well
+    under a byte each."""
+    packed = bytearray()
+    previous = 0
+
+    for quote_id in sorted(ids):
+        delta = quote_id - previous
+        previous = quote_id
+
+        while delta >= 0x80:
+            packed.append(delta & 0x7F | 0x80)
+            delta >>= 7
+
+        packed.append(delta)
+
+    return zlib.compress(bytes(packed))
+
+
+def unpack_ids(data):
+    """Returns the list of IDs packed by pack_ids."""
+    ids = []
+    previous = delta = shift = 0
+
+    for byte in zlib.decompress(data):
+        delta |= (byte & 0x7F) << shift
+
+        if byte & 0x80:
+            shift += 7
+        else:
+            previous += delta
+            ids.append(previous)
+            delta = shift = 0
+
+    return ids
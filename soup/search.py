@@ -0,0 +1,322 @@
+import itertools
+import re
+
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import column, select, table
+from sqlalchemy.sql.expression import and_, func, not_, or_
+
+from soup.classes import Quote, User, membership_table
+
+
+# Compiled search statements, keyed by the shape of the search
+bakery = baked.bakery(size=256)
+
+# Each user role is joined at most once, under its own alias
+Sender = aliased(User, name='sender')
+Quoter = aliased(User, name='quoter')
+
+ROLES = {
+    'sender': (Sender, Quote.sent_by_id),
+    'quoter': (Quoter, Quote.quoted_by_id),
+}
+
+# Optional full-text index over quote contents (SQLite FTS5)
+quote_fts = table('quote_fts', column('rowid'), column('quote_fts'))
+
+FULLTEXT_DDL = [
+    """CREATE VIRTUAL TABLE quote_fts USING fts5(
+        content, content='quote', content_rowid='id')""",
+    """CREATE TRIGGER quote_fts_insert AFTER INSERT ON quote BEGIN
+        INSERT INTO quote_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER quote_fts_delete AFTER DELETE ON quote BEGIN
+        INSERT INTO quote_fts(quote_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER quote_fts_update AFTER UPDATE OF content ON quote BEGIN
+        INSERT INTO quote_fts(quote_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO quote_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    "INSERT INTO quote_fts(quote_fts) VALUES ('rebuild')",
+]
+
+# Limits on search queries, checked before anything reaches the database
+MAX_SEARCH_LENGTH = 200
+MAX_SEARCH_TERMS = 12
+MAX_SEARCH_DEPTH = 3
+
+
+class SearchSyntaxError(ValueError):
+    pass
+
+
+# Expression tree
+
+
+class Term:
+    """Matches quotes whose text contains a word or phrase."""
+    role = None
+    priority = 90
+    shape = ('term',)
+
+    def __init__(self, value, phrase=False):
+        self.value = value
+        self.phrase = phrase
+
+    def criterion(self, param, fulltext=False):
+        if fulltext:
+            return Quote.id.in_(select([quote_fts.c.rowid]).where(
+                quote_fts.c.quote_fts.op('MATCH')(bindparam(param))))
+
+        return func.coalesce(Quote.content, '').ilike(
+            bindparam(param), escape='\\')
+
+    def params(self, param, fulltext=False):
+        if fulltext:
+            value = '"{}"'.format(self.value.replace('"', '""'))
+            return {param: value if self.phrase else value + '*'}
+
+        value = re.sub(r'([\\%_])', r'\\\1', self.value)
+        return {param: f'%{value}%'}
+
+    def __repr__(self):
+        return f"<Term: {self.value}>"
+
+
+class Operator:
+    def __init__(self, *children):
+        self.children = sorted(children, key=lambda child: child.priority)
+
+    @property
+    def priority(self):
+        return max(child.priority for child in self.children)
+
+    @property
+    def shape(self):
+        return (self.name,) + tuple(child.shape for child in self.children)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {self.children}>"
+
+
+class And(Operator):
+    name = 'and'
+
+
+class Or(Operator):
+    name = 'or'
+
+
+class Not(Operator):
+    name = 'not'
+
+
+def leaves(node):
+    """Yields the terms and tags in the expression, in compilation order."""
+    if isinstance(node, Operator):
+        for child in node.children:
+            yield from leaves(child)
+    else:
+        yield node
+
+
+# Parsing
+
+
+TOKEN = re.compile(r'\s*(?:(\))|(-?)(?:(\()|"([^"]*)"|([^\s()"]+)))')
+TAG = re.compile(r'^([-\w]+):(<|<=|>=|>)?([-\w]+)$')
+
+
+def tokenize(text):
+    """Splits a search into (kind, negated, value) tokens in a single pass."""
+    position = 0
+    text = text.rstrip()
+
+    while position < len(text):
+        match = TOKEN.match(text, position)
+
+        if match is None:
+            raise SearchSyntaxError("unterminated phrase")
+
+        close, negated, open_, phrase, word = match.groups()
+        position = match.end()
+
+        if close is not None:
+            yield ')', False, None
+        elif open_ is not None:
+            yield '(', bool(negated), None
+        elif phrase is not None:
+            yield 'phrase', bool(negated), phrase
+        elif word in ('OR', '|') and not negated:
+            yield 'or', False, None
+        else:
+            yield 'word', bool(negated), word
+
+
+def parse_search(text, create_tag):
+    """Parses a search into an expression tree, or returns None if the search
+    is empty. Words are ANDed together; OR, parentheses, quoted phrases and a
+    leading - for negation are supported. Tags are created with create_tag.
+
+    Raises SearchSyntaxError for invalid or overly complex searches."""
+    if len(text) > MAX_SEARCH_LENGTH:
+        raise SearchSyntaxError(
+            f"searches are limited to {MAX_SEARCH_LENGTH} characters")
+
+    tokens = list(tokenize(text))
+    if not tokens:
+        return None
+
+    parser = _Parser(tokens, create_tag)
+    expression = parser.parse_or(depth=0)
+
+    if parser.position != len(tokens):
+        raise SearchSyntaxError("unbalanced parentheses")
+
+    return expression
+
+
+class _Parser:
+    def __init__(self, tokens, create_tag):
+        self.tokens = tokens
+        self.position = 0
+        self.terms = 0
+        self.create_tag = create_tag
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def parse_or(self, depth):
+        groups = [self.parse_and(depth)]
+
+        while self.peek() == 'or':
+            self.position += 1
+            groups.append(self.parse_and(depth))
+
+        return groups[0] if len(groups) == 1 else Or(*groups)
+
+    def parse_and(self, depth):
+        items = []
+
+        while self.peek() not in (None, 'or', ')'):
+            items.append(self.parse_item(depth))
+
+        if not items:
+            raise SearchSyntaxError("expected a search term")
+
+        return items[0] if len(items) == 1 else And(*items)
+
+    def parse_item(self, depth):
+        kind, negated, value = self.tokens[self.position]
+        self.position += 1
+
+        if kind == '(':
+            if depth == MAX_SEARCH_DEPTH:
+                raise SearchSyntaxError("too many nested parentheses")
+
+            item = self.parse_or(depth + 1)
+
+            if self.peek() != ')':
+                raise SearchSyntaxError("unbalanced parentheses")
+            self.position += 1
+        else:
+            self.terms += 1
+
+            if self.terms > MAX_SEARCH_TERMS:
+                raise SearchSyntaxError(
+                    f"searches are limited to {MAX_SEARCH_TERMS} terms")
+
+            item = self.parse_leaf(kind, value)
+
+        return Not(item) if negated else item
+
+    def parse_leaf(self, kind, value):
+        if kind == 'phrase':
+            if not value.strip():
+                raise SearchSyntaxError("empty phrase")
+            return Term(value, phrase=True)
+
+        match = TAG.match(value)
+
+        if match is None:
+            return Term(value)
+
+        name, cmp, tag_value = match.groups()
+
+        try:
+            return self.create_tag(name, tag_value, cmp=cmp)
+        except ValueError as e:
+            raise SearchSyntaxError(f"invalid tag {value}") from e
+
+
+# Compilation
+
+
+def search_signature(expression, fulltext=False, member=False):
+    """Returns a hashable description of the statement's shape. Searches with
+    the same signature compile to the same SQL and differ only in their
+    bound parameters."""
+    return (expression.shape, fulltext, member)
+
+
+def compile_search(expression, fulltext=False, member=False):
+    """Returns a baked query selecting random quotes that match the search
+    expression, and the parameters to bind to it. The query searches the chat
+    bound to chat_id, or with member set, every chat that the user bound to
+    user_id is a member of.
+
+    The query is built once per signature; later searches with the same
+    signature reuse the cached statement."""
+    params = {}
+
+    for i, leaf in enumerate(leaves(expression)):
+        if isinstance(leaf, Term):
+            params.update(leaf.params(f'p{i}', fulltext=fulltext))
+        else:
+            params.update(leaf.params(f'p{i}'))
+
+    query = bakery(lambda session: session.query(Quote))
+    query.add_criteria(
+        lambda q: _build_search(q, expression, fulltext, member),
+        search_signature(expression, fulltext, member))
+
+    return query, params
+
+
+def _build_search(query, expression, fulltext, member):
+    if member:
+        chats = select([membership_table.c.chat_id]).where(
+            membership_table.c.user_id == bindparam('user_id'))
+        query = query.filter(Quote.chat_id.in_(chats))
+    else:
+        query = query.filter(Quote.chat_id == bindparam('chat_id'))
+
+    query = query.filter(Quote.deleted == False)
+
+    roles = {leaf.role for leaf in leaves(expression)} - {None}
+    for role in sorted(roles):
+        alias, column = ROLES[role]
+        query = query.join(alias, column == alias.id)
+
+    names = (f'p{i}' for i in itertools.count())
+    query = query.filter(_criterion(expression, names, fulltext))
+
+    return query.order_by(func.random())
+
+
+def _criterion(node, names, fulltext):
+    if isinstance(node, And):
+        return and_(*[_criterion(c, names, fulltext) for c in node.children])
+    elif isinstance(node, Or):
+        return or_(*[_criterion(c, names, fulltext) for c in node.children])
+    elif isinstance(node, Not):
+        return not_(_criterion(node.children[0], names, fulltext))
+    elif isinstance(node, Term):
+        return node.criterion(next(names), fulltext=fulltext)
+    else:
+        return node.criterion(next(names))
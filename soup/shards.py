@@ -0,0 +1,879 @@
+"""Keeps each chat's quotes, votes and quote messages in a SQLite file of its
+own, so that a busy chat doesn't hold the write lock for every other chat.
+Users, chats, memberships and the archive stay in a shared catalog, which
+the chats' files attach so that queries can join the two.
+
+    python -m soup.shards split SOURCE [--catalog data.db] [--directory shards] [--fulltext]
+"""
+
+import argparse
+import collections
+import datetime
+import functools
+import glob
+import inspect
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.horizontal_shard import ShardedQuery, ShardedSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.expression import (
+    Alias, TableClause, and_, func, select)
+from sqlalchemy.sql import visitors
+
+from soup.archive import quote_key
+from soup.classes import (
+    ArchivedQuote, ArchivedQuoteMessage, ArchivedVote, Base, Quote,
+    QuoteMessage, Vote, membership_table)
+from soup.database import QuoteDatabase
+from soup.search import FULLTEXT_DDL, compile_search
+
+# The catalog's shard ID; chats' shard IDs are their chat IDs
+CATALOG = 'catalog'
+
+# Tables kept in each chat's file, in the order they're copied
+CHAT_TABLES = ['quote', 'vote', 'quote_message', 'daily_stats', 'quote_bag']
+
+# Names that resolve to a chat's file; everything else is in the catalog
+CHAT_NAMES = set(CHAT_TABLES) | {'quote_fts'}
+
+# The chat of every quote. The catalog hands out quote IDs, so that they're
+# unique across chats, and keeps the quotes' keys (see soup.archive) to find
+# duplicates in other chats.
+quote_index_table = Table(
+    'quote_index', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('chat_id', Integer, nullable=False),
+    Column('key', Integer, nullable=False, index=True))
+
+FILE_PATTERN = re.compile(r'chat(-?\d+)\.db')
+
+
+def catalog_tables():
+    return [table for table in Base.metadata.sorted_tables
+        if table.name not in CHAT_NAMES]
+
+
+def chat_tables():
+    return [Base.metadata.tables[name] for name in CHAT_TABLES]
+
+
+def table_names(clause):
+    """Returns the names of the tables a statement reads or writes,
+    including those in subqueries."""
+    names = set()
+
+    for element in visitors.iterate(clause, {'column_collections': False}):
+        if isinstance(element, TableClause):
+            names.add(element.name)
+        elif isinstance(element, Alias):
+            names |= table_names(element.element)
+
+    if isinstance(clause, UpdateBase):
+        names.add(clause.table.name)
+
+    return names
+
+
+def set_wal(engine):
+    # Chats' connections read the catalog while it's being written
+    with engine.connect() as connection:
+        connection.execute('PRAGMA journal_mode=WAL')
+
+
+class ShardPool:
+    """Opens the engines of chats' files in a directory, attaching the
+    catalog to each of their connections. Only the size most recently used
+    engines are kept open; the others are disposed of, and opened again when
+    they're next used. Files are created on first use."""
+
+    def __init__(self, catalog, directory, size=64, fulltext=False):
+        self.catalog = os.path.abspath(catalog)
+        self.directory = directory
+        self.size = size
+        self.fulltext = fulltext
+
+        self.engines = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.evicted = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.chats = set()
+
+        for path in glob.glob(os.path.join(directory, 'chat*.db')):
+            match = FILE_PATTERN.fullmatch(os.path.basename(path))
+
+            if match:
+                self.chats.add(int(match.group(1)))
+
+    def path(self, chat_id):
+        return os.path.join(self.directory, f'chat{chat_id}.db')
+
+    def chat_ids(self):
+        """Returns the IDs of the chats that have a file."""
+        with self.lock:
+            return sorted(self.chats)
+
+    def engine(self, chat_id):
+        """Returns the engine of a chat's file, opening it if needed."""
+        with self.lock:
+            engine = self.engines.get(chat_id)
+
+            if engine is not None:
+                self.engines.move_to_end(chat_id)
+                return engine
+
+            engine = self.engines[chat_id] = self.open(chat_id)
+
+            if len(self.engines) > self.size:
+                _, evicted = self.engines.popitem(last=False)
+                evicted.dispose()
+                self.evicted += 1
+
+            return engine
+
+    def open(self, chat_id):
+        engine = create_engine(
+            f'sqlite:///{self.path(chat_id)}', poolclass=QueuePool,
+            pool_size=2, max_overflow=8,
+            connect_args={'check_same_thread': False})
+        catalog = self.catalog
+
+        @event.listens_for(engine, 'connect')
+        def attach(connection, record):
+            connection.execute('ATTACH DATABASE ? AS catalog', (catalog,))
+
+        if chat_id not in self.chats:
+            set_wal(engine)
+            Base.metadata.create_all(engine, tables=chat_tables())
+            self.chats.add(chat_id)
+
+        if self.fulltext and not engine.has_table('quote_fts'):
+            try:
+                with engine.begin() as connection:
+                    for statement in FULLTEXT_DDL:
+                        connection.execute(statement)
+            except OperationalError:
+                logging.warning("FTS5 is unavailable; using substring search")
+                self.fulltext = False
+
+        self.opened += 1
+        return engine
+
+    def close(self, chat_id):
+        """Disposes of a chat's engine, if it's open."""
+        with self.lock:
+            engine = self.engines.pop(chat_id, None)
+
+        if engine is not None:
+            engine.dispose()
+
+    def rename(self, from_id, to_id):
+        """Moves a chat's file to a new chat ID."""
+        self.close(from_id)
+
+        with self.lock:
+            if from_id not in self.chats:
+                return
+
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.path(from_id) + suffix):
+                    os.replace(self.path(from_id) + suffix,
+                        self.path(to_id) + suffix)
+
+            self.chats.discard(from_id)
+            self.chats.add(to_id)
+
+    def metrics(self):
+        with self.lock:
+            return {'chats': len(self.chats), 'open': len(self.engines),
+                'opened': self.opened, 'evicted': self.evicted}
+
+
+class ChatQuery(ShardedQuery):
+    def _execute_and_instances(self, context):
+        # Baked queries reuse their context, which keeps the shard the query
+        # last ran on
+        context.identity_token = self._refresh_identity_token
+        return super()._execute_and_instances(context)
+
+
+class ChatSession(ShardedSession):
+    """A session that runs statements on the file of the chat it's routed
+    to (see ShardedQuoteDatabase.route), and on the catalog for statements
+    that only use its tables."""
+
+    def __init__(self, database, **kwargs):
+        super().__init__(
+            shard_chooser=self.choose_shard, id_chooser=self.choose_ids,
+            query_chooser=self.choose_query, query_cls=ChatQuery, **kwargs)
+        self.database = database
+
+        # Engines used by this session, which are kept even if the pool
+        # evicts them, so that each file has one connection
+        self.engines = {}
+
+    @property
+    def chat_id(self):
+        return self.info.get('chat_id')
+
+    def get_bind(self, mapper=None, shard_id=None, instance=None, clause=None,
+            **kwargs):
+        if shard_id is None:
+            shard_id = self._choose_shard_and_assign(
+                mapper, instance, clause=clause)
+
+        engine = self.engines.get(shard_id)
+
+        if engine is None:
+            engine = self.engines[shard_id] = self.database.shard_engine(
+                shard_id)
+
+        return engine
+
+    def connection(self, mapper=None, instance=None, shard_id=None, **kwargs):
+        # Catalog rows are written to the catalog, even if they were loaded
+        # through a chat's file, so that only one connection writes to it
+        if instance is not None and not self.in_chat(mapper.local_table):
+            self._choose_shard_and_assign(mapper, instance)
+            shard_id = CATALOG
+
+        return super().connection(mapper, instance, shard_id, **kwargs)
+
+    @staticmethod
+    def in_chat(table):
+        return table.name in CHAT_NAMES
+
+    def current_chat(self):
+        if self.chat_id is None:
+            raise RuntimeError("the session isn't routed to a chat")
+        return self.chat_id
+
+    def choose_shard(self, mapper, instance, clause=None):
+        if instance is not None:
+            if not self.in_chat(mapper.local_table):
+                return CATALOG
+            return self.database.chat_of(self, instance)
+
+        if clause is not None:
+            names = table_names(clause)
+
+            # Writes to the catalog go to the catalog, and so does anything
+            # that only reads it
+            if isinstance(clause, UpdateBase) and not self.in_chat(clause.table):
+                return CATALOG
+        elif mapper is not None:
+            names = {mapper.local_table.name}
+        else:
+            names = set()
+
+        if not names & CHAT_NAMES:
+            return CATALOG
+        return self.current_chat()
+
+    # Baked queries are kept with the session they were first made for, so
+    # these look at the session the query runs in
+
+    @staticmethod
+    def choose_ids(query, ident):
+        session = query.session
+        table = query._mapper_zero().local_table
+
+        if not session.in_chat(table):
+            return [CATALOG]
+        if table.name == 'quote':
+            chat_id = session.database.quote_chat(session, ident[0])
+            return [] if chat_id is None else [chat_id]
+        if table.name in ('quote_bag', 'daily_stats'):
+            return [ident[0]]
+        if session.chat_id is not None:
+            return [session.chat_id]
+        return session.database.shards.chat_ids()
+
+    @staticmethod
+    def choose_query(query):
+        session = query.session
+        names = table_names(query.statement)
+
+        # Baked queries that wrap another, such as counts, don't show their
+        # tables, and go to the chat too
+        if names and not names & CHAT_NAMES:
+            return [CATALOG]
+        if session.chat_id is not None:
+            return [session.chat_id]
+        if not names:
+            return [CATALOG]
+
+        # Nothing says which chat this is for, so every chat is asked
+        return session.database.shards.chat_ids()
+
+
+def _routed(key, method):
+    """Wraps a QuoteDatabase method so that it routes the session to the
+    chat given as the argument key, or to the chat of the quote given as
+    key."""
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, session, *args, **kwargs):
+        value = signature.bind(self, session, *args, **kwargs).arguments[key]
+
+        if key == 'quote_id':
+            value = self.quote_chat(session, value)
+
+        if value is None:
+            return method(self, session, *args, **kwargs)
+
+        self.route(session, value)
+        result = method(self, session, *args, **kwargs)
+
+        # Queries are run later, when the session might be routed elsewhere
+        if isinstance(result, ShardedQuery):
+            result = result.set_shard(value)
+
+        return result
+
+    return wrapper
+
+
+class ShardedQuoteDatabase(QuoteDatabase):
+    """A QuoteDatabase that keeps each chat's quotes, votes, quote messages,
+    rollups and shuffle bag in a file of its own in directory (see
+    ShardPool), and everything else in the catalog, filename.
+
+    Methods that take a chat or quote route the session to that chat's file
+    until another chat is used. Objects are written to their chat's file,
+    and statements that only use catalog tables are run on the catalog.
+    Queries that aren't for any chat in particular are run on every chat's
+    file and their results put together.
+
+    The files are in WAL mode, so that chats' connections can read the
+    catalog while it's written. A session that writes to the catalog and a
+    chat commits to each file in turn, so a crash between the two can leave
+    a quote's index entry without its quote; quote IDs are still never
+    reused. Batches of updates aren't supported."""
+
+    def __init__(self, filename='data.db', directory='shards', fulltext=False,
+            pool_size=64):
+        self.shards = ShardPool(
+            filename, directory, size=pool_size, fulltext=fulltext)
+
+        # Chats of quotes looked up in the index
+        self.quote_chats = {}
+        self.max_quote_chats = 100000
+
+        # Chats that sessions created on this thread are routed to
+        self.pinned = threading.local()
+
+        super().__init__(filename, fulltext=fulltext)
+
+    def create_schema(self, fulltext=False):
+        set_wal(self.engine)
+        Base.metadata.create_all(self.engine, tables=catalog_tables())
+        quote_index_table.create(self.engine, checkfirst=True)
+
+    def has_fulltext_index(self):
+        return self.shards.fulltext
+
+    def _session_factory(self):
+        factory = sessionmaker(class_=ChatSession, database=self)
+        event.listen(factory, 'before_flush', self._assign_quote_ids)
+        return factory
+
+    def create_session(self, **kwargs):
+        session = super().create_session(**kwargs)
+        chat_id = getattr(self.pinned, 'chat_id', None)
+
+        if chat_id is not None:
+            self.route(session, chat_id)
+
+        return session
+
+    def files(self):
+        return [self.filename] + [
+            self.shards.path(chat_id) for chat_id in self.shards.chat_ids()]
+
+    def begin_batch(self):
+        raise NotImplementedError("batches aren't supported with shards")
+
+    def backfill_daily_stats(self, batch_size=1000, pause=0.1):
+        # Databases are rolled up before they're split (see split)
+        if not self.daily_stats_ready:
+            raise NotImplementedError(
+                "daily rollups can't be backfilled once a database is split")
+        return 0
+
+    def data_version(self, session):
+        # Quotes' IDs are all in the index, which saves opening every file
+        return (session.execute(
+                select([func.max(quote_index_table.c.id)])).scalar() or 0,
+            session.query(func.count(ArchivedQuote.id)).scalar())
+
+    def _has_quotes(self, connection):
+        return connection.execute(
+            select([quote_index_table.c.id]).limit(1)).first() is not None
+
+    # Routing
+
+    def shard_engine(self, shard_id):
+        if shard_id == CATALOG:
+            return self.engine
+        return self.shards.engine(shard_id)
+
+    def route(self, session, chat_id):
+        """Routes the session's statements that use chats' tables to a chat's
+        file."""
+        session.info['chat_id'] = chat_id
+
+    def quote_chat(self, session, quote_id):
+        """Returns the ID of the chat a quote is in, or None if there's no
+        such quote."""
+        chat_id = self.quote_chats.get(quote_id)
+
+        if chat_id is None and quote_id is not None:
+            chat_id = session.info.setdefault('quote_chats', {}).get(quote_id)
+
+        if chat_id is None and quote_id is not None:
+            chat_id = session.execute(select([quote_index_table.c.chat_id])
+                .where(quote_index_table.c.id == quote_id)).scalar()
+
+            if chat_id is not None:
+                self._quote_chat_found(session, quote_id, chat_id)
+
+        return chat_id
+
+    def _quote_chat_found(self, session, quote_id, chat_id):
+        # The index entry might not be committed yet, and the ID would be
+        # handed out again if it's rolled back, so other sessions only see
+        # it once it's committed
+        session.info.setdefault('quote_chats', {})[quote_id] = chat_id
+        self.on_commit(session, functools.partial(
+            self._cache_quote_chat, quote_id, chat_id))
+
+    def _cache_quote_chat(self, quote_id, chat_id):
+        if len(self.quote_chats) >= self.max_quote_chats:
+            self.quote_chats.clear()
+        self.quote_chats[quote_id] = chat_id
+
+    def chat_of(self, session, instance):
+        """Returns the ID of the chat whose file an object is written to:
+        that of its quote, or its own chat."""
+        quote = getattr(instance, 'quote', None)
+
+        if quote is not None:
+            return self.chat_of(session, quote)
+
+        # New objects might only have the chat itself
+        chat_id = getattr(instance, 'chat_id', None)
+
+        if chat_id is None and getattr(instance, 'chat', None) is not None:
+            chat_id = instance.chat.id
+        if chat_id is None and getattr(instance, 'quote_id', None) is not None:
+            chat_id = self.quote_chat(session, instance.quote_id)
+
+        return session.current_chat() if chat_id is None else chat_id
+
+    def _assign_quote_ids(self, session, context, instances):
+        # New quotes take the next ID from the index
+        for obj in session.new:
+            if not isinstance(obj, Quote) or obj.id is not None:
+                continue
+
+            chat_id = self.chat_of(session, obj)
+            sent_by_id = (obj.sent_by.id if obj.sent_by is not None
+                else obj.sent_by_id)
+            key = (quote_key(obj.sent_at, sent_by_id, obj.content_html)
+                if obj.sent_at is not None else 0)
+
+            obj.id = session.execute(quote_index_table.insert().values(
+                chat_id=chat_id, key=key)).inserted_primary_key[0]
+
+    # Methods for one chat or quote
+
+    get_user_score = _routed('chat_id', QuoteDatabase.get_user_score)
+    get_user_quotes = _routed('chat_id', QuoteDatabase.get_user_quotes)
+    rank_users = _routed('chat_id', QuoteDatabase.rank_users)
+    get_chat_stats = _routed('chat_id', QuoteDatabase.get_chat_stats)
+    get_user_scores = _routed('chat_id', QuoteDatabase.get_user_scores)
+    get_lowest_scoring = functools.partialmethod(get_user_scores, direction=-1)
+    get_highest_scoring = functools.partialmethod(get_user_scores, direction=1)
+
+    def get_quote_by_id(self, session, quote_id):
+        # Quotes are usually looked up in the chat the session is routed to,
+        # such as random quotes, which saves asking the index
+        chat_id = session.info.get('chat_id')
+
+        if chat_id is not None and quote_id not in self.quote_chats:
+            quote = (session.query(Quote).set_shard(chat_id)
+                .filter(Quote.id == quote_id).one_or_none())
+
+            if quote is not None:
+                self._quote_chat_found(session, quote_id, chat_id)
+                return quote
+
+        chat_id = self.quote_chat(session, quote_id)
+
+        if chat_id is None:
+            return None
+
+        self.route(session, chat_id)
+        return super().get_quote_by_id(session, quote_id)
+
+    get_quote_by_ids = _routed('chat_id', QuoteDatabase.get_quote_by_ids)
+    get_trending_quotes = _routed('chat_id', QuoteDatabase.get_trending_quotes)
+    get_quote_count = _routed('chat_id', QuoteDatabase.get_quote_count)
+    get_random_quote = _routed('chat_id', QuoteDatabase.get_random_quote)
+    search_quote = _routed('chat_id', QuoteDatabase.search_quote)
+    delete_quote = _routed('quote_id', QuoteDatabase.delete_quote)
+
+    get_sampler = _routed('chat_id', QuoteDatabase.get_sampler)
+    get_bag = _routed('chat_id', QuoteDatabase.get_bag)
+    save_bag = _routed('chat_id', QuoteDatabase.save_bag)
+    get_activity = _routed('chat_id', QuoteDatabase.get_activity)
+
+    add_message = _routed('chat_id', QuoteDatabase.add_message)
+    get_quote_messages = _routed('quote_id', QuoteDatabase.get_quote_messages)
+    get_quote_id_from_message = _routed(
+        'chat_id', QuoteDatabase.get_quote_id_from_message)
+
+    get_user_vote = _routed('quote_id', QuoteDatabase.get_user_vote)
+    add_vote = _routed('quote_id', QuoteDatabase.add_vote)
+    get_votes = _routed('chat_id', QuoteDatabase.get_votes)
+    get_votes_by_id = _routed('quote_id', QuoteDatabase.get_votes_by_id)
+    add_daily_stats = _routed('chat_id', QuoteDatabase.add_daily_stats)
+
+    def add_quote(self, session, chat_id, message_id, is_forward,
+            sent_at, sent_by_id, message_type, content, content_html, file_id,
+            quoted_by_id, score=0):
+        # Quotes are unique across chats, so other chats with a quote of the
+        # same key are checked first
+        key = quote_key(sent_at, sent_by_id, content_html)
+        others = session.execute(select([quote_index_table.c.chat_id])
+            .where(and_(quote_index_table.c.key == key,
+                quote_index_table.c.chat_id != chat_id))
+            .distinct()).fetchall()
+
+        for other, in others:
+            self.route(session, other)
+            quote = (session.query(Quote)
+                .filter(Quote.sent_at == sent_at,
+                    Quote.sent_by_id == sent_by_id,
+                    Quote.content_html == content_html)
+                .one_or_none())
+
+            if quote is not None:
+                if quote.deleted:
+                    return None, self.QUOTE_PREVIOUSLY_DELETED
+                return quote, self.QUOTE_ALREADY_EXISTS
+
+        self.route(session, chat_id)
+        quote, status = super().add_quote(
+            session, chat_id, message_id, is_forward, sent_at, sent_by_id,
+            message_type, content, content_html, file_id, quoted_by_id, score)
+
+        if status == self.QUOTE_ADDED:
+            self._quote_chat_found(session, quote.id, chat_id)
+
+        return quote, status
+
+    def search_member_quote(self, session, user_id, expression):
+        """Returns a random quote matching the search expression from any chat
+        that the user is a member of, and the user who wrote the quote. Each
+        chat is searched in turn, and one is picked with a chance in
+        proportion to its matches, so every match is as likely as with one
+        file."""
+        query, params = compile_search(expression, fulltext=self.fulltext)
+        chat_ids = [chat_id for chat_id, in session.execute(
+            select([membership_table.c.chat_id])
+            .where(membership_table.c.user_id == user_id))]
+
+        chats = set(self.shards.chat_ids())
+        counts = []
+
+        for chat_id in chat_ids:
+            if chat_id not in chats:
+                continue
+
+            self.route(session, chat_id)
+            count = query(session).params(chat_id=chat_id, **params).count()
+
+            if count:
+                counts.append((chat_id, count))
+
+        if not counts:
+            return None, None
+
+        chat_id, = random.choices(
+            [chat_id for chat_id, _ in counts],
+            weights=[count for _, count in counts])
+        return self.search_quote(session, chat_id, expression)
+
+    def migrate_chat(self, session, from_id, to_id):
+        super().migrate_chat(session, from_id, to_id)
+
+        session.execute(quote_index_table.update()
+            .where(quote_index_table.c.chat_id == from_id)
+            .values(chat_id=to_id))
+
+        self.on_commit(session, functools.partial(
+            self._chat_migrated, from_id, to_id))
+
+    def _chat_migrated(self, from_id, to_id):
+        self.quote_chats.clear()
+
+        if from_id not in self.shards.chat_ids():
+            return
+
+        with self.shards.engine(from_id).begin() as connection:
+            for table in chat_tables():
+                # Votes only have their quote's ID
+                if 'chat_id' not in table.c:
+                    continue
+
+                connection.execute(table.update()
+                    .where(table.c.chat_id == from_id)
+                    .values(chat_id=to_id))
+
+        self.shards.rename(from_id, to_id)
+
+    # Maintenance, one chat at a time
+
+    def table_size(self, name):
+        if name not in CHAT_NAMES:
+            return super().table_size(name)
+
+        table = Base.metadata.tables[name]
+        rows = size = 0
+
+        for chat_id in self.shards.chat_ids():
+            with self.shards.engine(chat_id).connect() as connection:
+                rows += connection.execute(
+                    select([func.count()]).select_from(table)).scalar()
+
+                try:
+                    size += connection.execute(
+                        "SELECT sum(pgsize) FROM main.dbstat WHERE name = ?",
+                        name).scalar() or 0
+                except OperationalError:
+                    size = None
+
+        return rows, size
+
+    def compact_quote_messages(self, max_age, batch_size=500, pause=0.1):
+        deleted = 0
+
+        for chat_id in self.shards.chat_ids():
+            self.pinned.chat_id = chat_id
+
+            try:
+                deleted += super().compact_quote_messages(
+                    max_age, batch_size=batch_size, pause=pause)
+            finally:
+                self.pinned.chat_id = None
+
+        return deleted
+
+    def archive_deleted_quotes(self, batch_size=200, pause=0.1):
+        """Moves deleted quotes, with their votes and messages, into the
+        archive tables in the catalog, a chat and a batch at a time. Each
+        batch is written through the chat's connection in one transaction,
+        though in WAL mode a crash can still commit it to one file and not
+        the other; the next run then archives the batch again. Returns the
+        number of quotes archived."""
+        archived_at = datetime.datetime.now()
+        archived = 0
+
+        for chat_id in self.shards.chat_ids():
+            engine = self.shards.engine(chat_id)
+
+            while True:
+                with engine.begin() as connection:
+                    quotes = connection.execute(select([Quote.__table__])
+                        .where(Quote.deleted == True)
+                        .order_by(Quote.id)
+                        .limit(batch_size)).fetchall()
+
+                    if not quotes:
+                        break
+
+                    quote_ids = [quote.id for quote in quotes]
+                    rows = [dict(quote,
+                        archived_at=archived_at,
+                        key=quote_key(
+                            quote.sent_at, quote.sent_by_id, quote.content_html))
+                        for quote in quotes]
+
+                    for row in rows:
+                        del row['deleted'], row['hotness']
+
+                    connection.execute(ArchivedQuote.__table__.insert()
+                        .prefix_with('OR IGNORE'), rows)
+
+                    # Votes' and messages' IDs are only unique within a
+                    # chat's file, so the archive numbers them itself. Any
+                    # rows from an attempt whose delete wasn't committed
+                    # are replaced
+                    for hot, cold in ((Vote, ArchivedVote),
+                            (QuoteMessage, ArchivedQuoteMessage)):
+                        columns = [column.name
+                            for column in cold.__table__.columns
+                            if column.name != 'id']
+
+                        connection.execute(cold.__table__.delete()
+                            .where(cold.quote_id.in_(quote_ids)))
+                        connection.execute(cold.__table__.insert()
+                            .from_select(columns, select(
+                                [hot.__table__.c[name] for name in columns])
+                            .where(hot.quote_id.in_(quote_ids))))
+
+                        connection.execute(hot.__table__.delete()
+                            .where(hot.quote_id.in_(quote_ids)))
+
+                    connection.execute(Quote.__table__.delete()
+                        .where(Quote.id.in_(quote_ids)))
+
+                self._quotes_archived([row['key'] for row in rows])
+                archived += len(quotes)
+
+                time.sleep(pause)
+
+        return archived
+
+
+# Splitting a database
+
+SplitReport = collections.namedtuple('SplitReport', 'chats quotes orphans')
+
+
+def _copy(connection, table, where, *params):
+    columns = ', '.join(f'"{column.name}"' for column in table.columns)
+
+    return connection.execute(
+        f'INSERT INTO main."{table.name}" ({columns}) '
+        f'SELECT {columns} FROM source."{table.name}" WHERE {where}',
+        *params).rowcount
+
+
+def split(source, catalog='data.db', directory='shards', fulltext=False):
+    """Copies a database into a catalog and a file per chat. The source's
+    daily rollups are finished first, and the source is left as it was
+    otherwise. Returns a SplitReport with the number of rows copied into each
+    chat's file, by table, and the number of rows that belong to no chat."""
+    if os.path.exists(catalog):
+        raise FileExistsError(f"{catalog} already exists")
+    if glob.glob(os.path.join(directory, 'chat*.db')):
+        raise FileExistsError(f"{directory} already has chats' files")
+
+    original = QuoteDatabase(source)
+    original.backfill_daily_stats(pause=0)
+    source = os.path.abspath(source)
+
+    database = ShardedQuoteDatabase(catalog, directory, fulltext=fulltext)
+
+    with database.engine.connect() as connection:
+        connection.execute('ATTACH DATABASE ? AS source', source)
+
+        with connection.begin():
+            connection.execute(quote_index_table.delete())
+
+            for table in catalog_tables():
+                connection.execute(table.delete())
+                _copy(connection, table, '1')
+
+    with original.engine.connect() as connection:
+        quotes = connection.execute(select([
+            Quote.id, Quote.chat_id, Quote.sent_at, Quote.sent_by_id,
+            Quote.content_html])).fetchall()
+        archived = connection.execute(select([
+            ArchivedQuote.id, ArchivedQuote.chat_id, ArchivedQuote.key])
+            ).fetchall()
+
+    orphans = sum(chat_id is None for _, chat_id, _, _, _ in quotes)
+
+    with database.engine.begin() as connection:
+        connection.execute(quote_index_table.insert(), [
+            {'id': quote_id, 'chat_id': chat_id, 'key': quote_key(
+                sent_at, sent_by_id, content_html) if sent_at else 0}
+            for quote_id, chat_id, sent_at, sent_by_id, content_html in quotes
+            if chat_id is not None] + [
+            {'id': quote_id, 'chat_id': chat_id or 0, 'key': key}
+            for quote_id, chat_id, key in archived])
+
+    with original.engine.connect() as connection:
+        chat_ids = sorted({chat_id for chat_id, in connection.execute(
+            ' UNION '.join(f'SELECT chat_id FROM "{name}"'
+                for name in ('quote', 'quote_message', 'daily_stats',
+                    'quote_bag')))
+            if chat_id is not None})
+
+    tables = {table.name: table for table in chat_tables()}
+    in_chat = 'quote_id IN (SELECT id FROM source.quote WHERE chat_id = ?)'
+    report = {}
+
+    for chat_id in chat_ids:
+        engine = database.shards.engine(chat_id)
+
+        with engine.connect() as connection:
+            connection.execute('ATTACH DATABASE ? AS source', source)
+
+            with connection.begin():
+                report[chat_id] = {
+                    'quote': _copy(
+                        connection, tables['quote'], 'chat_id = ?', chat_id),
+                    'vote': _copy(
+                        connection, tables['vote'], in_chat, chat_id),
+                    'quote_message': _copy(
+                        connection, tables['quote_message'],
+                        f'{in_chat} OR (quote_id IS NULL AND chat_id = ?)',
+                        chat_id, chat_id),
+                    'daily_stats': _copy(
+                        connection, tables['daily_stats'], 'chat_id = ?',
+                        chat_id),
+                    'quote_bag': _copy(
+                        connection, tables['quote_bag'], 'chat_id = ?',
+                        chat_id),
+                }
+
+            connection.execute('DETACH DATABASE source')
+
+        database.shards.close(chat_id)
+
+    return SplitReport(chats=report, quotes=len(quotes), orphans=orphans)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser('split', help=split.__doc__.split('.')[0])
+    command.add_argument('source')
+    command.add_argument('--catalog', default='data.db')
+    command.add_argument('--directory', default='shards')
+    command.add_argument('--fulltext', action='store_true')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    report = split(args.source, catalog=args.catalog,
+        directory=args.directory, fulltext=args.fulltext)
+
+    for chat_id, counts in report.chats.items():
+        print(f'{chat_id}: ' + ', '.join(
+            f'{count} {name}' for name, count in counts.items()))
+
+    print(f'{len(report.chats)} chats, {report.quotes} quotes; '
+        f'{report.orphans} quotes without a chat were left out')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Saves the database's in-memory state, such as random quote samplers and
+activity snapshots, to a file when the bot stops, and loads it when the bot
+starts again, so that the first chats to use the bot don't wait for it to
+be rebuilt from the database.
+
+A snapshot is only loaded by the run right after the one that saved it, and
+only if no quotes have been added or archived since; otherwise it's
+ignored, and the state is loaded from the database on first use as usual.
+Snapshots are deleted once loaded, so that a worker that's restarted
+doesn't load a snapshot that's out of date."""
+
+import os
+import struct
+import time
+import zlib
+
+from soup.activity import ActivitySnapshot, numpy
+from soup.archive import KeySet
+from soup.sampling import ShuffleBag, WeightedSampler
+
+MAGIC = b'SOUPSNAP'
+FORMAT = 1
+
+# Format, run, highest quote ID, archived quotes and number of sections
+HEADER = struct.Struct('<Hqqqi')
+
+# Kind, chat ID and length of a section
+SECTION = struct.Struct('<Bqi')
+
+# Kinds of sections
+SAMPLER = 1
+BAG = 2
+ACTIVITY = 3
+ARCHIVED_KEYS = 4
+
+# The number of times the bot has started
+RUN = 'run'
+
+
+def start_run(database):
+    """Counts a start of the bot. Returns the new run's number."""
+    with database.session_scope() as session:
+        run = int(database.get_state(session, RUN) or 0) + 1
+        database.set_state(session, RUN, str(run))
+
+    return run
+
+
+def current_run(database):
+    with database.session_scope() as session:
+        return int(database.get_state(session, RUN) or 0)
+
+
+def _sections(database):
+    for chat_id, sampler in list(database.samplers.items()):
+        yield SAMPLER, chat_id, sampler.dumps()
+
+    for chat_id, bag in list(database.bags.items()):
+        yield BAG, chat_id, struct.pack('<q', bag.high_water) + bag.dumps()
+
+    for chat_id, snapshot in list(database.activity.items()):
+        yield ACTIVITY, chat_id, snapshot.dumps()
+
+    if database.archived_keys is not None:
+        yield ARCHIVED_KEYS, 0, database.archived_keys.dumps()
+
+
+def save_snapshot(database, path):
+    """Saves the database's in-memory state to a file, replacing it
+    atomically. Returns a line saying what was saved."""
+    started_at = time.monotonic()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    with database.session_scope() as session:
+        max_quote_id, archived = database.data_version(session)
+
+    sections = list(_sections(database))
+    body = bytearray(MAGIC)
+    body += HEADER.pack(
+        FORMAT, current_run(database), max_quote_id, archived, len(sections))
+
+    for kind, chat_id, data in sections:
+        body += SECTION.pack(kind, chat_id, len(data))
+        body += data
+
+    body += struct.pack('<I', zlib.crc32(body))
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(body)
+
+    os.replace(path + '.tmp', path)
+
+    return "saved {0} sections ({1} bytes) in {2:.0f} ms".format(
+        len(sections), len(body), (time.monotonic() - started_at) * 1000)
+
+
+def read_snapshot(path):
+    """Returns a snapshot's header and its sections, as (kind, chat ID,
+    data) tuples. Raises ValueError if the file isn't a whole snapshot."""
+    with open(path, 'rb') as f:
+        body = f.read()
+
+    if not body.startswith(MAGIC):
+        raise ValueError("not a snapshot")
+
+    if (len(body) < len(MAGIC) + HEADER.size + 4
+            or zlib.crc32(body[:-4]) != struct.unpack('<I', body[-4:])[0]):
+        raise ValueError("the snapshot is damaged")
+
+    offset = len(MAGIC)
+    header = HEADER.unpack_from(body, offset)
+    offset += HEADER.size
+
+    if header[0] != FORMAT:
+        raise ValueError(f"unknown snapshot format {header[0]}")
+
+    sections = []
+
+    for _ in range(header[4]):
+        kind, chat_id, length = SECTION.unpack_from(body, offset)
+        offset += SECTION.size
+        sections.append((kind, chat_id, body[offset:offset + length]))
+        offset += length
+
+    return header, sections
+
+
+def load_snapshot(database, path):
+    """Loads the state saved by save_snapshot into the database's caches,
+    if the snapshot was saved by the last run and no quotes have been added
+    or archived since, then deletes it. Caches that are already loaded are
+    kept. Returns a line saying what was loaded, or why nothing was."""
+    if not os.path.isfile(path):
+        return "no snapshot"
+
+    started_at = time.monotonic()
+
+    try:
+        header, sections = read_snapshot(path)
+    except (OSError, ValueError, struct.error) as e:
+        return f"snapshot ignored: {e}"
+    finally:
+        # A snapshot is only good for one start
+        os.remove(path)
+
+    _, run, max_quote_id, archived, _ = header
+
+    with database.session_scope() as session:
+        version = database.data_version(session)
+
+    if run != current_run(database) - 1:
+        return "snapshot ignored: it's from an earlier run"
+    if version != (max_quote_id, archived):
+        return "snapshot ignored: quotes were added or archived since"
+
+    counts = [0] * (ARCHIVED_KEYS + 1)
+
+    for kind, chat_id, data in sections:
+        if kind == SAMPLER:
+            database.samplers.setdefault(
+                chat_id, WeightedSampler.loads(data, database.quote_weight))
+        elif kind == BAG:
+            high_water, = struct.unpack_from('<q', data)
+            database.bags.setdefault(
+                chat_id, ShuffleBag.loads(data[8:], high_water=high_water))
+        elif kind == ACTIVITY:
+            if numpy is None:
+                continue
+            database.activity.setdefault(
+                chat_id, ActivitySnapshot.loads(data))
+        elif kind == ARCHIVED_KEYS:
+            # Quotes are archived by the bot's main process, so workers'
+            # keys can be missing some
+            if len(data) // 8 != archived or database.archived_keys is not None:
+                continue
+            database.archived_keys = KeySet.loads(data)
+            database.archived_count = archived
+        else:
+            continue
+
+        counts[kind] += 1
+
+    return ("loaded {0} samplers, {1} bags, {2} activity snapshots and "
+        "{3} archived key sets in {4:.0f} ms").format(
+            *counts[1:], (time.monotonic() - started_at) * 1000)
@@ -1,6 +1,7 @@
 from html import escape
 
-from soup.core import MAX_CAPTION_LENGTH, MAX_MESSAGE_LENGTH, TIME_FORMAT, TRUNCATE_LENGTH
+from soup.core import (
+    MAX_CAPTION_LENGTH, MAX_MESSAGE_LENGTH, TIME_FORMAT, TRUNCATE_LENGTH, database)
 
 
 def chunks(l, size):
@@ -9,26 +10,44 @@ def chunks(l, size):
         yield l[i:i + size]
 
 
-def send_quote(update, quote, sent_by, buttons):
+def send_quote(update, quote, sent_by, buttons, source=None):
     if quote.message_type == 'text':
-        response = format_quote(quote, sent_by, MAX_MESSAGE_LENGTH)
+        response = format_quote(quote, sent_by, MAX_MESSAGE_LENGTH, source)
 
         return update.message.reply_text(
             response, parse_mode='HTML', reply_markup=buttons)
 
     elif quote.message_type == 'photo':
-        caption = format_quote(quote, sent_by, MAX_CAPTION_LENGTH)
+        caption = format_quote(quote, sent_by, MAX_CAPTION_LENGTH, source)
 
         return update.message.reply_photo(
             quote.file_id, parse_mode='HTML', caption=caption, reply_markup=buttons)
 
 
-def format_quote(quote, sent_by, limit):
-    """Creates the Telegram message for a quote."""
+def remember_message(chat_id, quote_id, then=None):
+    """Returns a callback for when_sent that adds a sent message as a message
+    of a quote from the given chat, then calls then with the message if
+    given."""
+    def remember(message, session):
+        quote = database.get_quote_by_id(session, quote_id)
+        database.add_message(session, chat_id, message.message_id, quote)
+
+        if then is not None:
+            then(message)
+
+    return remember
+
+
+def format_quote(quote, sent_by, limit, source=None):
+    """Creates the Telegram message for a quote. If given, the title of the
+    chat the quote is from is shown after the date."""
     text = quote.content_html
     name = sent_by.first_name
     date = quote.sent_at.strftime(TIME_FORMAT)
 
+    if source is not None:
+        date += f" in {escape(source)}"
+
     if not text:
         assert quote.message_type == 'photo'
         return f"[no caption] - {name}\n{date}"
@@ -0,0 +1,378 @@
+"""Runs the bot's handlers in several processes, so that handling updates
+isn't held to one core by the GIL. A supervisor receives each update once
+and forwards it to the worker process that owns its chat."""
+
+import collections
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import zlib
+
+from telegram import Update
+from telegram.ext import Handler
+
+# Keys of updates that belong to a chat
+CHAT_UPDATES = ['message', 'edited_message', 'channel_post', 'edited_channel_post']
+
+# Keys of updates that belong to the user who sent them
+USER_UPDATES = ['inline_query', 'chosen_inline_result', 'shipping_query',
+    'pre_checkout_query']
+
+
+def chat_key(data):
+    """Returns the ID of the chat an update, as a dictionary, belongs to:
+    its chat, the chat of a callback query's message, or otherwise the
+    user who sent it, whose private chat has the same ID. Returns None for
+    updates from no one in particular."""
+    for key in CHAT_UPDATES:
+        if key in data:
+            return data[key]['chat']['id']
+
+    query = data.get('callback_query')
+
+    if query is not None:
+        message = query.get('message')
+
+        # Queries from inline messages have no chat
+        if message is not None:
+            return message['chat']['id']
+        return query['from']['id']
+
+    for key in USER_UPDATES:
+        if key in data:
+            return data[key]['from']['id']
+
+    return None
+
+
+def shard(key, workers):
+    """Returns the index of the worker that owns a chat. IDs are hashed, since
+    they have patterns of their own, such as supergroups' -100 prefix, and
+    with CRC-32, which is the same in every process."""
+    if key is None:
+        return 0
+
+    return zlib.crc32(str(key).encode()) % workers
+
+
+def run_worker(target, index, workers, connection):
+    """The worker processes' main function. Handles the updates received on
+    the connection, in order, with the dispatcher returned by
+    target(index, workers), and sends back the ID of each once handled.
+
+    The dispatcher can send a message to the worker that owns a chat with
+    dispatcher.send_to_owner(chat_id, message); the owner calls each of its
+    dispatcher's on_message callbacks with the chat's ID and the message."""
+    # The supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    dispatcher = target(index, workers)
+    outbox = getattr(dispatcher.bot, 'outbox', None)
+
+    def send_to_owner(chat_id, message):
+        # Only the dispatcher's thread sends on the connection
+        connection.send((chat_id, message))
+
+    dispatcher.send_to_owner = send_to_owner
+
+    # Ready for updates
+    connection.send(None)
+
+    def run_callbacks():
+        # Callbacks of sent messages are put in the dispatcher's queue
+        while True:
+            try:
+                item = dispatcher.update_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            dispatcher.process_update(item)
+
+    while True:
+        run_callbacks()
+
+        if not connection.poll(0.05):
+            continue
+
+        data = connection.recv()
+
+        if data is None:
+            break
+
+        if isinstance(data, tuple):
+            for callback in getattr(dispatcher, 'on_message', ()):
+                callback(*data)
+            continue
+
+        dispatcher.process_update(Update.de_json(data, dispatcher.bot))
+        connection.send(data['update_id'])
+
+    if outbox is not None:
+        outbox.stop()
+        run_callbacks()
+
+    # Save state kept in memory, such as conversations
+    for callback in getattr(dispatcher, 'on_stop', ()):
+        callback()
+
+    connection.close()
+
+
+class _Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.connection = None
+
+        # Updates forwarded but not yet handled, by ID, with the number of
+        # times each has been sent
+        self.unacked = collections.OrderedDict()
+
+        self.forwarded = 0
+        self.handled = 0
+        self.restarts = 0
+        self.dropped = 0
+
+        # When recent updates were handled
+        self.times = collections.deque()
+        self.ready = threading.Event()
+
+        # Sends are made in order under send_lock; the counts above are
+        # only changed under lock
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+
+
+class Supervisor:
+    """Forwards updates, as dictionaries, to worker processes that handle
+    them with a dispatcher each.
+
+    Every chat belongs to one worker, chosen by its ID, so a chat's updates
+    are handled in order and each worker's caches only hold its own chats.
+    Direct messages belong to the worker of the user's private chat, which
+    keeps their conversations in one process; commands there about another
+    worker's chat read it from the database without caching it (see
+    QuoteDatabase.owns_chat), and changes to it, such as votes, are passed on
+    to its worker (see run_worker). The workers' dispatchers are made by
+    target(index, workers), which is called in the worker and has to be
+    importable, since workers are started with start_method.
+
+    A worker that dies is started again, and is sent the updates it hadn't
+    finished, in order; an update that has been sent max_attempts times is
+    dropped instead, so that an update which kills its worker can't do so
+    forever. on_handled, if given, is called with the ID of each update
+    once it has been handled."""
+
+    def __init__(self, target, workers=2, start_method='spawn', max_attempts=3,
+            on_handled=None):
+        self.target = target
+        self.max_attempts = max_attempts
+        self.on_handled = on_handled
+
+        self.context = multiprocessing.get_context(start_method)
+        self.workers = [_Worker(i) for i in range(workers)]
+        self.stopping = False
+        self.logger = logging.getLogger(__name__)
+
+        # Messages between workers, passed on by a thread of their own so
+        # that a busy worker doesn't hold up the others' readers
+        self.messages = queue.Queue()
+
+    def start(self):
+        for worker in self.workers:
+            with worker.send_lock:
+                self.spawn(worker)
+
+        threading.Thread(
+            target=self.pass_messages, name='worker_messages',
+            daemon=True).start()
+
+        return self
+
+    def wait_ready(self, timeout=None):
+        """Waits until every worker has set up its dispatcher. Returns
+        whether they all did in time."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        return all(worker.ready.wait(
+                None if deadline is None else max(0, deadline - time.monotonic()))
+            for worker in self.workers)
+
+    def spawn(self, worker):
+        connection, child = self.context.Pipe()
+        worker.ready.clear()
+
+        worker.process = self.context.Process(
+            target=run_worker, name=f'worker_{worker.index}',
+            args=(self.target, worker.index, len(self.workers), child))
+        worker.process.start()
+        worker.connection = connection
+
+        # The pipe ends once the worker has exited, which the reader sees
+        child.close()
+
+        threading.Thread(
+            target=self.read, args=(worker, connection),
+            name=f'worker_{worker.index}_reader', daemon=True).start()
+
+    def submit(self, data):
+        """Forwards an update to the worker that owns its chat."""
+        worker = self.workers[shard(chat_key(data), len(self.workers))]
+
+        with worker.send_lock:
+            with worker.lock:
+                worker.unacked[data['update_id']] = [data, 1]
+                worker.forwarded += 1
+
+            try:
+                worker.connection.send(data)
+            except (OSError, ValueError):
+                # The worker has died; it gets the update when it restarts
+                pass
+
+    def read(self, worker, connection):
+        while True:
+            try:
+                update_id = connection.recv()
+            except (EOFError, OSError):
+                break
+
+            if update_id is None:
+                worker.ready.set()
+                continue
+
+            if isinstance(update_id, tuple):
+                self.messages.put(update_id)
+                continue
+
+            with worker.lock:
+                worker.unacked.pop(update_id, None)
+                worker.handled += 1
+                worker.times.append(time.monotonic())
+
+            if self.on_handled is not None:
+                self.on_handled(update_id)
+
+        connection.close()
+
+        if not self.stopping:
+            self.restart(worker)
+
+    def pass_messages(self):
+        """Passes messages from one worker on to the worker that owns their
+        chat. Messages to a worker that has died are dropped, since it
+        starts again from the database."""
+        while True:
+            item = self.messages.get()
+
+            if item is None:
+                return
+
+            worker = self.workers[shard(item[0], len(self.workers))]
+
+            with worker.send_lock:
+                try:
+                    worker.connection.send(item)
+                except (OSError, ValueError):
+                    pass
+
+    def restart(self, worker):
+        """Starts a dead worker again, and sends it the updates it hadn't
+        finished."""
+        worker.process.join(5)
+
+        with worker.send_lock:
+            if self.stopping:
+                return
+
+            self.logger.warning(
+                'worker %s exited with code %s, restarting',
+                worker.index, worker.process.exitcode)
+            self.spawn(worker)
+
+            with worker.lock:
+                worker.restarts += 1
+
+                for update_id, item in list(worker.unacked.items()):
+                    if item[1] >= self.max_attempts:
+                        del worker.unacked[update_id]
+                        worker.dropped += 1
+                        self.logger.error(
+                            'dropped update %s after %s attempts',
+                            update_id, item[1])
+                    else:
+                        item[1] += 1
+
+                resend = [data for data, _ in worker.unacked.values()]
+
+            for data in resend:
+                try:
+                    worker.connection.send(data)
+                except (OSError, ValueError):
+                    break
+
+    def metrics(self, window=60):
+        """Returns the number of updates each worker has been forwarded,
+        handled and not yet finished, its updates a second over the last
+        window seconds, and how many times it has been restarted."""
+        now = time.monotonic()
+        metrics = []
+
+        for worker in self.workers:
+            with worker.lock:
+                while worker.times and worker.times[0] < now - window:
+                    worker.times.popleft()
+
+                metrics.append({
+                    'worker': worker.index,
+                    'pid': worker.process.pid if worker.process else None,
+                    'forwarded': worker.forwarded,
+                    'handled': worker.handled,
+                    'in_flight': len(worker.unacked),
+                    'per_second': round(len(worker.times) / window, 2),
+                    'restarts': worker.restarts,
+                    'dropped': worker.dropped,
+                })
+
+        return metrics
+
+    def stop(self, timeout=30):
+        """Lets the workers finish the updates they've been sent, waiting
+        for up to timeout seconds, then stops them."""
+        self.stopping = True
+        self.messages.put(None)
+        deadline = time.monotonic() + timeout
+
+        for worker in self.workers:
+            with worker.send_lock:
+                try:
+                    worker.connection.send(None)
+                except (OSError, ValueError):
+                    pass
+
+        for worker in self.workers:
+            worker.process.join(max(0, deadline - time.monotonic()))
+
+            if worker.process.is_alive():
+                self.logger.warning(
+                    "worker %s didn't stop in time", worker.index)
+                worker.process.terminate()
+                worker.process.join()
+
+
+class Forwarder(Handler):
+    """Forwards every update to a Supervisor's workers, in place of the
+    bot's own handlers."""
+
+    def __init__(self, supervisor):
+        super().__init__(None)
+        self.supervisor = supervisor
+
+    def check_update(self, update):
+        return isinstance(update, Update)
+
+    def handle_update(self, update, dispatcher):
+        self.supervisor.submit(update.to_dict())
@@ -0,0 +1,149 @@
+import collections
+import datetime
+import random
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from soup.activity import (
+    ActivitySnapshot, render_heatmap, render_trend, to_seconds)
+
+
+def random_quotes(count, senders=(1, 2, 3)):
+    start = datetime.datetime(2017, 1, 1)
+
+    for quote_id in range(1, count + 1):
+        sent_at = start + datetime.timedelta(
+            seconds=random.randrange(3 * 365 * 86400))
+        yield quote_id, sent_at, random.choice(senders), random.randint(-4, 10)
+
+
+def snapshot_rows(quotes):
+    return [(quote_id, to_seconds(sent_at), sender_id, score)
+        for quote_id, sent_at, sender_id, score in quotes]
+
+
+def month_of(sent_at):
+    return sent_at.year * 12 + sent_at.month - 1
+
+
+# Snapshot
+
+
+def test__heatmap__random_quotes__matches_python_counts():
+    quotes = list(random_quotes(500))
+    snapshot = ActivitySnapshot(snapshot_rows(quotes))
+
+    expected = collections.Counter(
+        (sent_at.weekday(), sent_at.hour) for _, sent_at, _, _ in quotes)
+    cells = snapshot.heatmap()
+
+    assert cells.sum() == len(quotes)
+
+    for (weekday, hour), count in expected.items():
+        assert cells[weekday, hour] == count
+
+
+def test__monthly__random_quotes__matches_python_counts_and_means():
+    quotes = list(random_quotes(500))
+    snapshot = ActivitySnapshot(snapshot_rows(quotes))
+
+    first_month, counts, totals, means = snapshot.monthly()
+    first = min(month_of(sent_at) for _, sent_at, _, _ in quotes)
+
+    assert str(first_month) == f"{first // 12}-{first % 12 + 1:02}"
+    assert totals[-1] == len(quotes)
+
+    by_month = collections.defaultdict(list)
+    for _, sent_at, _, score in quotes:
+        by_month[month_of(sent_at) - first].append(score)
+
+    for offset, scores in by_month.items():
+        assert counts[offset] == len(scores)
+        assert means[offset] == pytest.approx(sum(scores) / len(scores))
+
+
+def test__snapshot__appends_and_removals__match_rebuilt_snapshot():
+    quotes = list(random_quotes(300))
+    snapshot = ActivitySnapshot(snapshot_rows(quotes[:10]))
+
+    # Grows past its initial capacity
+    for quote in quotes[10:]:
+        snapshot.append(*quote)
+
+    removed = set(random.sample(range(1, 301), 50))
+    for quote_id in removed:
+        snapshot.remove(quote_id)
+
+    for quote_id in range(1, 301, 7):
+        snapshot.set_score(quote_id, 20)
+
+    expected = [(quote_id, sent_at, sender_id, 20 if quote_id % 7 == 1 else score)
+        for quote_id, sent_at, sender_id, score in quotes
+        if quote_id not in removed]
+    rebuilt = ActivitySnapshot(snapshot_rows(expected))
+
+    assert len(snapshot) == len(rebuilt) == 250
+    assert (snapshot.heatmap(sender_id=2) == rebuilt.heatmap(sender_id=2)).all()
+
+    for actual, reference in zip(snapshot.monthly(), rebuilt.monthly()):
+        assert (actual == reference).all()
+
+
+def test__snapshot__changes__bump_version():
+    snapshot = ActivitySnapshot()
+    assert snapshot.monthly() is None
+
+    snapshot.append(1, datetime.datetime(2019, 1, 31, 12), 1, 0)
+    snapshot.append(1, datetime.datetime(2019, 1, 31, 12), 1, 0)
+    assert snapshot.version == 1
+
+    snapshot.set_score(1, 3)
+    snapshot.remove(1)
+    snapshot.remove(1)
+    assert snapshot.version == 3
+
+
+def test__snapshot__derive__computed_again_after_a_change():
+    snapshot = ActivitySnapshot()
+    calls = []
+
+    def count():
+        calls.append(len(snapshot))
+        return len(snapshot)
+
+    assert snapshot.derive('count', count) == 0
+    assert snapshot.derive('count', count) == 0
+
+    snapshot.append(1, datetime.datetime(2019, 1, 31, 12), 1, 0)
+    assert snapshot.derive('count', count) == 1
+    assert calls == [0, 1]
+
+
+# Rendering
+
+
+def test__render_heatmap__busiest_cell__is_darkest():
+    cells = numpy.zeros((7, 24), dtype=numpy.int64)
+    cells[4, 22] = 10
+    cells[0, 9] = 1
+
+    text, peak = render_heatmap(cells)
+    lines = text.split('\n')
+
+    assert peak == "busiest: Fri 22:00"
+    assert lines[5] == 'Fri ' + ' ' * 22 + '█ '
+    assert lines[1][4 + 9] == '░'
+
+
+def test__render_trend__many_months__shows_last_months():
+    counts = numpy.arange(1, 25)
+    text = render_trend(
+        numpy.datetime64('2017-01'), counts, numpy.cumsum(counts),
+        numpy.zeros(24), months=12)
+    lines = text.split('\n')
+
+    assert len(lines) == 12
+    assert lines[0].startswith('2018-01')
+    assert lines[-1].startswith('2018-12 █   24 (300 total')
@@ -0,0 +1,51 @@
+import datetime
+import random
+
+from soup.archive import KeySet, quote_key
+from soup.classes import Chat, User
+from soup.database import QuoteDatabase
+
+
+def test__quote_key__same_fields__same_key():
+    sent_at = datetime.datetime(2019, 5, 1, 12, 30, 15, 250)
+    aware = sent_at.replace(tzinfo=datetime.timezone.utc)
+
+    assert quote_key(sent_at, 1, 'hi') == quote_key(aware, 1, 'hi')
+    assert quote_key(sent_at, 1, 'hi') != quote_key(sent_at, 2, 'hi')
+    assert quote_key(sent_at, 1, None) == quote_key(sent_at, 1, '')
+
+
+def test__key_set__random_keys__matches_python_set():
+    keys = {random.getrandbits(64) - 2 ** 63 for _ in range(1000)}
+    key_set = KeySet(list(keys)[:500], merge_size=100)
+
+    for key in list(keys)[400:]:
+        key_set.add(key)
+
+    assert len(key_set) == len(keys)
+    assert all(key in key_set for key in keys)
+    assert not any(key + 1 in key_set for key in keys if key + 1 not in keys)
+
+
+def test__is_archived__archived_by_another_process__keys_reloaded(tmpdir):
+    bot = QuoteDatabase(str(tmpdir.join('data.db')))
+    sent_at = datetime.datetime(2019, 5, 1, 12, 30)
+
+    with bot.session_scope() as session:
+        session.add(User(id=1, first_name='soup'))
+        session.add(Chat(id=-1, type='group', title='dumplings'))
+        quote, _ = bot.add_quote(session, -1, 1, False, sent_at, 1, 'text',
+            'hi', 'hi', '', 1)
+        bot.delete_quote(session, quote.id)
+
+        # The bot loads the keys before the quote is archived
+        assert not bot.is_archived(session, sent_at, 1, 'hi')
+
+    # Archived by the archive-quotes command
+    assert QuoteDatabase(str(tmpdir.join('data.db'))).archive_deleted_quotes(
+        pause=0) == 1
+
+    with bot.session_scope() as session:
+        assert bot.is_archived(session, sent_at, 1, 'hi')
+        assert bot.add_quote(session, -1, 2, False, sent_at, 1, 'text',
+            'hi', 'hi', '', 1) == (None, bot.QUOTE_PREVIOUSLY_DELETED)
@@ -0,0 +1,98 @@
+import gzip
+import os
+import sqlite3
+
+import soup.backup
+from soup.backup import backup, copy_database, rotate
+
+
+def create_database(path, rows=2000):
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE quote (id INTEGER PRIMARY KEY, content TEXT)')
+    connection.executemany('INSERT INTO quote (content) VALUES (?)',
+        (('quote %d ' % i * 10,) for i in range(rows)))
+    connection.commit()
+
+    return connection
+
+
+def count_quotes(path):
+    connection = sqlite3.connect(path)
+
+    try:
+        return connection.execute('SELECT count(*) FROM quote').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def test__backup__database__writes_compressed_copy(tmpdir):
+    source = str(tmpdir.join('data.db'))
+    create_database(source).close()
+
+    report = backup(source, str(tmpdir.join('backups')), pages=8, pause=0)
+
+    assert report.path.endswith('.db.gz')
+    assert report.steps > 1
+    assert report.compressed_size < report.size
+
+    copy = str(tmpdir.join('copy.db'))
+    with gzip.open(report.path, 'rb') as f, open(copy, 'wb') as out:
+        out.write(f.read())
+
+    assert count_quotes(copy) == 2000
+
+
+def test__copy_database__concurrent_writes__restarts_and_finishes(tmpdir, monkeypatch):
+    source = str(tmpdir.join('data.db'))
+    writer = create_database(source)
+
+    def write(seconds):
+        writer.execute("INSERT INTO quote (content) VALUES ('new')")
+        writer.commit()
+
+    # Another connection writes during every pause between steps
+    monkeypatch.setattr(soup.backup.time, 'sleep', write)
+
+    target = str(tmpdir.join('copy.db'))
+    _, _, restarts, _, _ = copy_database(
+        source, target, pages=8, max_restarts=2)
+
+    assert restarts == 2
+    assert count_quotes(target) == count_quotes(source)
+
+
+def test__copy_database__no_backup_api__copies_files_with_log(tmpdir, monkeypatch):
+    source = str(tmpdir.join('data.db'))
+    writer = sqlite3.connect(source)
+    writer.execute('PRAGMA journal_mode=WAL')
+    writer.execute('PRAGMA wal_autocheckpoint=0')
+    writer.close()
+
+    # The rows are only in the log while the writer is open
+    writer = create_database(source)
+    assert os.path.getsize(source + '-wal') > 0
+
+    monkeypatch.setattr(soup.backup, 'BACKUP_API', False)
+
+    target = str(tmpdir.join('copy.db'))
+    pages, steps, restarts, _, _ = copy_database(source, target)
+
+    assert (steps, restarts) == (1, 0) and pages > 1
+    assert not os.path.exists(target + '-wal')
+    assert count_quotes(target) == 2000
+
+    # The write lock was given back
+    writer.execute("INSERT INTO quote (content) VALUES ('new')")
+    writer.commit()
+    writer.close()
+
+
+def test__rotate__many_snapshots__keeps_newest(tmpdir):
+    for day in range(1, 6):
+        tmpdir.join(f'data-2019010{day}-000000.db.gz').write('')
+    tmpdir.join('other-20190101-000000.db.gz').write('')
+
+    assert rotate(str(tmpdir), 'data', 2) == 3
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'data-20190104-000000.db.gz', 'data-20190105-000000.db.gz',
+        'other-20190101-000000.db.gz']
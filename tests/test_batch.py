@@ -0,0 +1,53 @@
+import datetime
+import queue
+
+from sqlalchemy import event
+from telegram import Bot, Chat, Message, Update, User
+from telegram.ext import Dispatcher, Filters, MessageHandler
+
+from soup.batch import UpdateBatch
+from soup.database import QuoteDatabase
+
+
+def test__update_batch__backlog__commits_once(tmpdir):
+    db = QuoteDatabase(filename=str(tmpdir.join('batch.db')))
+    commits = []
+
+    event.listen(db.session_factory, 'after_commit',
+        lambda session: commits.append(session.transaction.nested))
+
+    def handle(bot, update):
+        with db.session_scope() as session:
+            db.add_or_update_user(session, update.message.from_user)
+
+            if update.message.text == 'fail':
+                raise ValueError
+
+    bot = Bot('123:token')
+    bot.bot = User(123, 'soup', True, username='soup_bot')
+
+    updates = queue.Queue()
+    dispatcher = Dispatcher(bot, updates, workers=0)
+    batch = UpdateBatch(db)
+
+    dispatcher.add_handler(batch.start, group=-1)
+    dispatcher.add_handler(MessageHandler(Filters.text, handle), group=0)
+    dispatcher.add_handler(batch.end, group=1)
+
+    chat = Chat(-1, Chat.GROUP)
+    date = datetime.datetime(2019, 1, 1)
+
+    for i in range(10):
+        user = User(i + 1, f'user {i}', False)
+        text = 'fail' if i == 3 else 'hi'
+        updates.put(Update(i, message=Message(i, user, date, chat, text=text, bot=bot)))
+
+    while not updates.empty():
+        dispatcher.process_update(updates.get())
+
+    assert commits.count(False) == 1
+
+    session = db.create_session()
+    assert db.get_user_by_id(session, 4) is None
+    assert all(db.get_user_by_id(session, i) for i in (1, 2, 3, 5, 10))
+    session.close()
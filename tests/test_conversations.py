@@ -0,0 +1,145 @@
+import threading
+import types
+from sqlalchemy import event
+
+from soup.classes import Chat
+from soup.conversations import ConversationStore, pack_ints, unpack_ints
+from soup.database import QuoteDatabase
+from soup.outbox import Sent
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.user_data = {}
+
+    def process_update(self, update):
+        update.callback(update.result, None)
+
+
+def start_store(db, dispatcher=None, **kwargs):
+    handler = types.SimpleNamespace(conversations={})
+    store = ConversationStore(db, handler, interval=3600, **kwargs)
+    store.start(dispatcher or FakeDispatcher())
+
+    return store, handler
+
+
+def count_statements(db):
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    return statements
+
+
+def test__pack_ints__negative_ids__unpacked_in_order():
+    ids = [-1001234567890, 5, -3]
+
+    assert unpack_ints(pack_ints(ids)) == ids
+    assert len(pack_ints(ids)) == 24
+    assert pack_ints([]) is None and unpack_ints(None) == []
+
+
+def test__conversation_store__restart__state_restored_on_first_use(tmpdir):
+    db = QuoteDatabase(str(tmpdir.join('data.db')))
+
+    with db.session_scope() as session:
+        session.add(Chat(id=-1, type='group', title='soup'))
+        session.add(Chat(id=-2, type='group', title='dumplings'))
+
+    store, handler = start_store(db)
+    store.user_data[1]['choices'] = [[0, -1, 'soup'], [1, -2, 'dumplings']]
+    store.user_data[1]['search_results'] = {10: -2}
+    handler.conversations[(1, 1)] = 1
+    store.user_data[2]['current'] = -1
+    handler.conversations[(2, 2)] = 2
+    # Users without anything to save aren't written
+    store.user_data[3]
+
+    assert store.flush() == 2
+    assert store.flush() == 0
+    store.stop()
+
+    # After a restart, nothing is loaded until a user is seen
+    store, handler = start_store(db)
+    statements = count_statements(db)
+    assert store.saved == {}
+
+    assert handler.conversations.get((1, 1)) == 1
+    assert store.user_data[1] == {
+        'choices': [[0, -1, 'soup'], [1, -2, 'dumplings']],
+        'search_results': {10: -2}}
+    assert store.user_data[2] == {'current': -1}
+    assert handler.conversations.get((2, 2)) == 2
+    assert handler.conversations.get((-1, 2)) is None
+
+    # One query for each user, and one for the choices' titles
+    assert len(statements) == 3
+
+    # Ending a conversation deletes its state
+    del handler.conversations[(1, 1)]
+    store.user_data[1].clear()
+    store.stop()
+
+    with db.session_scope() as session:
+        assert db.get_conversation(session, 1) is None
+        assert db.get_conversation(session, 2).current_chat_id == -1
+
+
+def test__conversation_store__idle_users__evicted_once_saved(tmpdir):
+    db = QuoteDatabase(str(tmpdir.join('data.db')))
+    store, handler = start_store(db, idle=0)
+
+    store.user_data[1]['current'] = -1
+    handler.conversations[(1, 1)] = 2
+
+    # Unsaved changes are kept
+    assert store.evict() == 0
+
+    store.flush()
+    assert store.evict() == 1
+    assert dict(store.user_data) == {} and dict(handler.conversations) == {}
+
+    assert store.user_data[1] == {'current': -1}
+    assert handler.conversations.get((1, 1)) == 2
+    store.stop()
+
+
+def test__conversation_store__flush_during_private_update__waits_for_it(tmpdir):
+    db = QuoteDatabase(str(tmpdir.join('data.db')))
+    dispatcher = FakeDispatcher()
+    store, handler = start_store(db, dispatcher)
+    private = types.SimpleNamespace(chat=types.SimpleNamespace(type='private'))
+
+    store.user_data[1]['current'] = -1
+    store.flush()
+
+    changing = threading.Event()
+    release = threading.Event()
+
+    def choose(result, session):
+        store.user_data[1]['choices'] = [[0, -1, 'soup']]
+        changing.set()
+        release.wait(5)
+        store.user_data[1]['choices'].append([1, -2, 'dumplings'])
+
+    update = threading.Thread(
+        target=dispatcher.process_update, args=(Sent(choose, private),))
+    update.start()
+    assert changing.wait(5)
+
+    flush = threading.Thread(target=store.flush)
+    flush.start()
+    flush.join(0.2)
+    # The save waits for the update to finish changing the state
+    assert flush.is_alive()
+
+    release.set()
+    update.join(5)
+    flush.join(5)
+    store.stop()
+
+    with db.session_scope() as session:
+        assert unpack_ints(db.get_conversation(session, 1).choices) == [-1, -2]
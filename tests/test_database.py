@@ -1,3 +1,4 @@
+import collections
 import dataclasses
 import datetime
 import factory
@@ -7,13 +8,18 @@ import logging
 import os
 import pytest
 import random
+import threading
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 
+from soup.classes import ArchivedQuote, ArchivedVote, QuoteBag, QuoteMessage
 from soup.database import QuoteDatabase
+from soup.search import And, Not, Or, Term, bakery
 
 faker = faker.Faker()
 
 FILENAME = 'tests.db'
+FULLTEXT_FILENAME = 'tests-fulltext.db'
 
 
 # Setup and teardown
@@ -23,10 +29,16 @@ def setup_module():
     if os.path.isfile(FILENAME):
         os.remove(FILENAME)
 
+    if os.path.isfile(FULLTEXT_FILENAME):
+        os.remove(FULLTEXT_FILENAME)
+
 
 def teardown_module():
     os.remove(FILENAME)
 
+    if os.path.isfile(FULLTEXT_FILENAME):
+        os.remove(FULLTEXT_FILENAME)
+
 
 # Fixtures
 
@@ -261,6 +273,20 @@ def test__get_user_chats__user_with_chats__list_is_not_empty(db, s):
     assert len(chats) == x
 
 
+def test__get_user_chat_titles__user_with_chats__ordered_by_title(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chats = [ChatFactory() for _ in range(3)]
+    for chat in chats:
+        db.add_or_update_chat(s, chat)
+        db.add_membership(s, user.id, chat.id)
+
+    expected = sorted(((chat.id, chat.title) for chat in chats),
+        key=lambda chat: (chat[1], chat[0]))
+    assert db.get_user_chat_titles(s, user.id) == expected
+
+
 def test__get_user_score__user_has_no_quotes__result_is_0_0_0(db, s):
     user = UserFactory()
     db.add_or_update_user(s, user)
@@ -489,6 +515,56 @@ def test__remove_membership__existing_pair__is_successful(db, s):
     assert db_chat not in db.get_user_chats(s, user.id)
 
 
+def test__add_membership__loaded_collections__are_refreshed(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+    s.flush()
+
+    db_chat = db.get_chat_by_id(s, chat.id)
+    assert db_chat.users == []
+
+    assert db.add_membership(s, user.id, chat.id)
+    assert not db.add_membership(s, user.id, chat.id)
+    assert [u.id for u in db_chat.users] == [user.id]
+
+    assert db.remove_membership(s, user.id, chat.id)
+    assert not db.remove_membership(s, user.id, chat.id)
+    assert db_chat.users == []
+
+
+def test__sync_memberships__member_list__adds_and_removes_listings(db, s):
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    users = [UserFactory() for _ in range(6)]
+    for user in users:
+        db.add_or_update_user(s, user)
+
+    for user in users[:4]:
+        db.add_membership(s, user.id, chat.id)
+
+    # Other chats are untouched
+    other = ChatFactory()
+    db.add_or_update_chat(s, other)
+    db.add_membership(s, users[0].id, other.id)
+
+    unknown = generate_id()
+    listed = [users[2].id, users[3].id, users[4].id, users[5].id, unknown]
+
+    result = db.sync_memberships(s, chat.id, listed)
+    assert result == (2, 2, 2, 1)
+
+    members = {user.id for user in db.get_chat_by_id(s, chat.id).users}
+    assert members == {user.id for user in users[2:]}
+    assert [c.id for c in db.get_user_chats(s, users[0].id)] == [other.id]
+
+    assert db.sync_memberships(s, chat.id, listed) == (0, 0, 4, 1)
+    assert db.sync_memberships(s, chat.id, []) == (0, 4, 0, 0)
+
+
 # Stats
 
 
@@ -502,14 +578,322 @@ def test__most_quotes_added(db, s):
     pass
 
 
-@pytest.mark.skip
-def test__get_highest_scoring(db, s):
-    pass
+def test__get_chat_stats__empty_chat__is_empty(db, s):
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
 
+    assert db.get_chat_stats(s, chat.id) == (0, [], [])
 
-@pytest.mark.skip
-def test__get_lowest_scoring(db, s):
-    pass
+
+def test__get_chat_stats__populated_chat__ranks_senders_and_quoters(db, s):
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    users = [UserFactory() for _ in range(4)]
+    for user in users:
+        db.add_or_update_user(s, user)
+
+    # User i is quoted i + 1 times, each time by the next user
+    for i, user in enumerate(users):
+        quoter = users[(i + 1) % len(users)]
+
+        for _ in range(i + 1):
+            create_quote(db, s, user, chat, quoted_by_id=quoter.id)
+
+    # Deleted quotes aren't counted
+    create_quote(db, s, users[0], chat, score=-5, quoted_by_id=users[1].id)
+    s.flush()
+
+    total, most_quoted, most_added = db.get_chat_stats(s, chat.id, limit=3)
+
+    assert total == 10
+    assert [(user.id, count) for user, count in most_quoted] == [
+        (users[3].id, 4), (users[2].id, 3), (users[1].id, 2)]
+    assert [(user.id, count) for user, count in most_added] == [
+        (users[0].id, 4), (users[3].id, 3), (users[2].id, 2)]
+
+
+def test__get_chat_stats__populated_chat__matches_separate_queries(db, s):
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    users = [UserFactory() for _ in range(6)]
+    for user in users:
+        db.add_or_update_user(s, user)
+
+    for _ in range(40):
+        sent_by, quoted_by = random.sample(users, 2)
+        create_quote(db, s, sent_by, chat, quoted_by_id=quoted_by.id)
+
+    s.flush()
+
+    total, most_quoted, most_added = db.get_chat_stats(s, chat.id, limit=10)
+
+    assert total == db.get_quote_count(s, chat.id)
+    assert sorted(most_quoted, key=lambda u: u[0].id) == sorted(
+        db.get_most_quoted(s, chat.id, limit=10), key=lambda u: u[0].id)
+    assert sorted(most_added, key=lambda u: u[0].id) == sorted(
+        db.get_most_quotes_added(s, chat.id, limit=10), key=lambda u: u[0].id)
+
+
+def reference_user_scores(db, s, chat_id, limit=5, direction=1):
+    """The original per-member implementation of get_user_scores."""
+    chat = db.get_chat_by_id(s, chat_id)
+    scores = []
+
+    for user in chat.users:
+        up, score, down = db.get_user_score(s, user.id, chat.id)
+
+        if direction == 1 and score == 0:
+            continue
+        elif direction == -1 and score > 0:
+            continue
+
+        scores.append((user, up, score, down))
+
+    users = sorted(scores, key=lambda u: u[2], reverse=direction == 1)
+    return users[:limit]
+
+
+def create_scored_chat(db, s, members=8, quotes=20):
+    """Creates a chat whose members have quotes with random votes, including
+    deleted quotes and removed votes."""
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    users = [UserFactory() for _ in range(members)]
+    voters = [UserFactory() for _ in range(6)]
+
+    for user in users + voters:
+        db.add_or_update_user(s, user)
+
+    for user in users:
+        db.add_membership(s, user.id, chat.id)
+
+    for _ in range(quotes):
+        sent_by = random.choice(users)
+        quote, _ = db.add_quote_for_test(
+            s, QuoteFactory(sent_by_id=sent_by.id, chat_id=chat.id))
+
+        for voter in random.sample(voters, random.randint(0, len(voters))):
+            db.add_vote(s, voter.id, quote.id, random.choice((-1, 1)))
+
+            if random.random() < 0.1:
+                db.add_vote(s, voter.id, quote.id, 0)
+
+    # Quotes in other chats aren't counted
+    other = ChatFactory()
+    db.add_or_update_chat(s, other)
+    create_quote(db, s, users[0], other, score=3)
+
+    s.flush()
+    return chat, users
+
+
+def score_rows(scores):
+    return [(user.id, up, score, down) for user, up, score, down in scores]
+
+
+def test__get_highest_scoring__populated_chat__sorted_without_zero_scores(db, s):
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    users = [UserFactory() for _ in range(4)]
+    for user, score in zip(users, (3, 0, -2, 7)):
+        db.add_or_update_user(s, user)
+        db.add_membership(s, user.id, chat.id)
+        create_quote(db, s, user, chat, score=score)
+
+    s.flush()
+
+    assert score_rows(db.get_highest_scoring(s, chat.id, limit=5)) == [
+        (users[3].id, 7, 7, 0), (users[0].id, 3, 3, 0), (users[2].id, 0, -2, 2)]
+
+
+def test__get_lowest_scoring__populated_chat__sorted_without_positive_scores(db, s):
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    users = [UserFactory() for _ in range(4)]
+    for user, score in zip(users, (3, -1, -4, 7)):
+        db.add_or_update_user(s, user)
+        db.add_membership(s, user.id, chat.id)
+        create_quote(db, s, user, chat, score=score)
+
+    # Members without quotes have a score of 0
+    idle = UserFactory()
+    db.add_or_update_user(s, idle)
+    db.add_membership(s, idle.id, chat.id)
+
+    s.flush()
+
+    assert score_rows(db.get_lowest_scoring(s, chat.id, limit=2)) == [
+        (users[2].id, 0, -4, 4), (users[1].id, 0, -1, 1)]
+    assert score_rows(db.get_lowest_scoring(s, chat.id, limit=5))[-1] == (
+        idle.id, 0, 0, 0)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test__get_user_scores__random_chats__match_reference_implementation(db, s, seed):
+    random.seed(seed)
+    chat, users = create_scored_chat(db, s)
+
+    for direction in (1, -1):
+        for limit in (1, 3, len(users)):
+            expected = reference_user_scores(
+                db, s, chat.id, limit=limit, direction=direction)
+            actual = db.get_user_scores(
+                s, chat.id, limit=limit, direction=direction)
+
+            # Ties may be ordered differently, so compare scores in order and
+            # the full rows when every member is included
+            assert [row[2] for row in actual] == [row[2] for row in expected]
+
+            if limit == len(users):
+                assert sorted(score_rows(actual)) == sorted(score_rows(expected))
+
+
+# Daily rollups
+
+
+ALL_TIME = datetime.date(1900, 1, 1)
+
+
+def test__get_chat_stats__window__counts_quotes_added_in_window(db, s):
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    recent, old = UserFactory(), UserFactory()
+    for user in (recent, old):
+        db.add_or_update_user(s, user)
+
+    now = datetime.datetime.now()
+    for content in ("soup", "dumpling"):
+        create_quote(db, s, recent, chat, sent_at=now, quoted_by_id=old.id,
+            content=content, content_html=content)
+
+    # A message from long ago, quoted today
+    create_quote(db, s, old, chat, sent_at=now - datetime.timedelta(days=60),
+        quoted_by_id=recent.id)
+
+    week = datetime.date.today() - datetime.timedelta(days=6)
+    total, most_quoted, most_added = db.get_chat_stats(s, chat.id, since=week)
+
+    assert total == 3
+    assert [(user.id, count) for user, count in most_quoted] == [
+        (recent.id, 2), (old.id, 1)]
+    assert [(user.id, count) for user, count in most_added] == [
+        (old.id, 2), (recent.id, 1)]
+
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    assert db.get_chat_stats(s, chat.id, since=tomorrow)[0] == 0
+
+
+def test__get_user_scores__window__counts_votes_cast_in_window(db, s):
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    user, voter = UserFactory(), UserFactory()
+    for member in (user, voter):
+        db.add_or_update_user(s, member)
+        db.add_membership(s, member.id, chat.id)
+
+    old = create_quote(db, s, user, chat,
+        sent_at=datetime.datetime.now() - datetime.timedelta(days=400))
+    db.add_vote(s, voter.id, old.id, 1)
+
+    today = datetime.date.today()
+    assert score_rows(db.get_highest_scoring(s, chat.id, since=today)) == [
+        (user.id, 1, 1, 0)]
+
+    # Changing the vote takes it back from the day it was cast
+    db.add_vote(s, voter.id, old.id, -1)
+    assert score_rows(db.get_lowest_scoring(s, chat.id, limit=1, since=today)) == [
+        (user.id, 0, -1, 1)]
+
+    db.delete_quote(s, old.id)
+    assert score_rows(db.get_lowest_scoring(s, chat.id, limit=1, since=today)) == [
+        (user.id, 0, 0, 0)]
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test__get_user_scores__all_time_window__matches_all_time_scores(db, s, seed):
+    random.seed(seed)
+    chat, users = create_scored_chat(db, s)
+
+    for direction in (1, -1):
+        expected = db.get_user_scores(
+            s, chat.id, limit=len(users), direction=direction)
+        actual = db.get_user_scores(
+            s, chat.id, limit=len(users), direction=direction, since=ALL_TIME)
+
+        assert score_rows(actual) == score_rows(expected)
+
+
+def test__backfill_daily_stats__interrupted_by_new_votes__counts_each_quote_once(db, s):
+    random.seed(0)
+    chat, users = create_scored_chat(db, s)
+    s.commit()
+
+    # Start over, as if upgrading an existing database
+    db.set_state(s, db.DAILY_STATS_BACKFILL, '0')
+    s.commit()
+    db.daily_stats_ready = False
+
+    db.backfill_daily_stats(batch_size=5, pause=0)
+
+    voter = UserFactory()
+    db.add_or_update_user(s, voter)
+
+    for quote in db.get_user_quotes(s, users[0].id, chat.id):
+        db.add_vote(s, voter.id, quote.id, 1)
+
+    create_quote(db, s, users[1], chat, score=2)
+    s.commit()
+
+    assert db.backfill_daily_stats(batch_size=5, pause=0) == 0
+    assert db.get_state(s, db.DAILY_STATS_BACKFILL) == 'done'
+
+    assert db.get_chat_stats(s, chat.id, since=ALL_TIME) == (
+        db.get_chat_stats(s, chat.id))
+    assert score_rows(db.get_user_scores(
+        s, chat.id, limit=len(users), since=ALL_TIME)) == score_rows(
+        db.get_user_scores(s, chat.id, limit=len(users)))
+
+
+# Batches
+
+
+def test__batch__failing_savepoint__rolls_back_alone_and_commits_once(db, s):
+    users = [UserFactory() for _ in range(3)]
+    hooks = []
+
+    db.begin_batch()
+
+    for i, user in enumerate(users):
+        try:
+            with db.session_scope() as session:
+                assert session is db.current_batch()
+
+                db.add_or_update_user(session, user)
+                db.on_commit(session, lambda i=i: hooks.append(i))
+
+                if i == 1:
+                    raise ValueError
+        except ValueError:
+            pass
+
+    # Nothing is committed, or run, until the batch ends
+    assert hooks == []
+    assert db.get_user_by_id(s, users[0].id) is None
+
+    db.end_batch()
+
+    assert hooks == [0, 2]
+    assert db.current_batch() is None
+    assert db.get_user_by_id(s, users[0].id) is not None
+    assert db.get_user_by_id(s, users[1].id) is None
+    assert db.get_user_by_id(s, users[2].id) is not None
 
 
 # Quotes
@@ -551,6 +935,47 @@ def test__get_quote_by_ids__existing_quote__is_not_none(db, s):
     assert db.get_quote_by_ids(s, quote.chat_id, quote.message_id) is not None
 
 
+def test__get_trending_quotes__voted_quotes__ordered_by_recent_votes(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    quiet = create_quote(db, s, user, chat)
+    popular = create_quote(db, s, user, chat, score=3)
+    disliked = create_quote(db, s, user, chat, score=-1)
+    deleted = create_quote(db, s, user, chat, score=2)
+    db.delete_quote(s, deleted.id)
+
+    s.flush()
+
+    trending = db.get_trending_quotes(s, chat.id, limit=5)
+    assert trending == [popular, quiet]
+    assert disliked.hotness is None
+
+
+def test__get_trending_quotes__changed_vote__replaces_previous_weight(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    quote = create_quote(db, s, user, chat)
+    added = quote.hotness
+
+    voter = UserFactory()
+    db.add_or_update_user(s, voter)
+
+    db.add_vote(s, voter.id, quote.id, 1)
+    db.add_vote(s, voter.id, quote.id, 0)
+    assert quote.hotness == pytest.approx(added)
+
+    db.add_vote(s, voter.id, quote.id, -1)
+    assert quote.hotness is None
+
+
 def test__get_quote_count__new_pair__is_0(db, s):
     user = UserFactory()
     db.add_or_update_user(s, user)
@@ -596,6 +1021,22 @@ def test__get_quote_count__multiple_chats__only_counts_quotes_in_current_chat(db
     assert db.get_quote_count(s, current.id) == 0
 
 
+def test__get_quote_count__deleted_quotes__are_not_counted(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    for _ in range(3):
+        create_quote(db, s, user, chat)
+
+    quote = create_quote(db, s, user, chat)
+    db.delete_quote(s, quote.id)
+
+    assert db.get_quote_count(s, chat.id) == 3
+
+
 def test__get_random_quote__populated_chat__is_not_none(db, s):
     chat = ChatFactory()
     db.add_or_update_chat(s, chat)
@@ -644,9 +1085,342 @@ def test__get_random_quote__populated_chat_and_specific_user__quote_is_by_user(d
         assert quote is not None
 
 
-@pytest.mark.skip
-def test__search_quote(db, s):
-    pass
+def test__get_random_quote__populated_chat__no_repeats_until_all_drawn(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    quotes = [create_quote(db, s, user, chat) for _ in range(5)]
+    ids = sorted(quote.id for quote in quotes)
+
+    for _ in range(3):
+        drawn = [db.get_random_quote(s, chat.id)[0].id for _ in ids]
+        assert sorted(drawn) == ids
+
+
+def test__get_random_quote__new_quote__is_added_to_bag(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    create_quote(db, s, user, chat)
+    create_quote(db, s, user, chat)
+    s.commit()
+
+    db.get_random_quote(s, chat.id)
+    quote = create_quote(db, s, user, chat)
+    s.commit()
+
+    assert quote.id in db.get_bag(s, chat.id)
+
+
+def test__get_random_quote__restart__bag_state_is_restored(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    for _ in range(4):
+        create_quote(db, s, user, chat)
+
+    drawn = {db.get_random_quote(s, chat.id)[0].id for _ in range(2)}
+    s.commit()
+
+    added = create_quote(db, s, user, chat)
+    s.commit()
+
+    # Saved when the bot stops
+    assert db.save_bags() >= 1
+
+    restarted = QuoteDatabase(filename=FILENAME)
+    session = restarted.create_session()
+
+    remaining = {restarted.get_random_quote(session, chat.id)[0].id
+        for _ in range(3)}
+
+    assert added.id in remaining
+    assert not remaining & drawn
+
+    session.close()
+
+
+def test__get_random_quote__rolled_back__draw_is_undone(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    for _ in range(3):
+        create_quote(db, s, user, chat)
+
+    s.commit()
+    db.get_random_quote(s, chat.id)
+    s.commit()
+    saved = s.query(QuoteBag).get(chat.id).quote_ids
+
+    # Draws after the refill aren't written
+    db.get_random_quote(s, chat.id)
+    assert not s.dirty and not s.new
+    s.rollback()
+
+    assert len(db.get_bag(s, chat.id)) == 2
+    assert s.query(QuoteBag).get(chat.id).quote_ids == saved
+
+
+def test__get_random_quote__weighted_chat__draws_by_score(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+    db.set_random_mode(s, chat.id, 'weighted')
+
+    low = create_quote(db, s, user, chat, score=-4)
+    high = create_quote(db, s, user, chat, score=10)
+    s.commit()
+
+    counts = collections.Counter(
+        db.get_random_quote(s, chat.id)[0].id for _ in range(160))
+
+    # The high quote has weight 15 and the low quote weight 1
+    assert counts[high.id] > counts[low.id]
+
+
+def test__get_random_quote__weighted_chat__sampler_follows_votes(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+    db.set_random_mode(s, chat.id, 'weighted')
+
+    quote = create_quote(db, s, user, chat)
+    s.commit()
+
+    sampler = db.get_sampler(s, chat.id)
+    assert sampler.tree.total() == db.quote_weight(0)
+
+    voter = UserFactory()
+    db.add_or_update_user(s, voter)
+    db.add_vote(s, voter.id, quote.id, 1)
+    s.commit()
+
+    assert sampler.tree.total() == db.quote_weight(1)
+
+    db.delete_quote(s, quote.id)
+    s.commit()
+
+    assert quote.id not in sampler
+    assert db.get_random_quote(s, chat.id) == (None, None)
+
+
+def test__get_random_quote__weighted_chat__rolled_back_quote_is_not_added(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+    db.set_random_mode(s, chat.id, 'weighted')
+    s.commit()
+
+    sampler = db.get_sampler(s, chat.id)
+
+    create_quote(db, s, user, chat)
+    s.rollback()
+
+    assert len(sampler) == 0
+
+
+def test__get_activity__committed_changes__update_snapshot(db, s):
+    pytest.importorskip('numpy')
+
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    sent_at = datetime.datetime(2019, 3, 15, 21, 30)
+    create_quote(db, s, user, chat, sent_at=sent_at)
+    s.commit()
+
+    snapshot = db.get_activity(s, chat.id)
+    assert snapshot.heatmap()[sent_at.weekday(), sent_at.hour] == 1
+
+    quote = create_quote(
+        db, s, user, chat, sent_at=sent_at, content="new", content_html="new")
+    s.rollback()
+    assert len(snapshot) == 1
+
+    quote = create_quote(
+        db, s, user, chat, sent_at=sent_at, content="new", content_html="new")
+    s.commit()
+    assert snapshot.heatmap(sender_id=user.id).sum() == 2
+
+    voter = UserFactory()
+    db.add_or_update_user(s, voter)
+    db.add_vote(s, voter.id, quote.id, 1)
+    s.commit()
+
+    _, counts, _, means = snapshot.monthly()
+    assert (counts, means) == ([2], [0.5])
+
+    db.delete_quote(s, quote.id)
+    s.commit()
+    assert len(snapshot) == 1
+
+
+def test__search_quote__matching_terms__quote_contains_terms(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    for content in ("soup dumpling", "noodle soup", "fried rice"):
+        quote = QuoteFactory(
+            sent_by_id=user.id, chat_id=chat.id,
+            content=content, content_html=content)
+        db.add_quote_for_test(s, quote)
+
+    s.flush()
+
+    for _ in range(10):
+        quote, sent_by = db.search_quote(s, chat.id, Term("soup"))
+        assert "soup" in quote.content
+        assert sent_by.id == user.id
+
+
+def test__search_quote__no_matching_terms__is_none(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    quote = QuoteFactory(
+        sent_by_id=user.id, chat_id=chat.id,
+        content="fried rice", content_html="fried rice")
+    db.add_quote_for_test(s, quote)
+    s.flush()
+
+    assert db.search_quote(s, chat.id, Term("soup")) == (None, None)
+
+
+def test__search_quote__or_and_negation__matches_expression(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    for content in ("soup dumpling", "noodle soup", "fried rice", "rice soup"):
+        quote = QuoteFactory(
+            sent_by_id=user.id, chat_id=chat.id,
+            content=content, content_html=content)
+        db.add_quote_for_test(s, quote)
+
+    s.flush()
+
+    expression = And(
+        Or(Term("dumpling"), Term("rice")), Not(Term("fried")))
+
+    for _ in range(10):
+        quote, _ = db.search_quote(s, chat.id, expression)
+        assert quote.content in ("soup dumpling", "rice soup")
+
+
+def test__search_quote__wildcard_characters__are_matched_literally(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    quote = QuoteFactory(
+        sent_by_id=user.id, chat_id=chat.id,
+        content="soup dumpling", content_html="soup dumpling")
+    db.add_quote_for_test(s, quote)
+    s.flush()
+
+    assert db.search_quote(s, chat.id, Term("soup%dumpling")) == (None, None)
+    assert db.search_quote(s, chat.id, Term("s_up")) == (None, None)
+
+
+def test__search_quote__fulltext_index__matches_words_and_phrases(db, s):
+    fts_db = QuoteDatabase(filename=FULLTEXT_FILENAME, fulltext=True)
+
+    if not fts_db.fulltext:
+        pytest.skip("SQLite was built without FTS5")
+
+    session = fts_db.create_session()
+
+    user = UserFactory()
+    fts_db.add_or_update_user(session, user)
+
+    chat = ChatFactory()
+    fts_db.add_or_update_chat(session, chat)
+
+    for content in ("soup dumpling", "dumpling soup"):
+        quote = QuoteFactory(
+            sent_by_id=user.id, chat_id=chat.id,
+            content=content, content_html=content)
+        fts_db.add_quote_for_test(session, quote)
+
+    session.flush()
+
+    quote, _ = fts_db.search_quote(
+        session, chat.id, Term("soup dumpling", phrase=True))
+    assert quote.content == "soup dumpling"
+
+    quote, _ = fts_db.search_quote(
+        session, chat.id, And(Term("dump"), Not(Term("soup dumpling", phrase=True))))
+    assert quote.content == "dumpling soup"
+
+    session.close()
+
+
+def test__search_member_quote__member_chats__only_searches_member_chats(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chats = [ChatFactory() for _ in range(3)]
+    for chat in chats:
+        db.add_or_update_chat(s, chat)
+
+        quote = QuoteFactory(
+            sent_by_id=user.id, chat_id=chat.id,
+            content=f"soup {chat.id}", content_html=f"soup {chat.id}")
+        db.add_quote_for_test(s, quote)
+
+    for chat in chats[:2]:
+        db.add_membership(s, user.id, chat.id)
+
+    s.flush()
+
+    found = {db.search_member_quote(s, user.id, Term("soup"))[0].chat_id
+        for _ in range(30)}
+    assert found == {chats[0].id, chats[1].id}
+
+    assert db.search_member_quote(s, user.id, Term("rice")) == (None, None)
+    assert db.search_member_quote(s, generate_id(), Term("soup")) == (None, None)
+
+
+def test__search_quote__same_signature__statement_is_reused(db, s):
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    db.search_quote(s, chat.id, Term("first"))
+    cached = len(bakery.cache)
+
+    db.search_quote(s, chat.id, Term("second"))
+    assert len(bakery.cache) == cached
 
 
 def test__add_quote__new_quote__returns_quote_added(db, s):
@@ -688,6 +1462,73 @@ def test__delete_quote__existing_quote__marks_quote_as_deleted(db, s):
     assert db_quote.deleted
 
 
+def test__archive_deleted_quotes__deleted_quote__moves_it_and_blocks_readding(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    live = create_quote(db, s, user, chat, score=1, content="live", content_html="live")
+    deleted = create_quote(db, s, user, chat, score=2, content="gone", content_html="gone")
+    db.add_message(s, chat.id, generate_id(), live)
+    db.add_message(s, chat.id, generate_id(), deleted)
+
+    db.delete_quote(s, deleted.id)
+    s.commit()
+    deleted_id, sent_at = deleted.id, deleted.sent_at
+
+    assert db.archive_deleted_quotes(batch_size=1, pause=0) >= 1
+    s.expire_all()
+
+    assert db.get_quote_by_id(s, deleted_id) is None
+    assert not db.get_quote_messages(s, deleted_id).count()
+    assert s.query(ArchivedQuote).get(deleted_id).content == "gone"
+    assert s.query(ArchivedVote).filter(
+        ArchivedVote.quote_id == deleted_id).count() == 2
+
+    assert db.get_quote_by_id(s, live.id) is not None
+    assert db.get_quote_messages(s, live.id).count() == 1
+
+    again = QuoteFactory(sent_by_id=user.id, chat_id=chat.id,
+        sent_at=sent_at, content="gone", content_html="gone")
+    db_quote, status = db.add_quote_for_test(s, again)
+
+    assert db_quote is None
+    assert status == QuoteDatabase.QUOTE_PREVIOUSLY_DELETED
+
+
+def test__archive_deleted_quotes__newest_quote_archived__ids_not_reused(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    first = create_quote(db, s, user, chat, score=1, content="first", content_html="first")
+    db.delete_quote(s, first.id)
+    s.commit()
+    first_id = first.id
+
+    db.archive_deleted_quotes(pause=0)
+
+    # The newest quote was archived, so its ID would be handed out again
+    second = create_quote(db, s, user, chat, score=1, content="second", content_html="second")
+    assert second.id > first_id
+
+    db.delete_quote(s, second.id)
+    s.commit()
+    second_id = second.id
+
+    assert db.archive_deleted_quotes(pause=0) == 1
+    s.expire_all()
+
+    assert s.query(ArchivedQuote).get(first_id).content == "first"
+    assert s.query(ArchivedQuote).get(second_id).content == "second"
+    assert s.query(ArchivedVote).filter(
+        ArchivedVote.quote_id == second_id).count() == 1
+
+
 # Quote messages
 
 
@@ -706,6 +1547,41 @@ def test__get_quote_messages(db, s):
     pass
 
 
+def test__compact_quote_messages__old_messages__keeps_newest_per_live_quote(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    live = create_quote(db, s, user, chat, content="live", content_html="live")
+    fresh = create_quote(db, s, user, chat, content="fresh", content_html="fresh")
+    deleted = create_quote(db, s, user, chat, content="gone", content_html="gone")
+
+    for quote in (live, live, live, fresh, fresh, deleted):
+        db.add_message(s, chat.id, generate_id(), quote)
+
+    db.add_message(s, chat.id, generate_id(), fresh)
+    db.delete_quote(s, deleted.id)
+    s.flush()
+
+    # Everything but the last message is old
+    messages = s.query(QuoteMessage).filter(QuoteMessage.chat_id == chat.id)
+    for message in messages.order_by(QuoteMessage.id)[:-1]:
+        message.sent_at -= datetime.timedelta(days=60)
+
+    s.commit()
+
+    assert db.compact_quote_messages(
+        datetime.timedelta(days=30), batch_size=2, pause=0) == 5
+
+    remaining = collections.Counter(m.quote_id for m in messages)
+    assert remaining == {live.id: 1, fresh.id: 1}
+
+    with pytest.raises(ValueError):
+        db.compact_quote_messages(datetime.timedelta(hours=1))
+
+
 # Votes
 
 
@@ -719,6 +1595,50 @@ def test__add_vote(db, s):
     pass
 
 
+def test__add_vote__same_user_on_two_threads__one_vote_kept(db, s):
+    user = UserFactory()
+    db.add_or_update_user(s, user)
+
+    chat = ChatFactory()
+    db.add_or_update_chat(s, chat)
+
+    quote = create_quote(db, s, user, chat)
+    s.commit()
+    quote_id = quote.id
+
+    writing = threading.Event()
+    results = []
+
+    def note_write(conn, cursor, statement, *args):
+        if (statement.startswith(('INSERT', 'UPDATE'))
+                and threading.current_thread() is other):
+            writing.set()
+
+    def vote_down():
+        with db.session_scope() as session:
+            results.append(db.add_vote(session, user.id, quote_id, -1))
+
+    # Both threads read that the user hasn't voted, then both add a vote
+    other = threading.Thread(target=vote_down)
+    event.listen(db.engine, 'before_cursor_execute', note_write)
+
+    try:
+        assert db.add_vote(s, user.id, quote_id, 1) == db.VOTE_ADDED
+        other.start()
+        assert writing.wait(5)
+        s.commit()
+        other.join(10)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', note_write)
+
+    # The later vote changed the first one
+    assert results == [db.VOTE_ADDED]
+    s.expire_all()
+
+    assert db.get_user_vote(s, user.id, quote_id).direction == -1
+    assert db.get_votes_by_id(s, quote_id) == (0, -1, 1)
+
+
 @pytest.mark.skip
 def test__get_votes(db, s):
     pass
@@ -0,0 +1,133 @@
+import datetime
+import importlib
+import json
+import os
+import subprocess
+
+import pytest
+from telegram import Update
+from telegram.error import BadRequest
+
+import soup
+from soup.classes import Chat, User
+from soup.fakebot import TOKEN
+
+GROUP_ID = -1
+VOTER_ID = 10
+
+
+class FakeBot:
+    """Records the requests handlers make, and fails edits with error, if
+    given."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.calls.append(('answer', text))
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.calls.append(('edit_text', chat_id, message_id))
+
+        if self.error is not None:
+            raise self.error
+
+    def edit_message_reply_markup(self, chat_id=None, message_id=None, **kwargs):
+        self.calls.append(('edit_markup', chat_id, message_id))
+
+        if self.error is not None:
+            raise self.error
+
+    answerCallbackQuery = answer_callback_query
+
+
+@pytest.fixture(scope='module')
+def quotes(tmpdir_factory):
+    """The quote handlers, run from a checkout of their own: a git repository
+    with the package's files, a config file and the bot's database."""
+    directory = tmpdir_factory.mktemp('bot')
+    directory.join('soup').mksymlinkto(os.path.dirname(soup.__file__))
+    directory.mkdir('data').join('config.json').write(
+        json.dumps({'username': 'soup_bot', 'token': TOKEN}))
+
+    # /about reads the checkout's commit and what's been pushed of it
+    def git(*args):
+        subprocess.run(['git', '-C', str(directory), '-c', 'user.name=soup',
+            '-c', 'user.email=soup@localhost'] + list(args),
+            check=True, stdout=subprocess.DEVNULL)
+
+    git('init', '-q')
+    git('checkout', '-q', '-b', 'master')
+    git('commit', '-q', '--allow-empty', '-m', 'soup')
+    git('update-ref', 'refs/remotes/origin/master', 'HEAD')
+
+    cwd = os.getcwd()
+    os.chdir(str(directory))
+    os.environ['SOUP_DATABASE'] = str(directory.join('data.db'))
+
+    try:
+        return importlib.import_module('soup.handlers.quotes')
+    finally:
+        os.chdir(cwd)
+        del os.environ['SOUP_DATABASE']
+
+
+def add_quote(database, message_id, downvotes=0):
+    """Adds a quote sent in the group as the given message, with downvotes
+    from other users. Returns its ID."""
+    with database.session_scope() as session:
+        if database.get_chat_by_id(session, GROUP_ID) is None:
+            session.add(Chat(id=GROUP_ID, type='group', title='soup'))
+
+            for user_id in range(1, VOTER_ID + 1):
+                session.add(User(id=user_id, first_name=f'user {user_id}'))
+
+    with database.session_scope() as session:
+        content = f"quote {message_id}"
+        quote, _ = database.add_quote(session, GROUP_ID, message_id, False,
+            datetime.datetime(2019, 1, 1), 1, 'text', content, content, '', 1)
+        database.add_message(session, GROUP_ID, message_id + 1000, quote)
+        quote_id = quote.id
+
+    for user_id in range(2, 2 + downvotes):
+        with database.session_scope() as session:
+            database.add_vote(session, user_id, quote_id, -1)
+
+    return quote_id
+
+
+def vote(bot, message_id, direction):
+    return Update.de_json({'update_id': 1, 'callback_query': {
+        'id': '1', 'chat_instance': '1', 'data': str(direction),
+        'from': {'id': VOTER_ID, 'is_bot': False, 'first_name': 'voter'},
+        'message': {'message_id': message_id, 'date': 0,
+            'chat': {'id': GROUP_ID, 'type': 'group'}},
+    }}, bot)
+
+
+def test__handle_vote__upvote__answers_and_edits_buttons(quotes):
+    add_quote(quotes.database, 1)
+
+    # The buttons may already show the vote
+    bot = FakeBot(BadRequest('Message is not modified'))
+    quotes.handle_vote(bot, vote(bot, 1001, 1), {})
+
+    assert bot.calls == [
+        ('answer', 'upvoted!'), ('edit_markup', GROUP_ID, 1001)]
+
+
+def test__handle_vote__quote_deleted__old_messages_not_edited(quotes):
+    quote_id = add_quote(quotes.database, 2,
+        downvotes=-quotes.database.SCORE_TO_DELETE - 1)
+
+    # The quote's message is too old to be edited
+    bot = FakeBot(BadRequest("Message can't be edited"))
+    quotes.handle_vote(bot, vote(bot, 1002, -1), {})
+
+    assert bot.calls == [
+        ('answer', "vote added and quote deleted!"),
+        ('edit_text', GROUP_ID, 1002)]
+
+    with quotes.database.session_scope() as session:
+        assert quotes.database.get_quote_by_id(session, quote_id).deleted
@@ -0,0 +1,66 @@
+import datetime
+import random
+
+import pytest
+
+from soup.hotness import HALF_LIFE, add_event, decayed_score
+
+
+def naive_score(events, now):
+    return sum(direction * 0.5 ** ((now - when) / HALF_LIFE)
+        for when, direction in events)
+
+
+def test__add_event__random_upvotes__match_naive_decay():
+    now = datetime.datetime(2026, 6, 1)
+    events = []
+    hotness = None
+
+    for _ in range(50):
+        when = now - datetime.timedelta(seconds=random.randrange(30 * 86400))
+        events.append((when, 1))
+        hotness = add_event(hotness, when, 1)
+
+    assert decayed_score(hotness, now) == pytest.approx(naive_score(events, now))
+
+
+def test__add_event__removals__match_naive_decay():
+    now = datetime.datetime(2026, 6, 1)
+    day = datetime.timedelta(days=1)
+    events = [(now - 5 * day, 1), (now - 2 * day, 1), (now - day, -1),
+        (now, 1), (now, -1)]
+
+    hotness = None
+    for when, direction in events:
+        hotness = add_event(hotness, when, direction)
+
+    assert decayed_score(hotness, now) == pytest.approx(naive_score(events, now))
+
+
+def test__add_event__more_downvotes_than_upvotes__is_none():
+    now = datetime.datetime(2026, 6, 1)
+
+    hotness = add_event(None, now, 1)
+    assert add_event(hotness, now, -1) is None
+    assert add_event(None, now, -1) is None
+
+
+def test__add_event__recent_upvote__outranks_older_upvotes():
+    now = datetime.datetime(2026, 6, 1)
+
+    old = None
+    for _ in range(3):
+        old = add_event(old, now - 2 * HALF_LIFE, 1)
+
+    recent = add_event(None, now, 1)
+    assert recent > old
+
+    recent = add_event(None, now - HALF_LIFE, 1)
+    assert recent < old
+
+
+def test__add_event__far_future__does_not_overflow():
+    when = datetime.datetime(2100, 1, 1)
+
+    hotness = add_event(add_event(None, when, 1), when, 1)
+    assert decayed_score(hotness, when) == pytest.approx(2)
@@ -0,0 +1,160 @@
+import queue
+import threading
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+from soup.fakebot import TOKEN, FakeBotAPI, FakeRequest, RateLimits
+from soup.outbox import (
+    ANSWER, EDIT, SEND, Outbox, Pending, QueuedBot, Sent, TokenBucket,
+    request_ignoring, when_sent)
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.update_queue = queue.Queue()
+
+
+def test__token_bucket__burst__then_waits_for_rate():
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    for _ in range(3):
+        assert bucket.wait(0) == 0
+        bucket.take(0)
+
+    assert bucket.wait(0) == 0.5
+    assert bucket.wait(0.5) == 0
+    bucket.take(0.5)
+    assert bucket.wait(0.75) == 0.25
+
+
+def test__outbox__lanes__answers_go_before_sends():
+    outbox = Outbox(threads=1, chat=(100, 1))
+    sent = []
+    release = threading.Event()
+
+    # Keep the only thread busy while the rest is queued
+    outbox.submit(SEND, -1, release.wait)
+    futures = [
+        outbox.submit(SEND, -2, sent.append, 'stats'),
+        outbox.submit(SEND, -2, sent.append, 'quote'),
+        outbox.submit(ANSWER, None, sent.append, 'answer'),
+    ]
+    release.set()
+
+    for future in futures:
+        future.result(timeout=5)
+    outbox.stop()
+
+    # Messages to one chat keep their order
+    assert sent == ['answer', 'stats', 'quote']
+    assert outbox.metrics()['sent'] == {'answer': 1, 'send': 3}
+
+
+def test__outbox__retry_after__holds_chat_and_resends():
+    outbox = Outbox(threads=2, chat=(100, 1))
+    attempts = []
+
+    def send(text):
+        attempts.append(text)
+
+        if len(attempts) == 1:
+            raise RetryAfter(0.1)
+        return text
+
+    first = outbox.submit(SEND, 5, send, 'first')
+    second = outbox.submit(SEND, 5, send, 'second')
+
+    assert second.result(timeout=5) == 'second'
+    assert first.result() == 'first'
+    outbox.stop()
+
+    assert attempts == ['first', 'first', 'second']
+    assert outbox.metrics()['retries'] == 1
+
+
+def test__outbox__same_coalesce_key__replaces_queued_request():
+    outbox = Outbox(threads=1, chat=(100, 1))
+    sent = []
+    release = threading.Event()
+
+    outbox.submit(SEND, 1, release.wait)
+    first = outbox.submit(EDIT, 2, sent.append, 'old', coalesce=10)
+    other = outbox.submit(EDIT, 2, sent.append, 'other', coalesce=11)
+    second = outbox.submit(EDIT, 2, sent.append, 'new', coalesce=10)
+    release.set()
+
+    assert second is first
+    second.result(timeout=5)
+    other.result(timeout=5)
+    outbox.stop()
+
+    assert sent == ['new', 'other']
+    assert outbox.metrics()['coalesced'] == 1
+
+
+def test__queued_bot__rate_limited_api__sends_in_order_within_limits():
+    api = FakeBotAPI(limits=RateLimits(chat=(1, 0.05), group=None, total=None))
+    outbox = Outbox(chat=(10, 1), group=(10, 1))
+    bot = QueuedBot(TOKEN, outbox, request=FakeRequest(api))
+
+    futures = [bot.send_message(-5, str(i)) for i in range(10)]
+    answer = bot.answer_callback_query('1', 'upvoted!')
+
+    assert isinstance(futures[0], Pending)
+    assert answer.result(timeout=5) is True
+
+    messages = [future.result(timeout=10) for future in futures]
+    outbox.stop()
+
+    assert [m.text for m in messages] == [str(i) for i in range(10)]
+    # The outbox kept under the API's limit
+    assert not api.rejected
+
+
+def test__when_sent__queued__runs_callback_through_dispatcher():
+    outbox = Outbox(threads=1)
+    dispatcher = FakeDispatcher()
+    outbox.start(dispatcher, database=None)
+    called = []
+
+    callback = lambda result, session: called.append((result, session))
+
+    when_sent('sent', callback, session='handler session')
+    when_sent(outbox.submit(SEND, 1, lambda: 'queued'), callback,
+        session='handler session')
+
+    sent = dispatcher.update_queue.get(timeout=5)
+    outbox.stop()
+
+    assert isinstance(sent, Sent) and outbox.handler.check_update(sent)
+    assert sent.result == 'queued'
+    # Sent directly, the callback runs at once with the handler's session
+    assert called == [('sent', 'handler session')]
+
+
+def test__request_ignoring__now_or_queued__raises_only_other_errors():
+    outbox = Outbox(threads=1)
+    dispatcher = FakeDispatcher()
+    outbox.start(dispatcher, database=None)
+
+    def edit(text):
+        raise BadRequest(text)
+
+    ignored = lambda error: 'not modified' in str(error)
+
+    assert request_ignoring(ignored, edit, 'Message is not modified') is None
+    with pytest.raises(BadRequest):
+        request_ignoring(ignored, edit, 'Message to edit not found')
+
+    for text in ['Message is not modified', 'Message to edit not found']:
+        request_ignoring(ignored, outbox.submit, EDIT, 1, edit, text)
+
+    not_modified = dispatcher.update_queue.get(timeout=5)
+    not_found = dispatcher.update_queue.get(timeout=5)
+    outbox.stop()
+
+    # Failures of queued requests are handled on the dispatcher's thread
+    not_modified.callback(not_modified.result, None)
+    with pytest.raises(BadRequest):
+        not_found.callback(not_found.result, None)
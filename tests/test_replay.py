@@ -0,0 +1,149 @@
+import gzip
+import os
+
+from sqlalchemy import create_engine
+import pytest
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import (
+    CallbackQueryHandler, CommandHandler, Dispatcher, Filters, MessageHandler, Updater)
+
+from soup.fakebot import TOKEN, FakeBotAPI, FakeBotServer, RateLimits, create_bot
+from soup.replay import (
+    UpdateRecorder, generate_updates, read_log, replay, replay_polling)
+
+MEMBERS = [(-1, 1), (-1, 2), (-2, 3)]
+QUOTE_MESSAGES = [(-1, 10), (-2, 11)]
+WORDS = ['soup', 'dumpling', 'quote']
+
+
+def test__recorder__many_updates__rotates_and_reads_back(tmpdir):
+    recorder = UpdateRecorder(str(tmpdir), max_updates=3, keep=2)
+
+    for update_id in range(1, 8):
+        recorder.record({'update_id': update_id})
+    recorder.close()
+
+    logs = sorted(str(path) for path in tmpdir.listdir())
+    assert len(logs) == 2
+
+    # The oldest log was deleted
+    assert [u['update_id'] for u in read_log(logs)] == [4, 5, 6, 7]
+
+
+def test__read_log__cut_off_log__reads_complete_lines(tmpdir):
+    path = str(tmpdir.join('updates-20190101-000000.jsonl.gz'))
+
+    with gzip.open(path, 'wt') as f:
+        for update_id in range(100):
+            f.write('{"at": 0, "update": {"update_id": %d}}\n' % update_id)
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+
+    updates = list(read_log([path]))
+    assert 0 < len(updates) < 100
+    assert [u['update_id'] for u in updates] == list(range(len(updates)))
+
+
+def test__fake_bot__send_message__returns_message_and_counts_call():
+    api = FakeBotAPI()
+    bot = create_bot(api)
+
+    message = bot.send_message(-5, 'hello')
+
+    assert bot.username == 'soup_bot'
+    assert message.chat.id == -5 and message.text == 'hello'
+    assert bot.answer_callback_query('1', 'upvoted!') is True
+    assert api.calls == {'getMe': 1, 'sendMessage': 1, 'answerCallbackQuery': 1}
+
+
+def test__replay__generated_updates__runs_handlers_and_reports(tmpdir):
+    bot = create_bot()
+    engine = create_engine(f"sqlite:///{tmpdir.join('replay.db')}")
+    engine.execute('CREATE TABLE seen (update_id INTEGER)')
+
+    def record(bot, update):
+        engine.execute('INSERT INTO seen VALUES (?)', update.update_id)
+
+    def reply(bot, update):
+        update.message.reply_text('a quote')
+
+    def vote(bot, update):
+        update.callback_query.answer('upvoted!')
+
+    dispatcher = Dispatcher(bot, None, workers=0)
+    dispatcher.add_handler(MessageHandler(Filters.all, record), group=0)
+    dispatcher.add_handler(CommandHandler(['random', 'search'], reply), group=1)
+    dispatcher.add_handler(CallbackQueryHandler(vote), group=2)
+
+    updates = list(generate_updates(300, MEMBERS, QUOTE_MESSAGES, WORDS))
+    assert all(Update.de_json(u, bot).effective_user for u in updates)
+
+    report = replay(dispatcher, engine, updates, concurrency=4)
+    calls = report.api_calls
+
+    assert report.updates == len(report.latencies) == 300
+    assert calls['sendMessage'] + calls['answerCallbackQuery'] > 0
+    assert report.statements == 300 - calls['answerCallbackQuery']
+
+
+def test__rate_limits__too_many_messages__waits_for_oldest():
+    limits = RateLimits(chat=(1, 1), group=(3, 60), total=(30, 1))
+
+    assert limits.check(-1, now=0) == 0
+    assert limits.check(-1, now=0.5) == 0.5
+    assert limits.check(5, now=0.5) == 0
+
+    assert limits.check(-1, now=1) == 0
+    assert limits.check(-1, now=2) == 0
+    # The group has had 3 messages in the last minute, the first at 0
+    assert limits.check(-1, now=3) == 57
+
+
+def test__fake_bot__rate_limited__raises_retry_after():
+    api = FakeBotAPI(limits=RateLimits(chat=(2, 1)))
+    bot = create_bot(api)
+
+    bot.send_message(5, 'one')
+    bot.send_message(5, 'two')
+
+    with pytest.raises(RetryAfter) as e:
+        bot.send_message(5, 'three')
+
+    assert e.value.retry_after == 1
+    assert bot.answer_callback_query('1') is True
+    assert api.rejected == {'sendMessage': 1}
+
+
+def test__replay_polling__fake_server__polls_and_rate_limits_over_http(tmpdir):
+    server = FakeBotServer(FakeBotAPI(limits=RateLimits())).start()
+    engine = create_engine(f"sqlite:///{tmpdir.join('replay.db')}")
+    errors = []
+
+    def reply(bot, update):
+        update.message.reply_text('a quote')
+
+    updater = Updater(TOKEN, base_url=server.url)
+    updater.dispatcher.add_handler(CommandHandler('random', reply))
+    updater.dispatcher.add_error_handler(
+        lambda bot, update, error: errors.append(error))
+
+    updates = [u for u in generate_updates(200, MEMBERS, QUOTE_MESSAGES, WORDS)
+        if 'message' in u][:50]
+
+    try:
+        report = replay_polling(updater, server, engine, updates, idle_timeout=5)
+    finally:
+        server.stop()
+
+    commands = sum(u['message']['text'] == '/random' for u in updates)
+
+    assert report.updates == 50
+    assert report.api_calls['getUpdates'] > 0
+    assert report.api_calls['sendMessage'] == commands
+    # Only one message a second gets through to each of the two chats
+    assert 0 < report.rejected['sendMessage'] == len(errors) < commands
+    assert all(isinstance(e, RetryAfter) for e in errors)
@@ -0,0 +1,155 @@
+import datetime
+
+from telegram import (
+    Bot, CallbackQuery, Chat, Message, ReplyKeyboardRemove, Update, User)
+from telegram.ext import (
+    CallbackQueryHandler, CommandHandler, ConversationHandler, Dispatcher,
+    Filters, MessageHandler)
+
+from soup.router import Router, parse_command
+
+USERNAME = 'soup_bot'
+
+
+def create_bot():
+    bot = Bot('123:token')
+    bot.bot = User(123, 'soup', True, username=USERNAME)
+    return bot
+
+
+def create_handlers(calls):
+    """Returns handlers shaped like the bot's, which record what they
+    handle."""
+    def record(name):
+        def callback(bot, update, **kwargs):
+            calls.append((name, update.update_id))
+            return 1
+        return callback
+
+    def end(bot, update, **kwargs):
+        calls.append(('cancel', update.update_id))
+        return ConversationHandler.END
+
+    conversation = ConversationHandler(
+        entry_points=[CommandHandler('start', record('start'), filters=Filters.private)],
+        states={1: [
+            CommandHandler('random', record('dm random'), filters=Filters.private),
+            MessageHandler(Filters.text, record('dm text')),
+        ]},
+        fallbacks=[CommandHandler('cancel', end, filters=Filters.private)],
+        allow_reentry=True)
+
+    handlers = [
+        CommandHandler('addquote', record('addquote'),
+            filters=Filters.reply & Filters.group),
+        CommandHandler('help', record('help'), filters=Filters.private),
+        CommandHandler('help', record('help group'), filters=Filters.group),
+        CommandHandler('about', record('about')),
+        MessageHandler(Filters.status_update.left_chat_member, record('left')),
+        CommandHandler('random', record('random'), filters=Filters.group),
+        CommandHandler(['stats', 'count'], record('stats'),
+            filters=Filters.group, pass_args=True),
+        CallbackQueryHandler(record('vote')),
+        conversation,
+    ]
+
+    return handlers, conversation
+
+
+def create_updates(bot):
+    group = Chat(-100, Chat.SUPERGROUP, title='group')
+    private = Chat(5, Chat.PRIVATE)
+    user = User(5, 'user', False)
+    other = User(6, 'other', False)
+    date = datetime.datetime(2019, 1, 1)
+
+    def message(chat, text=None, **kwargs):
+        return Message(1, user, date, chat, text=text, bot=bot, **kwargs)
+
+    replied = message(group, 'quote me')
+    messages = [
+        message(group, 'hello'),
+        message(group, '/random'),
+        message(group, f'/random@{USERNAME}'),
+        message(group, '/random@other_bot'),
+        message(group, '/RANDOM extra words'),
+        message(group, '/addquote'),
+        message(group, '/addquote', reply_to_message=replied),
+        message(group, '/stats week'),
+        message(group, '/count'),
+        message(group, '/help'),
+        message(group, '/about'),
+        message(group, '/'),
+        message(group, left_chat_member=other),
+        message(private, '/help'),
+        message(private, '/random'),
+        message(private, '/start'),
+        message(private, 'some text'),
+        message(private, '/random'),
+        message(private, '/cancel'),
+        message(private, 'more text'),
+        message(private, '/about'),
+    ]
+
+    updates = [Update(i, message=m) for i, m in enumerate(messages)]
+    updates.append(Update(len(updates), callback_query=CallbackQuery(
+        '1', user, 'instance', message=replied, data='1:1:1', bot=bot)))
+
+    return updates
+
+
+def dispatch(dispatcher, updates):
+    for update in updates:
+        dispatcher.process_update(update)
+
+
+def test__parse_command__messages__matches_command_handler():
+    bot = create_bot()
+    chat = Chat(1, Chat.GROUP)
+
+    def parse(text):
+        message = Message(1, None, datetime.datetime.now(), chat, text=text)
+        return parse_command(message, USERNAME)
+
+    assert parse('/Stats week') == 'stats'
+    assert parse(f'/stats@{USERNAME.upper()}') == 'stats'
+    assert parse('/stats@other_bot') is None
+    assert parse('/') is None
+    assert parse('/@soup_bot') is None
+    assert parse('stats') is None
+    assert parse(None) is None
+
+
+def test__router__bot_updates__matches_dispatcher_groups():
+    bot = create_bot()
+    updates = create_updates(bot)
+
+    grouped_calls = []
+    grouped = Dispatcher(bot, None, workers=0)
+    for i, handler in enumerate(create_handlers(grouped_calls)[0]):
+        grouped.add_handler(handler, group=i)
+
+    routed_calls = []
+    routed = Dispatcher(bot, None, workers=0)
+    handlers, conversation = create_handlers(routed_calls)
+    routed.add_handler(Router(handlers, private=[conversation]))
+
+    dispatch(grouped, updates)
+    dispatch(routed, updates)
+
+    assert routed_calls == grouped_calls
+    assert ('dm text', 16) in routed_calls
+    assert ('vote', len(updates) - 1) in routed_calls
+
+
+def test__router__group_message__skips_command_handlers():
+    bot = create_bot()
+    handlers, conversation = create_handlers([])
+    router = Router(handlers, private=[conversation])
+
+    update = create_updates(bot)[0]
+    route = router.route(*router.classify(update, USERNAME))
+
+    assert route == [handlers[4]]
+    assert router.route('command', 'help', False) == handlers[1:3] + [handlers[4]]
+    assert router.route('callback', None, True) == [handlers[7], conversation]
@@ -0,0 +1,100 @@
+import asyncio
+import contextlib
+import threading
+import time
+
+import pytest
+from telegram.error import InvalidToken, RetryAfter
+from telegram.ext import MessageHandler, Filters
+
+from soup.fakebot import TOKEN, FakeBotAPI, FakeBotServer, RateLimits
+from soup.outbox import Outbox, when_sent
+from soup.runtime import AsyncBotAPI, AsyncRuntime
+
+
+class FakeDatabase:
+    @contextlib.contextmanager
+    def session_scope(self):
+        yield 'session'
+
+
+@pytest.fixture
+def server():
+    server = FakeBotServer(FakeBotAPI(limits=RateLimits(chat=(1, 10)))).start()
+    yield server
+    server.stop()
+
+
+def test__async_bot_api__fake_server__keeps_connection_and_raises_errors(server):
+    loop = asyncio.new_event_loop()
+    api = AsyncBotAPI(TOKEN, base_url=server.url)
+
+    async def calls():
+        me = await api.call('getMe', {})
+        message = await api.call('sendMessage', {'chat_id': 5, 'text': 'hi'})
+
+        with pytest.raises(RetryAfter):
+            await api.call('sendMessage', {'chat_id': 5, 'text': 'again'})
+
+        return me, message
+
+    try:
+        me, message = loop.run_until_complete(calls())
+
+        # Requests one after another share a connection
+        assert len(api.client.idle) == 1
+
+        with pytest.raises(InvalidToken):
+            bad = AsyncBotAPI('', base_url=server.url.replace('/bot', '/'))
+            loop.run_until_complete(bad.call('getMe', {}))
+    finally:
+        api.client.close()
+        loop.close()
+
+    assert me['username'] == 'soup_bot'
+    assert message['chat']['id'] == 5 and message['text'] == 'hi'
+
+
+def test__async_runtime__fake_server__handles_each_chat_in_order(server):
+    server.api.limits = None
+    outbox = Outbox(chat=(1000, 10), group=(1000, 10), total=(1000, 10))
+    runtime = AsyncRuntime(TOKEN, outbox, base_url=server.url, workers=4)
+
+    handled = []
+    sent = []
+    lock = threading.Lock()
+
+    def reply(bot, update):
+        with lock:
+            handled.append((update.effective_chat.id, int(update.message.text)))
+
+        when_sent(update.message.reply_text('a quote'),
+            lambda message, session: sent.append((message.chat_id, session)),
+            None)
+
+    outbox.start(runtime.dispatcher, FakeDatabase())
+    runtime.dispatcher.add_handler(MessageHandler(Filters.text, reply))
+    runtime.dispatcher.add_handler(outbox.handler)
+
+    for i in range(40):
+        chat_id = -(i % 4) - 1
+        server.api.push_update({'message': {
+            'message_id': i, 'date': 0, 'text': str(i),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'chat'}}})
+
+    runtime.start_polling(timeout=1)
+
+    deadline = time.monotonic() + 10
+    while len(handled) < 40 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    runtime.stop()
+
+    for chat_id in (-1, -2, -3, -4):
+        texts = [text for chat, text in handled if chat == chat_id]
+        assert texts == sorted(texts) and len(texts) == 10
+
+    # Callbacks of every reply ran before stopping, with a session
+    assert len(sent) == 40 and sent[0][1] == 'session'
+    assert runtime.update_queue.empty()
+    assert server.api.calls['sendMessage'] == 40
@@ -0,0 +1,129 @@
+import collections
+import random
+
+from soup.sampling import (
+    FenwickTree, ShuffleBag, WeightedSampler, pack_ids, unpack_ids)
+
+
+def weight(score):
+    return max(score + 5, 1)
+
+
+# Fenwick tree
+
+
+def test__fenwick_tree__prefix_sums__match_naive_sums():
+    weights = [random.randint(0, 50) for _ in range(100)]
+    tree = FenwickTree(weights)
+
+    for count in range(len(weights) + 1):
+        assert tree.prefix_sum(count) == sum(weights[:count])
+
+
+def test__fenwick_tree__append_and_add__match_naive_sums():
+    weights = []
+    tree = FenwickTree()
+
+    for _ in range(200):
+        if weights and random.random() < 0.5:
+            index = random.randrange(len(weights))
+            delta = random.randint(-weights[index], 20)
+            weights[index] += delta
+            tree.add(index, delta)
+        else:
+            weights.append(random.randint(0, 20))
+            tree.append(weights[-1])
+
+    for count in range(len(weights) + 1):
+        assert tree.prefix_sum(count) == sum(weights[:count])
+
+
+def test__fenwick_tree__find__returns_index_containing_target():
+    weights = [3, 0, 1, 4, 0, 2]
+    tree = FenwickTree(weights)
+
+    expected = [0, 0, 0, 2, 3, 3, 3, 3, 5, 5]
+    assert [tree.find(target) for target in range(tree.total())] == expected
+
+
+# Weighted sampler
+
+
+def test__weighted_sampler__empty__draws_none():
+    assert WeightedSampler(weight).draw() is None
+
+
+def test__weighted_sampler__draws__are_proportional_to_weight():
+    sampler = WeightedSampler(weight, [(1, -4), (2, 5)])
+    rng = random.Random(0)
+
+    counts = collections.Counter(sampler.draw(rng) for _ in range(11000))
+    assert 800 < counts[1] < 1200
+    assert 9800 < counts[2] < 10200
+
+
+def test__weighted_sampler__removed_quote__is_never_drawn():
+    sampler = WeightedSampler(weight, [(1, 0), (2, 0), (3, 0)])
+    sampler.remove(2)
+
+    assert 2 not in sampler
+    assert all(sampler.draw() != 2 for _ in range(100))
+
+
+def test__weighted_sampler__set__reuses_removed_slots():
+    sampler = WeightedSampler(weight, [(1, 0), (2, 0)])
+    sampler.remove(1)
+    sampler.set(3, 10)
+
+    assert len(sampler.ids) == 2
+    assert sampler.tree.total() == weight(0) + weight(10)
+
+
+def test__weighted_sampler__set_existing_quote__updates_weight():
+    sampler = WeightedSampler(weight, [(1, 0)])
+    sampler.set(1, 20)
+
+    assert len(sampler) == 1
+    assert sampler.tree.total() == weight(20)
+
+
+# Shuffle bag
+
+
+def test__shuffle_bag__pops__return_every_id_once():
+    ids = list(range(1, 51))
+    bag = ShuffleBag(ids)
+
+    drawn = [bag.pop() for _ in range(len(ids))]
+    assert sorted(drawn) == ids
+    assert bag.pop() is None
+
+
+def test__shuffle_bag__remove__id_is_never_popped():
+    bag = ShuffleBag([1, 2, 3])
+    bag.remove(2)
+    bag.remove(4)
+
+    assert sorted(bag.pop() for _ in range(2)) == [1, 3]
+
+
+def test__shuffle_bag__add__updates_high_water():
+    bag = ShuffleBag([5, 3])
+    assert bag.high_water == 5
+
+    bag.add(8)
+    assert bag.high_water == 8
+    assert 8 in bag
+
+
+def test__shuffle_bag__dumps_and_loads__round_trip():
+    ids = random.sample(range(1, 10 ** 7), 500)
+    bag = ShuffleBag.loads(ShuffleBag(ids).dumps())
+
+    assert sorted(bag.ids) == sorted(ids)
+
+
+def test__pack_ids__dense_ids__are_compact():
+    ids = list(range(1, 10001))
+    assert unpack_ids(pack_ids(ids)) == ids
+    assert len(pack_ids(ids)) < 1000
@@ -0,0 +1,124 @@
+import pytest
+
+from soup.search import (
+    And, Not, Or, SearchSyntaxError, Term, MAX_SEARCH_DEPTH,
+    MAX_SEARCH_LENGTH, MAX_SEARCH_TERMS, parse_search, search_signature)
+
+
+class Tag:
+    role = None
+    priority = 50
+
+    def __init__(self, name, value, cmp=None):
+        self.name = name
+        self.value = value
+        self.cmp = cmp
+
+    @property
+    def shape(self):
+        return (self.name, self.cmp)
+
+
+def create_tag(name, value, cmp=None):
+    if name == 'invalid':
+        raise ValueError("Invalid tag name")
+    return Tag(name, value, cmp=cmp)
+
+
+def parse(text):
+    return parse_search(text, create_tag)
+
+
+# Parsing
+
+
+def test__parse_search__empty_search__is_none():
+    assert parse("   ") is None
+
+
+def test__parse_search__single_word__is_term():
+    expression = parse("soup")
+    assert isinstance(expression, Term)
+    assert expression.value == "soup"
+
+
+def test__parse_search__multiple_words__are_anded():
+    expression = parse("soup dumpling")
+    assert isinstance(expression, And)
+    assert [term.value for term in expression.children] == ["soup", "dumpling"]
+
+
+def test__parse_search__or__groups_have_lower_precedence_than_and():
+    expression = parse("soup dumpling OR rice")
+    assert isinstance(expression, Or)
+    assert [child.shape for child in expression.children] == [
+        ('and', ('term',), ('term',)), ('term',)]
+
+
+def test__parse_search__quoted_phrase__is_single_term():
+    expression = parse('"soup dumpling"')
+    assert isinstance(expression, Term)
+    assert expression.value == "soup dumpling"
+    assert expression.phrase
+
+
+def test__parse_search__negated_word_phrase_and_tag__are_not_nodes():
+    expression = parse('-soup -"fried rice" -author:doktor')
+    assert isinstance(expression, And)
+    assert all(isinstance(child, Not) for child in expression.children)
+
+
+def test__parse_search__tag__is_created_with_comparator():
+    tag = parse("score:>=10")
+    assert (tag.name, tag.cmp, tag.value) == ('score', '>=', '10')
+
+
+def test__parse_search__tags_are_ordered_before_terms():
+    expression = parse("soup score:>1")
+    assert isinstance(expression.children[0], Tag)
+
+
+def test__parse_search__parentheses__group_expressions():
+    expression = parse("(soup OR rice) -(fried OR boiled)")
+    assert expression.shape == (
+        'and',
+        ('or', ('term',), ('term',)),
+        ('not', ('or', ('term',), ('term',))))
+
+
+def test__parse_search__same_shape__same_signature():
+    assert (search_signature(parse("soup OR -rice"))
+            == search_signature(parse("noodle OR -dumpling")))
+    assert (search_signature(parse("soup OR -rice"))
+            != search_signature(parse("soup -rice")))
+
+
+@pytest.mark.parametrize('text', [
+    '"soup',
+    '(soup',
+    'soup)',
+    '()',
+    'OR soup',
+    'soup OR',
+    '""',
+    'invalid:tag',
+])
+def test__parse_search__invalid_syntax__raises(text):
+    with pytest.raises(SearchSyntaxError):
+        parse(text)
+
+
+def test__parse_search__too_long__raises():
+    with pytest.raises(SearchSyntaxError):
+        parse("a" * (MAX_SEARCH_LENGTH + 1))
+
+
+def test__parse_search__too_many_terms__raises():
+    with pytest.raises(SearchSyntaxError):
+        parse(' OR '.join(['a'] * (MAX_SEARCH_TERMS + 1)))
+
+
+def test__parse_search__too_deeply_nested__raises():
+    depth = MAX_SEARCH_DEPTH + 1
+    with pytest.raises(SearchSyntaxError):
+        parse('(' * depth + 'soup' + ')' * depth)
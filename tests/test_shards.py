@@ -0,0 +1,185 @@
+import datetime
+import os
+import sqlite3
+
+from soup.classes import Chat, User
+from soup.database import QuoteDatabase
+from soup.maintenance import backup_database
+from soup.search import Term
+from soup.shards import ShardPool, ShardedQuoteDatabase, split
+
+
+def add_chats(db, session, chat_ids, user_ids):
+    for user_id in user_ids:
+        session.add(User(id=user_id, first_name=f'user {user_id}'))
+
+    for chat_id in chat_ids:
+        session.add(Chat(id=chat_id, type='group', title=f'chat {chat_id}'))
+
+        for user_id in user_ids:
+            db.add_membership(session, user_id, chat_id)
+
+    session.flush()
+
+
+def add_quote(db, session, chat_id, user_id, content, days=0):
+    sent_at = datetime.datetime(2019, 1, 1) + datetime.timedelta(days=days)
+    quote, status = db.add_quote(
+        session, chat_id, days, False, sent_at, user_id, 'text', content,
+        content, '', user_id)
+
+    return quote, status
+
+
+def count_rows(path, table):
+    connection = sqlite3.connect(path)
+
+    try:
+        return connection.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def test__sharded_database__quotes__written_to_their_chats_files(tmpdir):
+    db = ShardedQuoteDatabase(
+        str(tmpdir.join('data.db')), str(tmpdir.join('shards')))
+
+    with db.session_scope() as session:
+        add_chats(db, session, [-1, -2], [1, 2])
+
+        first, _ = add_quote(db, session, -1, 1, "soup")
+        second, _ = add_quote(db, session, -2, 1, "dumpling")
+        db.add_message(session, -2, 100, second)
+        quote_ids = [first.id, second.id]
+
+    with db.session_scope() as session:
+        assert db.add_vote(session, 2, quote_ids[1], 1) == db.VOTE_ADDED
+        assert db.get_votes(session, -2, 100) == (1, 1, 0)
+
+        # Quote IDs are unique across chats, and so are quotes
+        assert quote_ids == [1, 2]
+        _, status = add_quote(db, session, -1, 1, "dumpling")
+        assert status == db.QUOTE_ALREADY_EXISTS
+
+        assert db.get_quote_count(session, -1) == 1
+        assert [user.id for user, _, _, _ in
+            db.get_highest_scoring(session, -2)] == [1]
+
+    assert count_rows(db.shards.path(-1), 'quote') == 1
+    assert count_rows(db.shards.path(-2), 'vote') == 1
+    assert 'quote' not in {name for name, in sqlite3.connect(db.filename)
+        .execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test__shard_pool__more_chats_than_size__evicts_least_recently_used(tmpdir):
+    pool = ShardPool(str(tmpdir.join('data.db')), str(tmpdir.join('shards')),
+        size=2)
+
+    first = pool.engine(-1)
+    pool.engine(-2)
+    assert pool.engine(-1) is first
+
+    pool.engine(-3)
+
+    assert list(pool.engines) == [-1, -3]
+    assert pool.metrics() == {'chats': 3, 'open': 2, 'opened': 3, 'evicted': 1}
+    assert pool.chat_ids() == [-3, -2, -1]
+
+
+def test__search_member_quote__sharded__only_searches_member_chats(tmpdir):
+    db = ShardedQuoteDatabase(
+        str(tmpdir.join('data.db')), str(tmpdir.join('shards')))
+
+    with db.session_scope() as session:
+        add_chats(db, session, [-1, -2], [1])
+        add_chats(db, session, [-3], [2])
+
+        for chat_id in (-1, -2, -3):
+            add_quote(db, session, chat_id, 1, f"soup {chat_id}", days=-chat_id)
+
+    with db.session_scope() as session:
+        found = {db.search_member_quote(session, 1, Term("soup"))[0].chat_id
+            for _ in range(30)}
+
+        assert found == {-1, -2}
+        assert db.search_member_quote(session, 1, Term("rice")) == (None, None)
+
+
+def test__archive_deleted_quotes__sharded__moves_quotes_to_catalog(tmpdir):
+    db = ShardedQuoteDatabase(
+        str(tmpdir.join('data.db')), str(tmpdir.join('shards')))
+
+    with db.session_scope() as session:
+        add_chats(db, session, [-1, -2], [1, 2])
+
+        for chat_id in (-1, -2):
+            quote, _ = add_quote(db, session, chat_id, 1, f"gone {chat_id}",
+                days=-chat_id)
+            db.add_vote(session, 2, quote.id, -1)
+            db.delete_quote(session, quote.id)
+
+        add_quote(db, session, -1, 1, "live")
+
+    assert db.archive_deleted_quotes(pause=0) == 2
+    assert db.table_size('quote')[0] == 1
+    assert db.table_size('archived_vote')[0] == 2
+
+    with db.session_scope() as session:
+        _, status = add_quote(db, session, -2, 1, "gone -2", days=2)
+        assert status == db.QUOTE_PREVIOUSLY_DELETED
+
+
+def test__migrate_chat__sharded__moves_chats_file(tmpdir):
+    db = ShardedQuoteDatabase(
+        str(tmpdir.join('data.db')), str(tmpdir.join('shards')))
+
+    with db.session_scope() as session:
+        add_chats(db, session, [-1], [1])
+        quote, _ = add_quote(db, session, -1, 1, "soup")
+        quote_id = quote.id
+
+    with db.session_scope() as session:
+        db.migrate_chat(session, -1, -1001)
+
+    assert not os.path.exists(db.shards.path(-1))
+
+    with db.session_scope() as session:
+        assert db.get_quote_count(session, -1001) == 1
+        assert db.get_quote_by_id(session, quote_id).chat_id == -1001
+
+
+def test__split__existing_database__copies_each_chat_and_backs_up(tmpdir):
+    source = QuoteDatabase(str(tmpdir.join('source.db')))
+
+    with source.session_scope() as session:
+        add_chats(source, session, [-1, -2], [1, 2])
+
+        for i in range(6):
+            quote, _ = add_quote(source, session, -1 - i % 2, 1, f"soup {i}",
+                days=i)
+            source.add_vote(session, 2, quote.id, 1)
+            source.add_message(session, -1 - i % 2, i, quote)
+
+    report = split(str(tmpdir.join('source.db')),
+        catalog=str(tmpdir.join('data.db')),
+        directory=str(tmpdir.join('shards')))
+
+    assert report.quotes == 6
+    assert report.chats[-1]['quote'] == report.chats[-2]['quote'] == 3
+    assert report.chats[-1]['vote'] == report.chats[-1]['quote_message'] == 3
+
+    db = ShardedQuoteDatabase(
+        str(tmpdir.join('data.db')), str(tmpdir.join('shards')))
+
+    with db.session_scope() as session:
+        assert db.get_chat_stats(session, -2)[0] == 3
+        assert db.get_user_score(session, 1, -1) == (3, 3, 0)
+
+        # New quotes don't reuse the source's IDs
+        quote, _ = add_quote(db, session, -2, 2, "new")
+        assert quote.id == 7
+
+    text = backup_database(db, str(tmpdir.join('backups')), keep=2)
+
+    assert text.endswith("backed up 2 chats' files")
+    assert len(tmpdir.join('backups', 'shards').listdir()) == 2
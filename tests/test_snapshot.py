@@ -0,0 +1,86 @@
+import datetime
+
+from soup.classes import Chat, User
+from soup.database import QuoteDatabase
+from soup.snapshot import load_snapshot, save_snapshot, start_run
+
+
+def add_quotes(db, count, chat_id=-1):
+    with db.session_scope() as session:
+        if not db.user_exists(session, 1):
+            session.add(User(id=1, first_name='soup'))
+
+        session.add(Chat(id=chat_id, type='group', title='dumplings'))
+
+        for i in range(count):
+            sent_at = datetime.datetime(2019, 1, 1) + datetime.timedelta(days=i)
+            content = f"quote {sent_at} in {chat_id}"
+            db.add_quote(session, chat_id, i, False, sent_at, 1, 'text',
+                content, content, '', 1)
+
+
+def warm_up(db, chat_id=-1):
+    with db.session_scope() as session:
+        db.get_sampler(session, chat_id)
+        db.get_shuffled_random_quote(session, chat_id)
+        db.get_activity(session, chat_id)
+        db.get_archived_keys(session)
+
+
+def test__snapshot__next_run__caches_restored_without_queries(tmpdir):
+    path = str(tmpdir.join('snapshots', 'bot.snapshot'))
+    db = QuoteDatabase(str(tmpdir.join('data.db')))
+
+    start_run(db)
+    add_quotes(db, 5)
+    warm_up(db)
+    assert save_snapshot(db, path).startswith("saved 4 sections")
+
+    restarted = QuoteDatabase(str(tmpdir.join('data.db')))
+    start_run(restarted)
+
+    assert load_snapshot(restarted, path).startswith(
+        "loaded 1 samplers, 1 bags, 1 activity snapshots and 1 archived key sets")
+    assert not tmpdir.join('snapshots', 'bot.snapshot').exists()
+
+    assert (restarted.samplers[-1].slots.keys()
+        == db.samplers[-1].slots.keys())
+    assert restarted.samplers[-1].tree.total() == db.samplers[-1].tree.total()
+    assert sorted(restarted.bags[-1].ids) == sorted(db.bags[-1].ids)
+    assert len(restarted.bags[-1]) == 4
+    assert restarted.activity[-1].rows.keys() == db.activity[-1].rows.keys()
+    assert len(restarted.archived_keys) == 0
+
+
+def test__snapshot__stale__ignored_and_deleted(tmpdir):
+    path = str(tmpdir.join('bot.snapshot'))
+    db = QuoteDatabase(str(tmpdir.join('data.db')))
+
+    start_run(db)
+    add_quotes(db, 2)
+    warm_up(db)
+
+    # A run that didn't save a snapshot came in between
+    save_snapshot(db, path)
+    start_run(db)
+    start_run(db)
+
+    assert load_snapshot(db, path) == "snapshot ignored: it's from an earlier run"
+    assert load_snapshot(db, path) == "no snapshot"
+
+    # Quotes were added while the bot was stopped
+    save_snapshot(db, path)
+    add_quotes(db, 1, chat_id=-2)
+    start_run(db)
+
+    assert load_snapshot(db, path) == (
+        "snapshot ignored: quotes were added or archived since")
+
+    # The file was cut short
+    save_snapshot(db, path)
+    start_run(db)
+
+    with open(path, 'r+b') as f:
+        f.truncate(40)
+
+    assert load_snapshot(db, path) == "snapshot ignored: the snapshot is damaged"
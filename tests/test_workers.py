@@ -0,0 +1,231 @@
+import datetime
+import functools
+import os
+import queue
+import threading
+import time
+
+from soup.classes import Chat, QuoteBag, User
+from soup.database import QuoteDatabase
+from soup.replay import command
+from soup.workers import Supervisor, chat_key, shard
+
+
+class FakeDispatcher:
+    """Appends the chat and text of each update to a file, and kills its
+    worker at the first 'crash' of any worker."""
+
+    def __init__(self, path):
+        self.path = path
+        self.bot = None
+        self.update_queue = queue.Queue()
+
+    def process_update(self, update):
+        message = update.message
+        crashed = os.path.join(os.path.dirname(self.path), 'crashed')
+
+        if message.text == 'crash' and not os.path.exists(crashed):
+            open(crashed, 'w').close()
+            os._exit(1)
+
+        # "tell CHAT_ID" sends a message to the worker that owns the chat
+        if message.text.startswith('tell '):
+            self.send_to_owner(int(message.text.split()[1]), message.chat_id)
+
+        with open(self.path, 'a') as f:
+            f.write(f'{message.chat_id} {message.text}\n')
+
+    def on_message(self, chat_id, sender):
+        with open(self.path, 'a') as f:
+            f.write(f'{chat_id} told_by_{sender}\n')
+
+
+def fake_worker(directory, index, workers):
+    dispatcher = FakeDispatcher(os.path.join(directory, f'worker_{index}.log'))
+    dispatcher.on_message = [dispatcher.on_message]
+    return dispatcher
+
+
+def read_logs(tmpdir):
+    lines = []
+    for path in tmpdir.listdir('*.log'):
+        lines += path.read().splitlines()
+    return lines
+
+
+def test__chat_key__updates__keyed_by_chat_or_sender():
+    user = {'id': 5, 'is_bot': False, 'first_name': 'a'}
+    message = {'message_id': 1, 'date': 0, 'chat': {'id': -100}, 'from': user}
+
+    assert chat_key({'update_id': 1, 'message': message}) == -100
+    assert chat_key({'update_id': 2, 'callback_query': {
+        'id': '1', 'from': user, 'message': message}}) == -100
+    # Inline messages have no chat
+    assert chat_key({'update_id': 3, 'callback_query': {
+        'id': '1', 'from': user, 'inline_message_id': 'x'}}) == 5
+    assert chat_key({'update_id': 4}) is None
+
+
+def test__shard__ids_with_a_pattern__spread_over_workers():
+    chats = [-1001000000000 - i * 100 for i in range(100)]
+    counts = [0] * 4
+
+    for chat_id in chats:
+        counts[shard(chat_id, 4)] += 1
+
+    assert all(count > 10 for count in counts)
+    assert shard(None, 4) == 0
+
+
+def test__supervisor__worker_dies__restarts_and_keeps_chat_order(tmpdir):
+    handled = []
+    done = threading.Event()
+    chats = [-1, -2, -3, -4]
+    texts = ['first', 'crash', 'third']
+
+    def on_handled(update_id):
+        handled.append(update_id)
+
+        if len(handled) == len(chats) * len(texts):
+            done.set()
+
+    supervisor = Supervisor(
+        functools.partial(fake_worker, str(tmpdir)), workers=2,
+        on_handled=on_handled).start()
+
+    try:
+        assert supervisor.wait_ready(30)
+        update_id = 0
+
+        for text in texts:
+            for chat_id in chats:
+                update_id += 1
+                user = {'id': 1, 'is_bot': False, 'first_name': 'a'}
+                supervisor.submit(command(
+                    update_id, {'id': chat_id, 'type': 'group'}, user, text, 0))
+
+        assert done.wait(30)
+        metrics = supervisor.metrics()
+    finally:
+        supervisor.stop()
+
+    lines = read_logs(tmpdir)
+
+    # Each chat's updates were handled in order, once the crash was resent
+    for chat_id in chats:
+        assert [line.split()[1] for line in lines
+            if int(line.split()[0]) == chat_id] == texts
+
+    assert sum(m['restarts'] for m in metrics) == 1
+    assert sum(m['handled'] for m in metrics) == len(chats) * len(texts)
+    assert all(m['in_flight'] == 0 for m in metrics)
+
+
+def test__supervisor__message_to_owner__passed_on_to_its_worker(tmpdir):
+    group_id, user_id = -1, 1
+    assert shard(group_id, 2) != shard(user_id, 2)
+
+    supervisor = Supervisor(
+        functools.partial(fake_worker, str(tmpdir)), workers=2).start()
+
+    try:
+        assert supervisor.wait_ready(30)
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'a'}
+        supervisor.submit(command(
+            1, {'id': user_id, 'type': 'private'}, user, f'tell {group_id}', 0))
+
+        log = tmpdir.join(f'worker_{shard(group_id, 2)}.log')
+        deadline = time.monotonic() + 30
+
+        while time.monotonic() < deadline:
+            if log.check() and f'{group_id} told_by_{user_id}' in log.read():
+                break
+            time.sleep(0.05)
+        else:
+            raise AssertionError("the message wasn't passed on")
+    finally:
+        supervisor.stop()
+
+
+def test__random__by_dm_and_by_group__only_owner_keeps_chat_state(tmpdir):
+    # The group's worker, and the worker of a user's direct messages
+    group_id, user_id = -1, 1
+    assert shard(group_id, 2) != shard(user_id, 2)
+
+    workers = [QuoteDatabase(str(tmpdir.join('data.db'))) for _ in range(2)]
+    workers[0].owner = lambda chat_id: shard(chat_id, 2) == 0
+    workers[1].owner = lambda chat_id: shard(chat_id, 2) == 1
+
+    group_worker = workers[shard(group_id, 2)]
+    dm_worker = workers[shard(user_id, 2)]
+
+    with group_worker.session_scope() as session:
+        session.add(User(id=user_id, first_name='soup'))
+        session.add(Chat(id=group_id, type='group', title='dumplings'))
+
+        for i in range(5):
+            content = f"quote {i}"
+            group_worker.add_quote(session, group_id, i, False,
+                datetime.datetime(2019, 1, 1 + i), user_id, 'text', content,
+                content, '', user_id)
+
+    # /random in the group
+    with group_worker.session_scope() as session:
+        quote, _ = group_worker.get_random_quote(session, group_id)
+        assert quote is not None
+
+    with group_worker.session_scope() as session:
+        saved = session.query(QuoteBag).get(group_id).quote_ids
+
+    # /random, weighted /random and /activity by direct message
+    with dm_worker.session_scope() as session:
+        assert dm_worker.get_random_quote(session, group_id)[0] is not None
+        dm_worker.set_random_mode(session, group_id, 'weighted')
+
+    with dm_worker.session_scope() as session:
+        assert dm_worker.get_random_quote(session, group_id)[0] is not None
+        dm_worker.get_activity(session, group_id)
+
+    assert len(group_worker.bags[group_id]) == 4
+    assert not dm_worker.bags and not dm_worker.samplers and not dm_worker.activity
+
+    # The group's saved bag is left to its worker
+    with dm_worker.session_scope() as session:
+        assert session.query(QuoteBag).get(group_id).quote_ids == saved
+
+
+def test__vote__by_dm__owner_updates_chat_state(tmpdir):
+    group_id, user_id = -1, 1
+    workers = [QuoteDatabase(str(tmpdir.join('data.db'))) for _ in range(2)]
+
+    for index, worker in enumerate(workers):
+        worker.owner = functools.partial(
+            lambda index, chat_id: shard(chat_id, 2) == index, index)
+        # Stands in for the supervisor passing changes on
+        worker.on_foreign_change = lambda chat_id, change: (
+            workers[shard(chat_id, 2)].apply_change(change))
+
+    group_worker = workers[shard(group_id, 2)]
+    dm_worker = workers[shard(user_id, 2)]
+
+    with group_worker.session_scope() as session:
+        session.add(User(id=user_id, first_name='soup'))
+        session.add(Chat(id=group_id, type='group', title='dumplings'))
+        quote, _ = group_worker.add_quote(session, group_id, 1, False,
+            datetime.datetime(2019, 1, 1), user_id, 'text', 'quote', 'quote',
+            '', user_id)
+        quote_id = quote.id
+
+    with group_worker.session_scope() as session:
+        sampler = group_worker.get_sampler(session, group_id)
+        snapshot = group_worker.get_activity(session, group_id)
+
+    # An upvote of the group's quote, by direct message
+    with dm_worker.session_scope() as session:
+        assert dm_worker.add_vote(session, user_id, quote_id, 1) == (
+            dm_worker.VOTE_ADDED)
+
+    assert sampler.weights[sampler.slots[quote_id]] == (
+        group_worker.quote_weight(1))
+    assert snapshot.columns['score'][snapshot.rows[quote_id]] == 1
+    assert not dm_worker.samplers and not dm_worker.activity